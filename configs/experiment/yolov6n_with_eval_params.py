@@ -62,6 +62,7 @@ eval_params = dict(
     img_size=None,  #None mean will be the same as train image size
     conf_thres=0.03,
     iou_thres=0.65,
+    max_candidates=30000,  # max candidates per image put into NMS
 
     #pading and scale coord
     test_load_size=None, #None mean will be the same as test image size
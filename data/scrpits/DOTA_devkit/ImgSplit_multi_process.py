@@ -1,9 +1,17 @@
 """
 -------------
 This is the multi-process version
+out_format 'files' writes one image and one labelTxt per patch,
+out_format 'shards' appends the encoded patches to binary shards
+    outpath/shards/<rate>-<pid>-<k>.bin
+and indexes them in outpath/shards/index.json:
+    {"version": 1, "ext": ".png", "patches": [{"name", "shard", "offset", "length", "width", "height",
+                                                "labels": ["x1 y1 ... x4 y4 name difficult", ...]}, ...]}
+which yolov6/data/shards_R.py reads for training without unpacking.
 """
 import os
 import codecs
+import json
 import numpy as np
 import math
 from dota_utils import GetFileFromThisRootDir
@@ -42,7 +50,37 @@ def cal_line_length(point1, point2):
 
 
 def split_single_warp(name, split_base, rate, extent):
-    split_base.SplitSingle(name, rate, extent)
+    return split_base.SplitSingle(name, rate, extent)
+
+
+class GridIndex():
+    """
+        uniform grid buckets of the object hbbs, a patch only tests the objects of the cells it covers
+    """
+    def __init__(self, hbbs, cell_size):
+        self.hbbs = np.asarray(hbbs, dtype=np.float64).reshape(-1, 4)
+        self.cell_size = cell_size
+        self.cells = {}
+        cells = np.floor(self.hbbs / cell_size).astype(np.int64)
+        for i, (cx0, cy0, cx1, cy1) in enumerate(cells):
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    self.cells.setdefault((cx, cy), []).append(i)
+
+    def query(self, left, up, right, down):
+        """
+        :return: sorted index of the objects whose hbbs overlap the rectangle (left, up, right, down)
+        """
+        cx0, cy0 = int(left // self.cell_size), int(up // self.cell_size)
+        cx1, cy1 = int(right // self.cell_size), int(down // self.cell_size)
+        inds = [self.cells[(cx, cy)] for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)
+                if (cx, cy) in self.cells]
+        if not inds:
+            return np.zeros(0, dtype=np.int64)
+        inds = np.unique(np.concatenate(inds))
+        hbbs = self.hbbs[inds]
+        overlap = (hbbs[:, 0] <= right) & (hbbs[:, 2] >= left) & (hbbs[:, 1] <= down) & (hbbs[:, 3] >= up)
+        return inds[overlap]
 
 
 class splitbase():
@@ -56,7 +94,9 @@ class splitbase():
                  choosebestpoint=True,
                  ext='.png',
                  padding=True,
-                 num_process=8
+                 num_process=8,
+                 out_format='files',
+                 shard_size=1 << 30
                  ):
         """
         :param basepath: base path for dota data
@@ -69,7 +109,10 @@ class splitbase():
         :param choosebestpoint: used to choose the first point for the
         :param ext: ext for the image format
         :param padding: if to padding the images so that all the images have the same size
+        :param out_format: 'files' for one image and labelTxt per patch, 'shards' for binary shards with an index
+        :param shard_size: bytes of one shard in the 'shards' format
         """
+        assert out_format in ('files', 'shards'), 'Not supported out format: {}'.format(out_format)
         self.basepath = basepath
         self.outpath = outpath
         self.code = code
@@ -85,6 +128,9 @@ class splitbase():
         self.ext = ext
         self.padding = padding
         self.num_process = num_process
+        self.out_format = out_format
+        self.shard_size = shard_size
+        self.outshardpath = os.path.join(self.outpath, 'shards')
         self.pool = Pool(num_process)
         print('padding:', padding)
 
@@ -96,6 +142,8 @@ class splitbase():
             os.mkdir(self.outimagepath)
         if not os.path.isdir(self.outlabelpath):
             os.mkdir(self.outlabelpath)
+        if out_format == 'shards' and not os.path.isdir(self.outshardpath):
+            os.mkdir(self.outshardpath)
         # pdb.set_trace()
     # point: (x, y), rec: (xmin, ymin, xmax, ymax)
     # def __del__(self):
@@ -120,16 +168,17 @@ class splitbase():
         return inter_poly, half_iou
 
     def saveimagepatches(self, img, subimgname, left, up):
-        subimg = copy.deepcopy(
-            img[up: (up + self.subsize), left: (left + self.subsize)])
-        outdir = os.path.join(self.outimagepath, subimgname + self.ext)
+        subimg = img[up: (up + self.subsize), left: (left + self.subsize)]
         h, w, c = np.shape(subimg)
         if (self.padding):
-            outimg = np.zeros((self.subsize, self.subsize, 3))
+            outimg = np.zeros((self.subsize, self.subsize, 3), dtype=img.dtype)
             outimg[0:h, 0:w, :] = subimg
-            cv2.imwrite(outdir, outimg)
         else:
-            cv2.imwrite(outdir, subimg)
+            outimg = subimg
+        if self.out_format == 'shards':
+            return cv2.imencode(self.ext, outimg)[1], outimg.shape
+        outdir = os.path.join(self.outimagepath, subimgname + self.ext)
+        cv2.imwrite(outdir, outimg)
 
     def GetPoly4FromPoly5(self, poly):
         distances = [cal_line_length((poly[i * 2], poly[i * 2 + 1]), (poly[(
@@ -157,13 +206,25 @@ class splitbase():
                 count = count + 1
         return outpoly
 
-    def savepatches(self, resizeimg, objects, subimgname, left, up, right, down):
-        outdir = os.path.join(self.outlabelpath, subimgname + '.txt')
+    def savepatches(self, resizeimg, objects, subimgname, left, up, right, down, index=None):
+        """
+        :param index: GridIndex of the objects, all the objects are tested if None
+        :return: (encoded patch, patch shape, label lines) in the 'shards' format, None in the 'files' format
+        """
         mask_poly = []
         imgpoly = shgeo.Polygon([(left, up), (right, up), (right, down),
                                  (left, down)])
-        with codecs.open(outdir, 'w', self.code) as f_out:
-            for obj in objects:
+        candidates = range(len(objects)) if index is None else index.query(left, up, right, down)
+        outlines = []
+        for obj_id in candidates:
+            obj = objects[obj_id]
+            if obj['area'] <= 0:
+                continue
+            xs, ys = obj['poly'][0::2], obj['poly'][1::2]
+            if min(xs) >= left and max(xs) <= right and min(ys) >= up and max(ys) <= down:
+                # fully inside the patch, no need of the intersection
+                half_iou = 1
+            else:
                 gtpoly = shgeo.Polygon([(obj['poly'][0], obj['poly'][1]),
                                         (obj['poly'][2], obj['poly'][3]),
                                         (obj['poly'][4], obj['poly'][5]),
@@ -172,57 +233,76 @@ class splitbase():
                     continue
                 inter_poly, half_iou = self.calchalf_iou(gtpoly, imgpoly)
 
-                # print('writing...')
-                if (half_iou == 1):
-                    polyInsub = self.polyorig2sub(left, up, obj['poly'])
-                    outline = ' '.join(list(map(str, polyInsub)))
+            # print('writing...')
+            if (half_iou == 1):
+                polyInsub = self.polyorig2sub(left, up, obj['poly'])
+                outline = ' '.join(list(map(str, polyInsub)))
+                outline = outline + ' ' + \
+                    obj['name'] + ' ' + str(obj['difficult'])
+                outlines.append(outline)
+            elif (half_iou > 0):
+                # elif (half_iou > self.thresh):
+              # print('<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<')
+                inter_poly = shgeo.polygon.orient(inter_poly, sign=1)
+                out_poly = list(inter_poly.exterior.coords)[0: -1]
+                if len(out_poly) < 4:
+                    continue
+
+                out_poly2 = []
+                for i in range(len(out_poly)):
+                    out_poly2.append(out_poly[i][0])
+                    out_poly2.append(out_poly[i][1])
+
+                if (len(out_poly) == 5):
+                    # print('==========================')
+                    out_poly2 = self.GetPoly4FromPoly5(out_poly2)
+                elif (len(out_poly) > 5):
+                    """
+                        if the cut instance is a polygon with points more than 5, we do not handle it currently
+                    """
+                    continue
+                if (self.choosebestpoint):
+                    out_poly2 = choose_best_pointorder_fit_another(
+                        out_poly2, obj['poly'])
+
+                polyInsub = self.polyorig2sub(left, up, out_poly2)
+
+                for index, item in enumerate(polyInsub):
+                    if (item <= 1):
+                        polyInsub[index] = 1
+                    elif (item >= self.subsize):
+                        polyInsub[index] = self.subsize
+                outline = ' '.join(list(map(str, polyInsub)))
+                if (half_iou > self.thresh):
                     outline = outline + ' ' + \
                         obj['name'] + ' ' + str(obj['difficult'])
-                    f_out.write(outline + '\n')
-                elif (half_iou > 0):
-                    # elif (half_iou > self.thresh):
-                  # print('<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<')
-                    inter_poly = shgeo.polygon.orient(inter_poly, sign=1)
-                    out_poly = list(inter_poly.exterior.coords)[0: -1]
-                    if len(out_poly) < 4:
-                        continue
-
-                    out_poly2 = []
-                    for i in range(len(out_poly)):
-                        out_poly2.append(out_poly[i][0])
-                        out_poly2.append(out_poly[i][1])
-
-                    if (len(out_poly) == 5):
-                        # print('==========================')
-                        out_poly2 = self.GetPoly4FromPoly5(out_poly2)
-                    elif (len(out_poly) > 5):
-                        """
-                            if the cut instance is a polygon with points more than 5, we do not handle it currently
-                        """
-                        continue
-                    if (self.choosebestpoint):
-                        out_poly2 = choose_best_pointorder_fit_another(
-                            out_poly2, obj['poly'])
-
-                    polyInsub = self.polyorig2sub(left, up, out_poly2)
-
-                    for index, item in enumerate(polyInsub):
-                        if (item <= 1):
-                            polyInsub[index] = 1
-                        elif (item >= self.subsize):
-                            polyInsub[index] = self.subsize
-                    outline = ' '.join(list(map(str, polyInsub)))
-                    if (half_iou > self.thresh):
-                        outline = outline + ' ' + \
-                            obj['name'] + ' ' + str(obj['difficult'])
-                    else:
-                        # if the left part is too small, label as '2'
-                        outline = outline + ' ' + obj['name'] + ' ' + '2'
-                    f_out.write(outline + '\n')
-                # else:
-                 #   mask_poly.append(inter_poly)
+                else:
+                    # if the left part is too small, label as '2'
+                    outline = outline + ' ' + obj['name'] + ' ' + '2'
+                outlines.append(outline)
+            # else:
+             #   mask_poly.append(inter_poly)
+        if self.out_format == 'shards':
+            patch, shape = self.saveimagepatches(resizeimg, subimgname, left, up)
+            return patch, shape, outlines
+        outdir = os.path.join(self.outlabelpath, subimgname + '.txt')
+        with codecs.open(outdir, 'w', self.code) as f_out:
+            for outline in outlines:
+                f_out.write(outline + '\n')
         self.saveimagepatches(resizeimg, subimgname, left, up)
 
+    def get_shard(self, rate):
+        """
+            shard of this process to append, a new one is started when it is larger than shard_size
+        """
+        k = 0
+        while True:
+            shard = '{}-{}-{:05d}.bin'.format(rate, os.getpid(), k)
+            shardpath = os.path.join(self.outshardpath, shard)
+            if not os.path.exists(shardpath) or os.path.getsize(shardpath) < self.shard_size:
+                return shard
+            k += 1
+
     def SplitSingle(self, name, rate, extent):
         """
             split a single image and ground truth
@@ -248,6 +328,17 @@ class splitbase():
         outbasename = name + '__' + str(rate) + '__'
         weight = np.shape(resizeimg)[1]
         height = np.shape(resizeimg)[0]
+        for obj in objects:
+            poly = np.array(obj['poly'], dtype=np.float64)
+            obj['area'] = 0.5 * abs(np.dot(poly[0::2], np.roll(poly[1::2], 1)) - np.dot(poly[1::2], np.roll(poly[0::2], 1)))
+        hbbs = [[min(obj['poly'][0::2]), min(obj['poly'][1::2]), max(obj['poly'][0::2]), max(obj['poly'][1::2])]
+                for obj in objects]
+        index = GridIndex(hbbs, self.slide)
+
+        shard_file, records = None, []
+        if self.out_format == 'shards':
+            shard = self.get_shard(rate)
+            shard_file = open(os.path.join(self.outshardpath, shard), 'ab')
 
         left, up = 0, 0
         while (left < weight):
@@ -261,8 +352,14 @@ class splitbase():
                 down = min(up + self.subsize, height - 1)
                 subimgname = outbasename + str(left) + '___' + str(up)
                 # self.f_sub.write(name + ' ' + subimgname + ' ' + str(left) + ' ' + str(up) + '\n')
-                self.savepatches(resizeimg, objects,
-                                 subimgname, left, up, right, down)
+                result = self.savepatches(resizeimg, objects,
+                                          subimgname, left, up, right, down, index)
+                if shard_file is not None:
+                    patch, shape, outlines = result
+                    records.append({'name': subimgname, 'shard': shard, 'offset': shard_file.tell(),
+                                    'length': len(patch), 'width': shape[1], 'height': shape[0],
+                                    'labels': outlines})
+                    shard_file.write(patch.tobytes())
                 if (up + self.subsize >= height):
                     break
                 else:
@@ -271,6 +368,9 @@ class splitbase():
                 break
             else:
                 left = left + self.slide
+        if shard_file is not None:
+            shard_file.close()
+        return records
 
     def splitdata(self, rate):
         """
@@ -280,14 +380,32 @@ class splitbase():
         imagenames = [util.custombasename(x) for x in imagelist if (
             util.custombasename(x) != 'Thumbs')]
         if self.num_process == 1:
-            for name in imagenames:
-                self.SplitSingle(name, rate, self.ext)
+            results = [self.SplitSingle(name, rate, self.ext) for name in imagenames]
         else:
 
             # worker = partial(self.SplitSingle, rate=rate, extent=self.ext)
             worker = partial(split_single_warp, split_base=self,
                              rate=rate, extent=self.ext)
-            self.pool.map(worker, imagenames)
+            results = self.pool.map(worker, imagenames)
+        if self.out_format == 'shards':
+            self.save_index([r for records in results if records for r in records])
+
+    def save_index(self, records):
+        """
+            add the patch records to outpath/shards/index.json, the patches of the same name are replaced
+        """
+        indexpath = os.path.join(self.outshardpath, 'index.json')
+        patches = {}
+        if os.path.exists(indexpath):
+            with open(indexpath, 'r') as f:
+                patches = {r['name']: r for r in json.load(f)['patches']}
+        for r in records:
+            patches[r['name']] = r
+        tmppath = indexpath + '.tmp'
+        with open(tmppath, 'w') as f:
+            json.dump({'version': 1, 'ext': self.ext, 'patches': [patches[k] for k in sorted(patches)]}, f)
+        os.replace(tmppath, indexpath)
+        print('{} patches indexed in {}'.format(len(patches), indexpath))
 
     def __getstate__(self):
         self_dict = self.__dict__.copy()
@@ -61,66 +61,84 @@ def py_cpu_nms_poly(dets, thresh):
     return keep
 
 
+def build_grid(x1, y1, x2, y2, cell_size):
+    """
+    uniform grid over the hbbs, each box is bucketed in all the cells it covers
+    :return: sorted cell keys, starts and ends of their boxes in inds, inds (box index sorted by cell), grid origin
+    """
+    origin = np.array([x1.min(), y1.min()])
+    cx0 = ((x1 - origin[0]) // cell_size).astype(np.int64)
+    cy0 = ((y1 - origin[1]) // cell_size).astype(np.int64)
+    nx = ((x2 - origin[0]) // cell_size).astype(np.int64) - cx0 + 1
+    ny = ((y2 - origin[1]) // cell_size).astype(np.int64) - cy0 + 1
+    num_cells = nx * ny
+    inds = np.repeat(np.arange(len(x1)), num_cells)
+    # NOTE position of each entry inside the cells of its box
+    local = np.arange(len(inds)) - np.repeat(np.cumsum(num_cells) - num_cells, num_cells)
+    cx = cx0[inds] + local // ny[inds]
+    cy = cy0[inds] + local % ny[inds]
+    keys = cx * (1 << 31) + cy
+    order = np.argsort(keys, kind="stable")
+    keys, inds = keys[order], inds[order]
+    cell_keys, starts = np.unique(keys, return_index=True)
+    ends = np.append(starts[1:], len(keys))
+    return cell_keys, starts, ends, inds, origin
+
+
 def py_cpu_nms_poly_fast(dets, thresh):
+    """
+    greedy polygon nms, same result as the hbb prefiltered nms that compares every kept box with all the remaining
+    boxes, but the candidates of a kept box come from a uniform grid over the hbbs and only the polygons with
+    overlapping hbbs are built and compared with polyiou
+    """
+    if len(dets) == 0:
+        return []
     obbs = dets[:, 0:-1]
     x1 = np.min(obbs[:, 0::2], axis=1)
     y1 = np.min(obbs[:, 1::2], axis=1)
     x2 = np.max(obbs[:, 0::2], axis=1)
     y2 = np.max(obbs[:, 1::2], axis=1)
     scores = dets[:, 8]
-    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-
-    polys = []
-    for i in range(len(dets)):
-        tm_polygon = polyiou.VectorDouble(
-            [dets[i][0], dets[i][1], dets[i][2], dets[i][3], dets[i][4], dets[i][5], dets[i][6], dets[i][7]]
-        )
-        polys.append(tm_polygon)
     order = scores.argsort()[::-1]
+    rank = np.empty(len(dets), dtype=np.int64)
+    rank[order] = np.arange(len(dets))
+
+    # NOTE cell size 取较大的 box 尺寸, 大部分 box 只落在 1~4 个 cell 里
+    cell_size = max(float(np.percentile(np.maximum(x2 - x1, y2 - y1), 90)), 1.0)
+    cell_keys, starts, ends, cell_inds, origin = build_grid(x1, y1, x2, y2, cell_size)
+
+    polys = {}
 
+    def get_poly(i):
+        if i not in polys:
+            polys[i] = polyiou.VectorDouble(obbs[i].tolist())
+        return polys[i]
+
+    suppressed = np.zeros(len(dets), dtype=bool)
     keep = []
-    while order.size > 0:
-        ovr = []
-        i = order[0]
+    for i in order:
+        if suppressed[i]:
+            continue
         keep.append(i)
-        # if order.size == 0:
-        #     break
-        xx1 = np.maximum(x1[i], x1[order[1:]])
-        yy1 = np.maximum(y1[i], y1[order[1:]])
-        xx2 = np.minimum(x2[i], x2[order[1:]])
-        yy2 = np.minimum(y2[i], y2[order[1:]])
-        # w = np.maximum(0.0, xx2 - xx1 + 1)
-        # h = np.maximum(0.0, yy2 - yy1 + 1)
-        w = np.maximum(0.0, xx2 - xx1)
-        h = np.maximum(0.0, yy2 - yy1)
-        hbb_inter = w * h
-        hbb_ovr = hbb_inter / (areas[i] + areas[order[1:]] - hbb_inter)
-        # h_keep_inds = np.where(hbb_ovr == 0)[0]
-        h_inds = np.where(hbb_ovr > 0)[0]
-        tmp_order = order[h_inds + 1]
-        for j in range(tmp_order.size):
-            iou = polyiou.iou_poly(polys[i], polys[tmp_order[j]])
-            hbb_ovr[h_inds[j]] = iou
-            # ovr.append(iou)
-            # ovr_index.append(tmp_order[j])
-
-        # ovr = np.array(ovr)
-        # ovr_index = np.array(ovr_index)
-        # print('ovr: ', ovr)
-        # print('thresh: ', thresh)
-        try:
-            if math.isnan(ovr[0]):
-                pdb.set_trace()
-        except:
-            pass
-        inds = np.where(hbb_ovr <= thresh)[0]
-
-        # order_obb = ovr_index[inds]
-        # print('inds: ', inds)
-        # order_hbb = order[h_keep_inds + 1]
-        order = order[inds + 1]
-        # pdb.set_trace()
-        # order = np.concatenate((order_obb, order_hbb), axis=0).astype(np.int)
+        cx = np.arange((x1[i] - origin[0]) // cell_size, (x2[i] - origin[0]) // cell_size + 1, dtype=np.int64)
+        cy = np.arange((y1[i] - origin[1]) // cell_size, (y2[i] - origin[1]) // cell_size + 1, dtype=np.int64)
+        keys = (cx[:, None] * (1 << 31) + cy[None, :]).ravel()
+        pos = np.searchsorted(cell_keys, keys).clip(max=len(cell_keys) - 1)
+        pos = pos[cell_keys[pos] == keys]
+        if len(pos) == 0:
+            continue
+        cand = np.unique(np.concatenate([cell_inds[starts[k] : ends[k]] for k in pos]))
+        cand = cand[(rank[cand] > rank[i]) & ~suppressed[cand]]
+        # hbb prefilter, the same as the hbb iou > 0 of the full comparison
+        w = np.minimum(x2[i], x2[cand]) - np.maximum(x1[i], x1[cand])
+        h = np.minimum(y2[i], y2[cand]) - np.maximum(y1[i], y1[cand])
+        cand = cand[(w > 0) & (h > 0)]
+        if len(cand) == 0:
+            continue
+        poly_i = get_poly(i)
+        ovr = np.array([polyiou.iou_poly(poly_i, get_poly(j)) for j in cand.tolist()])
+        # NOTE nan iou 也会被抑制, 和原来的 np.where(ovr <= thresh) 一致
+        suppressed[cand[~(ovr <= thresh)]] = True
     return keep
 
 
@@ -186,74 +204,108 @@ def poly2origpoly(poly, x, y, rate):
     return origpoly
 
 
-def mergesingle(dstpath, nms, fullname):
+# NOTE patch name: <oriname>__<rate>__<x>___<y>
+pattern_xy = re.compile(r"__\d+___\d+")
+pattern_rate = re.compile(r"__([\d+\.]+)__\d+___")
+
+
+def parse_subname(subname, use_rate=True):
+    """
+    :return: oriname, x, y, rate of a patch name
+    """
+    x_y = re.findall(r"\d+", pattern_xy.findall(subname)[0])
+    rate = pattern_rate.findall(subname)[0] if use_rate else 1
+    return subname.split("__")[0], int(x_y[0]), int(x_y[1]), float(rate)
+
+
+def parse_dets(fullname, use_rate=True):
+    """
+    parse one class result file in bulk, the detections are mapped to the original images
+    :return: orinames (images in the order of their first detection), dets [N, 9] (poly, score) of each image in the
+        order of the file
+    """
+    with open(fullname, "r") as f_in:
+        tokens = f_in.read().split()
+    if not tokens:
+        return [], []
+    tokens = np.array(tokens, dtype=object).reshape(-1, 10)
+    subnames, sub_ids = np.unique(tokens[:, 0].astype(str), return_inverse=True)
+    values = tokens[:, 1:].astype(np.float64)
+
+    subinfos = [parse_subname(subname, use_rate) for subname in subnames]
+    orinames, ori_ids = np.unique([info[0] for info in subinfos], return_inverse=True)
+    offsets = np.array([info[1:3] for info in subinfos], dtype=np.float64)[sub_ids]
+    rates = np.array([info[3] for info in subinfos], dtype=np.float64)[sub_ids, None]
+
+    dets = np.empty((len(values), 9), dtype=np.float64)
+    dets[:, 0:8:2] = (values[:, 1::2] + offsets[:, 0:1]) / rates
+    dets[:, 1:8:2] = (values[:, 2::2] + offsets[:, 1:2]) / rates
+    dets[:, 8] = values[:, 0]
+
+    # group by image, images in the order of their first detection, detections in the order of the file
+    det_ori_ids = ori_ids[sub_ids]
+    order = np.argsort(det_ori_ids, kind="stable")
+    counts = np.bincount(det_ori_ids, minlength=len(orinames))
+    groups = np.split(dets[order], np.cumsum(counts)[:-1])
+    _, first = np.unique(det_ori_ids, return_index=True)
+    image_order = np.argsort(first, kind="stable")
+    return [orinames[i] for i in image_order], [groups[i] for i in image_order]
+
+
+def nms_single(args):
+    nms, dets, thresh = args
+    return dets[nms(dets, thresh)]
+
+
+def write_dets(dstname, orinames, dets):
+    lines = []
+    for imgname, dets_per_img in zip(orinames, dets):
+        for det in dets_per_img.tolist():
+            confidence = round(det[-1], 2)
+            bbox = [round(x, 1) for x in det[0:-1]]
+            lines.append(imgname + " " + str(confidence) + " " + " ".join(map(str, bbox)) + "\n")
+    with open(dstname, "w") as f_out:
+        f_out.write("".join(lines))
+
+
+def mergesingle(dstpath, nms, fullname, thresh=None, use_rate=True):
     name = util.custombasename(fullname)
     # print('name:', name)
     dstname = os.path.join(dstpath, name + ".txt")
     print(dstname)
-    with open(fullname, "r") as f_in:
-        nameboxdict = {}
-        lines = f_in.readlines()
-        splitlines = [x.strip().split(" ") for x in lines]
-        for splitline in splitlines:
-            subname = splitline[0]
-            splitname = subname.split("__")
-            oriname = splitname[0]
-            pattern1 = re.compile(r"__\d+___\d+")
-            # print('subname:', subname)
-            x_y = re.findall(pattern1, subname)
-            x_y_2 = re.findall(r"\d+", x_y[0])
-            x, y = int(x_y_2[0]), int(x_y_2[1])
-
-            pattern2 = re.compile(r"__([\d+\.]+)__\d+___")
-
-            rate = re.findall(pattern2, subname)[0]
-
-            confidence = splitline[1]
-            poly = list(map(float, splitline[2:]))
-            origpoly = poly2origpoly(poly, x, y, rate)
-            det = origpoly
-            det.append(confidence)
-            det = list(map(float, det))
-            if oriname not in nameboxdict:
-                nameboxdict[oriname] = []
-            nameboxdict[oriname].append(det)
-        nameboxnmsdict = nmsbynamedict(nameboxdict, nms, nms_thresh)
-        with open(dstname, "w") as f_out:
-            for imgname in nameboxnmsdict:
-                for det in nameboxnmsdict[imgname]:
-                    # print('det:', det)
-                    confidence = det[-1]
-                    confidence = round(confidence, 2)
-                    bbox = det[0:-1]
-
-                    bbox[0] = round(bbox[0], 1)
-                    bbox[1] = round(bbox[1], 1)
-                    bbox[2] = round(bbox[2], 1)
-                    bbox[3] = round(bbox[3], 1)
-                    bbox[4] = round(bbox[4], 1)
-                    bbox[5] = round(bbox[5], 1)
-                    bbox[6] = round(bbox[6], 1)
-                    bbox[7] = round(bbox[7], 1)
-
-                    outline = imgname + " " + str(confidence) + " " + " ".join(map(str, bbox))
-                    # print('outline:', outline)
-                    f_out.write(outline + "\n")
-
-
-def mergebase_parallel(srcpath, dstpath, nms):
-    pool = Pool(16)
-    filelist = util.GetFileFromThisRootDir(srcpath)
-
-    mergesingle_fn = partial(mergesingle, dstpath, nms)
-    # pdb.set_trace()
-    pool.map(mergesingle_fn, filelist)
+    orinames, dets = parse_dets(fullname, use_rate)
+    thresh = nms_thresh if thresh is None else thresh
+    write_dets(dstname, orinames, [nms_single((nms, d, thresh)) for d in dets])
 
 
-def mergebase(srcpath, dstpath, nms):
+def mergebase_parallel(srcpath, dstpath, nms, thresh=None, use_rate=True, num_process=16):
+    """
+    merge all the class files at once: the files are parsed in bulk, and the nms of every (class, image) runs in
+    one process pool so that the large classes do not wait for a single process
+    """
+    thresh = nms_thresh if thresh is None else thresh
+    filelist = util.GetFileFromThisRootDir(srcpath)
+    with Pool(num_process) as pool:
+        parsed = pool.map(partial(parse_dets, use_rate=use_rate), filelist)
+        tasks = [(nms, d, thresh) for _, dets in parsed for d in dets]
+        # NOTE images with most detections first
+        order = sorted(range(len(tasks)), key=lambda i: -len(tasks[i][1]))
+        results = pool.map(nms_single, [tasks[i] for i in order], chunksize=max(1, len(tasks) // (num_process * 8)))
+    kept = [None] * len(tasks)
+    for i, result in zip(order, results):
+        kept[i] = result
+    start = 0
+    for fullname, (orinames, dets) in zip(filelist, parsed):
+        dstname = os.path.join(dstpath, util.custombasename(fullname) + ".txt")
+        print(dstname)
+        write_dets(dstname, orinames, kept[start : start + len(dets)])
+        start += len(dets)
+
+
+def mergebase(srcpath, dstpath, nms, thresh=None, use_rate=True):
     filelist = util.GetFileFromThisRootDir(srcpath)
     for filename in filelist:
-        mergesingle(dstpath, nms, filename)
+        mergesingle(dstpath, nms, filename, thresh, use_rate)
 
 
 def mergebyrec(srcpath, dstpath):
@@ -270,10 +322,12 @@ def mergebyrec(srcpath, dstpath):
     mergebase(srcpath, dstpath, py_cpu_nms)
 
 
-def mergebypoly(srcpath, dstpath):
+def mergebypoly(srcpath, dstpath, thresh=None, use_rate=True):
     """
     srcpath: result files before merge and nms
     dstpath: result files after merge and nms
+    thresh: nms threshold, nms_thresh if None
+    use_rate: map the patches back with the rate in their names, 1 if False
     """
     # srcpath = r'/home/dingjian/evaluation_task1/result/faster-rcnn-59/comp4_test_results'
     # dstpath = r'/home/dingjian/evaluation_task1/result/faster-rcnn-59/testtime'
@@ -284,7 +338,7 @@ def mergebypoly(srcpath, dstpath):
     # mergebase(srcpath,
     #           dstpath,
     #           py_cpu_nms_poly)
-    mergebase_parallel(srcpath, dstpath, py_cpu_nms_poly_fast)
+    mergebase_parallel(srcpath, dstpath, py_cpu_nms_poly_fast, thresh, use_rate)
 
 
 def parse_args():
@@ -17,6 +17,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import polyiou
 from functools import partial
+from multiprocessing import Pool
 import argparse
 
 def parse_gt(filename):
@@ -85,13 +86,94 @@ def voc_ap(rec, prec, use_07_metric=False):
     return ap
 
 
+def load_gt_store(annopath, imagenames):
+    """
+    parse the ground truth files once into one indexed array store, shared by all classes
+    :param annopath: annopath.format(imagename) should be the ground truth txt file
+    :param imagenames: list of image names
+    :return: dict with
+        'imagenames': image names, 'image_index': {imagename: image index},
+        'polys': [N, 8] float64 polygons, 'hbbs': [N, 4] horizontal boxes of the polygons,
+        'names': [N] class names, 'difficult': [N] bool, 'img_ids': [N] image index of each object
+    """
+    polys, names, difficult, img_ids = [], [], [], []
+    for i, imagename in enumerate(imagenames):
+        for obj in parse_gt(annopath.format(imagename)):
+            polys.append(obj['bbox'])
+            names.append(obj['name'])
+            difficult.append(obj['difficult'])
+            img_ids.append(i)
+    polys = np.array(polys, dtype=np.float64).reshape(-1, 8)
+    return {'imagenames': list(imagenames),
+            'image_index': {imagename: i for i, imagename in enumerate(imagenames)},
+            'polys': polys,
+            'hbbs': poly2hbb(polys),
+            'names': np.array(names, dtype=str),
+            'difficult': np.array(difficult, dtype=np.bool_),
+            'img_ids': np.array(img_ids, dtype=np.int64)}
+
+
+def poly2hbb(polys):
+    """[N, 8] polygons -> [N, 4] (xmin, ymin, xmax, ymax)"""
+    return np.stack((np.min(polys[:, 0::2], axis=1), np.min(polys[:, 1::2], axis=1),
+                     np.max(polys[:, 0::2], axis=1), np.max(polys[:, 1::2], axis=1)), axis=1)
+
+
+def poly_overlaps(dets, gts, det_hbbs, gt_hbbs, chunk=256):
+    """
+    best polygon iou of each det among the gts of one image, polyiou is only called for the pairs whose hbbs overlap.
+    the dets and gts are swept in xmin order: a chunk of dets is only tested against the gts whose xmin lies in the
+    x range of the chunk (widened by the widest gt), so no dense [D, G] matrix is built
+    :return: ovmax [D] best overlap (-inf without hbb overlap), jmax [D] index of the best gt (0 without hbb overlap)
+    """
+    ovmax = np.full(len(dets), -np.inf)
+    jmax = np.zeros(len(dets), dtype=np.int64)
+    g_order = np.argsort(gt_hbbs[:, 0], kind='stable')
+    g_xmin = gt_hbbs[g_order, 0]
+    max_w = np.max(gt_hbbs[:, 2] - gt_hbbs[:, 0])
+    d_order = np.argsort(det_hbbs[:, 0], kind='stable')
+    pair_d, pair_g = [], []
+    for start in range(0, len(dets), chunk):
+        d_inds = d_order[start:start + chunk]
+        d_hbbs = det_hbbs[d_inds]
+        # gts whose hbb may overlap the x range of the chunk
+        lo = np.searchsorted(g_xmin, d_hbbs[0, 0] - max_w - 1., side='left')
+        hi = np.searchsorted(g_xmin, np.max(d_hbbs[:, 2]) + 1., side='right')
+        if lo == hi:
+            continue
+        g_inds = g_order[lo:hi]
+        g_hbbs = gt_hbbs[g_inds]
+        # 1. if the iou between hbbs are 0, the iou between obbs are 0, too.
+        iw = np.minimum(g_hbbs[None, :, 2], d_hbbs[:, None, 2]) - np.maximum(g_hbbs[None, :, 0], d_hbbs[:, None, 0]) + 1.
+        ih = np.minimum(g_hbbs[None, :, 3], d_hbbs[:, None, 3]) - np.maximum(g_hbbs[None, :, 1], d_hbbs[:, None, 1]) + 1.
+        d, g = np.nonzero((iw > 0) & (ih > 0))
+        pair_d.append(d_inds[d])
+        pair_g.append(g_inds[g])
+    if not pair_d:
+        return ovmax, jmax
+    pair_d, pair_g = np.concatenate(pair_d), np.concatenate(pair_g)
+
+    # 2. polygon iou of the kept pairs, the polygons are built once
+    det_polys = {d: polyiou.VectorDouble(dets[d].tolist()) for d in np.unique(pair_d).tolist()}
+    gt_polys = {g: polyiou.VectorDouble(gts[g].tolist()) for g in np.unique(pair_g).tolist()}
+    ious = np.array([polyiou.iou_poly(gt_polys[g], det_polys[d]) for d, g in zip(pair_d.tolist(), pair_g.tolist())])
+
+    # best pair of each det, the first gt on ties as np.argmax
+    best = np.lexsort((pair_g, -ious, pair_d))
+    best = best[np.unique(pair_d[best], return_index=True)[1]]
+    ovmax[pair_d[best]] = ious[best]
+    jmax[pair_d[best]] = pair_g[best]
+    return ovmax, jmax
+
+
 def voc_eval(detpath,
              annopath,
              imagesetfile,
              classname,
             # cachedir,
              ovthresh=0.5,
-             use_07_metric=False):
+             use_07_metric=False,
+             gt_store=None):
     """rec, prec, ap = voc_eval(detpath,
                                 annopath,
                                 imagesetfile,
@@ -105,42 +187,27 @@ def voc_eval(detpath,
         annopath.format(imagename) should be the xml annotations file.
     imagesetfile: Text file containing the list of images, one image per line.
     classname: Category name (duh)
-    cachedir: Directory for caching the annotations
     [ovthresh]: Overlap threshold (default = 0.5)
     [use_07_metric]: Whether to use VOC07's 11 point AP computation
         (default False)
+    [gt_store]: ground truths parsed by load_gt_store, parsed from annopath if None
     """
     # assumes detections are in detpath.format(classname)
     # assumes annotations are in annopath.format(imagename)
     # assumes imagesetfile is a text file with each line an image name
-    # cachedir caches the annotations in a pickle file
-
-    # first load gt
-    #if not os.path.isdir(cachedir):
-     #   os.mkdir(cachedir)
-    #cachefile = os.path.join(cachedir, 'annots.pkl')
-    # read list of images
-    with open(imagesetfile, 'r') as f:
-        lines = f.readlines()
-    imagenames = [x.strip() for x in lines]
-    
-    recs = {}
-    for i, imagename in enumerate(imagenames):
-        #print('parse_files name: ', annopath.format(imagename))
-        recs[imagename] = parse_gt(annopath.format(imagename))
-
-    # extract gt objects for this class
-    class_recs = {}
-    npos = 0
-    for imagename in imagenames:
-        R = [obj for obj in recs[imagename] if obj['name'] == classname]
-        bbox = np.array([x['bbox'] for x in R])
-        difficult = np.array([x['difficult'] for x in R]).astype(np.bool_)
-        det = [False] * len(R)
-        npos = npos + sum(~difficult)
-        class_recs[imagename] = {'bbox': bbox,
-                                 'difficult': difficult,
-                                 'det': det}
+    if gt_store is None:
+        with open(imagesetfile, 'r') as f:
+            lines = f.readlines()
+        imagenames = [x.strip() for x in lines]
+        gt_store = load_gt_store(annopath, imagenames)
+
+    # extract gt objects for this class, grouped by image
+    gt_inds = np.nonzero(gt_store['names'] == classname)[0]
+    gt_inds = gt_inds[np.argsort(gt_store['img_ids'][gt_inds], kind='stable')]
+    gt_polys, gt_hbbs = gt_store['polys'][gt_inds], gt_store['hbbs'][gt_inds]
+    gt_difficult = gt_store['difficult'][gt_inds]
+    gt_offsets = np.searchsorted(gt_store['img_ids'][gt_inds], np.arange(len(gt_store['imagenames']) + 1))
+    npos = int(np.sum(~gt_difficult))
 
     # read dets from Task1* files
     detfile = detpath.format(classname)
@@ -148,95 +215,44 @@ def voc_eval(detpath,
         lines = f.readlines()
 
     splitlines = [x.strip().split(' ') for x in lines]
-    image_ids = [x[0] for x in splitlines]
+    image_ids = np.array([gt_store['image_index'][x[0]] for x in splitlines], dtype=np.int64)
     confidence = np.array([float(x[1]) for x in splitlines])
 
-    BB = np.array([[float(z) for z in x[2:]] for x in splitlines])
+    BB = np.array([[float(z) for z in x[2:]] for x in splitlines]).reshape(-1, 8)
 
     # sort by confidence
     sorted_ind = np.argsort(-confidence)
-    sorted_scores = np.sort(-confidence)
 
     ## note the usage only in numpy not for list
     BB = BB[sorted_ind, :]
-    image_ids = [image_ids[x] for x in sorted_ind]
-    # go down dets and mark TPs and FPs
+    image_ids = image_ids[sorted_ind]
+    bb_hbbs = poly2hbb(BB)
+
+    # best gt of each det, the overlaps are computed in one batch per image
     nd = len(image_ids)
-    tp = np.zeros(nd)
-    fp = np.zeros(nd)
-    for d in range(nd):
-        R = class_recs[image_ids[d]]
-        bb = BB[d, :].astype(float)
-        ovmax = -np.inf
-        BBGT = R['bbox'].astype(float)
-
-        ## compute det bb with each BBGT
-        if BBGT.size > 0:
-            # compute overlaps
-            # intersection
-
-            # 1. calculate the overlaps between hbbs, if the iou between hbbs are 0, the iou between obbs are 0, too.
-            # pdb.set_trace()
-            BBGT_xmin =  np.min(BBGT[:, 0::2], axis=1)
-            BBGT_ymin = np.min(BBGT[:, 1::2], axis=1)
-            BBGT_xmax = np.max(BBGT[:, 0::2], axis=1)
-            BBGT_ymax = np.max(BBGT[:, 1::2], axis=1)
-            bb_xmin = np.min(bb[0::2])
-            bb_ymin = np.min(bb[1::2])
-            bb_xmax = np.max(bb[0::2])
-            bb_ymax = np.max(bb[1::2])
-
-            ixmin = np.maximum(BBGT_xmin, bb_xmin)
-            iymin = np.maximum(BBGT_ymin, bb_ymin)
-            ixmax = np.minimum(BBGT_xmax, bb_xmax)
-            iymax = np.minimum(BBGT_ymax, bb_ymax)
-            iw = np.maximum(ixmax - ixmin + 1., 0.)
-            ih = np.maximum(iymax - iymin + 1., 0.)
-            inters = iw * ih
-
-            # union
-            uni = ((bb_xmax - bb_xmin + 1.) * (bb_ymax - bb_ymin + 1.) +
-                   (BBGT_xmax - BBGT_xmin + 1.) *
-                   (BBGT_ymax - BBGT_ymin + 1.) - inters)
-
-            overlaps = inters / uni
-
-            BBGT_keep_mask = overlaps > 0
-            BBGT_keep = BBGT[BBGT_keep_mask, :]
-            BBGT_keep_index = np.where(overlaps > 0)[0]
-
-            def calcoverlaps(BBGT_keep, bb):
-                overlaps = []
-                for index, GT in enumerate(BBGT_keep):
-
-                    overlap = polyiou.iou_poly(polyiou.VectorDouble(BBGT_keep[index]), polyiou.VectorDouble(bb))
-                    overlaps.append(overlap)
-                return overlaps
-            if len(BBGT_keep) > 0:
-                overlaps = calcoverlaps(BBGT_keep, bb)
-
-                ovmax = np.max(overlaps)
-                jmax = np.argmax(overlaps)
-                # pdb.set_trace()
-                jmax = BBGT_keep_index[jmax]
-
-        if ovmax > ovthresh:
-            if not R['difficult'][jmax]:
-                if not R['det'][jmax]:
-                    tp[d] = 1.
-                    R['det'][jmax] = 1
-                else:
-                    fp[d] = 1.
-        else:
-            fp[d] = 1.
+    ovmax = np.full(nd, -np.inf)
+    jmax = np.zeros(nd, dtype=np.int64)
+    det_order = np.argsort(image_ids, kind='stable')
+    det_offsets = np.searchsorted(image_ids[det_order], np.arange(len(gt_store['imagenames']) + 1))
+    for img_id in np.unique(image_ids):
+        d_inds = det_order[det_offsets[img_id]:det_offsets[img_id + 1]]
+        g_start, g_end = gt_offsets[img_id], gt_offsets[img_id + 1]
+        if g_end == g_start:
+            continue
+        ovmax[d_inds], jmax[d_inds] = poly_overlaps(BB[d_inds], gt_polys[g_start:g_end], bb_hbbs[d_inds], gt_hbbs[g_start:g_end])
+        jmax[d_inds] += g_start
+
+    # go down dets and mark TPs and FPs: the first (highest score) det of a gt is a TP, the later ones are FPs,
+    # dets matched to difficult gts are neither
+    matched = ovmax > ovthresh
+    tp_candidate = matched.copy()
+    tp_candidate[matched] = ~gt_difficult[jmax[matched]]
+    first = np.zeros(nd, dtype=np.bool_)
+    first[np.unique(np.where(tp_candidate, jmax, -1), return_index=True)[1]] = True
+    tp = (tp_candidate & first).astype(np.float64)
+    fp = ((tp_candidate & ~first) | ~matched).astype(np.float64)
 
     # compute precision recall
-
-    print('check fp:', fp)
-    print('check tp', tp)
-
-
-    print('npos num:', npos)
     fp = np.cumsum(fp)
     tp = np.cumsum(tp)
 
@@ -248,6 +264,46 @@ def voc_eval(detpath,
 
     return rec, prec, ap
 
+
+_gt_store = None
+
+
+def _init_worker(gt_store):
+    global _gt_store
+    _gt_store = gt_store
+
+
+def _voc_eval_worker(args):
+    detpath, annopath, imagesetfile, classname, ovthresh, use_07_metric = args
+    return voc_eval(detpath, annopath, imagesetfile, classname, ovthresh, use_07_metric, gt_store=_gt_store)
+
+
+def voc_eval_classes(detpath,
+                     annopath,
+                     imagesetfile,
+                     classnames,
+                     ovthresh=0.5,
+                     use_07_metric=False,
+                     nproc=8):
+    """
+    voc_eval of all the classes, the ground truths are parsed once and the classes are evaluated in parallel
+    :return: {classname: (rec, prec, ap)} of the classes with a detection file
+    """
+    with open(imagesetfile, 'r') as f:
+        lines = f.readlines()
+    imagenames = [x.strip() for x in lines]
+    gt_store = load_gt_store(annopath, imagenames)
+
+    classnames = [c for c in classnames if os.path.exists(detpath.format(c))]
+    tasks = [(detpath, annopath, imagesetfile, c, ovthresh, use_07_metric) for c in classnames]
+    if nproc > 1 and len(tasks) > 1:
+        with Pool(min(nproc, len(tasks)), initializer=_init_worker, initargs=(gt_store,)) as pool:
+            results = pool.map(_voc_eval_worker, tasks, chunksize=1)
+    else:
+        _init_worker(gt_store)
+        results = [_voc_eval_worker(task) for task in tasks]
+    return dict(zip(classnames, results))
+
 def GetFileFromThisRootDir(dir,ext = None):
   allfiles = []
   needExtFilter = (ext != None)
@@ -281,6 +337,7 @@ def parse_args():
     parser.add_argument('--detpath', default='work_dirs/swin_tiny_patch4_window7_dotav2/Task1_results/Task1_{:s}.txt', help='test config file path')
     parser.add_argument('--annopath', default='data/dataset_demo/labelTxt/{:s}.txt', help='checkpoint file')
     parser.add_argument('--imagesetfile', default='data/dataset_demo/imgnamefile_demo.txt', help='checkpoint file')
+    parser.add_argument('--nproc', type=int, default=8, help='number of processes evaluating the classes in parallel')
     args = parser.parse_args()
     return args
 
@@ -304,19 +361,20 @@ def main():
     classaps = []
     map = 0
     skippedClassCount = 0
+    results = voc_eval_classes(detpath,
+             annopath,
+             imagesetfile,
+             classnames,
+             ovthresh=0.5,
+             use_07_metric=True,
+             nproc=args.nproc)
     for classname in classnames:
         print('classname:', classname)
-        detfile = detpath.format(classname)
-        if not (os.path.exists(detfile)):
+        if classname not in results:
             skippedClassCount += 1
             print('This class is not be detected in your dataset: {:s}'.format(classname))
             continue
-        rec, prec, ap = voc_eval(detpath,
-             annopath,
-             imagesetfile,
-             classname,
-             ovthresh=0.5,
-             use_07_metric=True)
+        rec, prec, ap = results[classname]
         map = map + ap
         #print('rec: ', rec, 'prec: ', prec, 'ap: ', ap)
         print('ap: ', ap)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
 import argparse
+import json
 import time
 import sys
 import os
@@ -14,6 +15,7 @@ if str(ROOT) not in sys.path:
 
 from yolov6.models.yolo_R import *
 from yolov6.models.effidehead_R import Detect
+from yolov6.models.end2end_R import End2EndOBB
 from yolov6.layers.common import *
 # from loguru import logger as LOGGER
 from yolov6.utils.events import LOGGER
@@ -21,7 +23,7 @@ from yolov6.utils.checkpoint import load_checkpoint
 from io import BytesIO
 
 
-#NOTE 由于旋转框NMS原生的TensorRT并没有plugin 作为映射
+#NOTE 由于旋转框NMS原生的TensorRT并没有plugin 作为映射, --end2end 用标准 ONNX 算子在图内实现旋转框 NMS (End2EndOBB)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -32,6 +34,14 @@ if __name__ == '__main__':
     parser.add_argument('--inplace', action='store_true', help='set Detect() inplace=True')
     parser.add_argument('--simplify', action='store_true', help='simplify onnx model')
     parser.add_argument('--dynamic-batch', action='store_true', help='export dynamic batch onnx model')
+    parser.add_argument('--end2end', action='store_true', help='export end2end onnx with the rotated NMS in the graph')
+    parser.add_argument('--with-preprocess', action='store_true', help='export bgr2rgb and normalize')
+    parser.add_argument('--topk-all', type=int, default=100, help='topk objects for every images')
+    parser.add_argument('--pre-topk', type=int, default=1000, help='candidates of every images put into the NMS')
+    parser.add_argument('--nms-iters', type=int, default=20, help='Cluster-NMS iterations of the end2end NMS')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='iou threshold for NMS')
+    parser.add_argument('--conf-thres', type=float, default=0.25, help='conf threshold for NMS')
+    parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
     parser.add_argument('--device', default='0', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     args = parser.parse_args()
     args.img_size *= 2 if len(args.img_size) == 1 else 1  # expand
@@ -70,8 +80,19 @@ if __name__ == '__main__':
         output_axes = {
                 'outputs': {0: 'batch'},
             }
+        if args.end2end:
+            output_axes = {
+                'num_dets': {0: 'batch'},
+                'det_boxes': {0: 'batch'},
+                'det_scores': {0: 'batch'},
+                'det_classes': {0: 'batch'},
+            }
         dynamic_axes.update(output_axes)
 
+    if args.end2end:
+        model = End2EndOBB(model, max_obj=args.topk_all, iou_thres=args.iou_thres, score_thres=args.conf_thres,
+                           pre_topk=args.pre_topk, nms_iters=args.nms_iters, agnostic=args.agnostic_nms,
+                           device=device, with_preprocess=args.with_preprocess)
 
 
 
@@ -85,12 +106,15 @@ if __name__ == '__main__':
     try:
         LOGGER.info('\nStarting to export ONNX...')
         export_file = args.weights.replace('.pt', '.onnx')  # filename
+        if args.end2end:
+            export_file = export_file.replace('.onnx', '-end2end.onnx')
         with BytesIO() as f:
             torch.onnx.export(model, img, f, verbose=False, opset_version=13,
                               training=torch.onnx.TrainingMode.EVAL,
                               do_constant_folding=True,
                               input_names=['images'],
-                              output_names=['outputs'],
+                              output_names=['num_dets', 'det_boxes', 'det_scores', 'det_classes']
+                              if args.end2end else ['outputs'],
                               dynamic_axes=dynamic_axes)
             f.seek(0)
             # Checks
@@ -105,6 +129,17 @@ if __name__ == '__main__':
                 assert check, 'assert check failed'
             except Exception as e:
                 LOGGER.info(f'Simplifier failure: {e}')
+        # NOTE metadata read by yolov6/utils/backends_R.py
+        detector = model.model if args.end2end else model
+        meta = {'stride': int(detector.stride.max())}
+        if getattr(detector, 'names', None) is not None:
+            meta['names'] = json.dumps(list(detector.names))
+        if args.end2end:
+            meta['end2end'] = json.dumps({'conf_thres': args.conf_thres, 'iou_thres': args.iou_thres,
+                                          'max_det': args.topk_all, 'agnostic': args.agnostic_nms})
+        for k, v in meta.items():
+            prop = onnx_model.metadata_props.add()
+            prop.key, prop.value = k, str(v)
         onnx.save(onnx_model, export_file)
         LOGGER.info(f'ONNX export success, saved as {export_file}')
     except Exception as e:
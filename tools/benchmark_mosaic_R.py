@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import argparse
+import os
+import random
+import sys
+import time
+
+import cv2
+import numpy as np
+
+ROOT = os.getcwd()
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))
+
+from yolov6.data.data_augment_R import filter_box_candidates, mosaic_augmentation_obb
+from yolov6.utils.events_R import LOGGER
+
+
+def get_args_parser(add_help=True):
+    parser = argparse.ArgumentParser(description="YOLOv6 OBB mosaic benchmark.", add_help=add_help)
+    parser.add_argument("--img-size", type=int, default=1024, help="train image size (pixels).")
+    parser.add_argument("--num-objects", type=int, default=100, help="number of objects per source image.")
+    parser.add_argument("--min-ratio", type=float, default=0.5, help="minimal short / long side of the sources.")
+    parser.add_argument("--samples", type=int, default=200, help="number of timed mosaic samples.")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the fake images and labels.")
+    args = parser.parse_args()
+    LOGGER.info(args)
+    return args
+
+
+def make_sources(img_size, num_objects, min_ratio, num=16):
+    """Fake sources as TrainValDataset.load_image returns them, the long side is img_size."""
+    imgs, hs, ws, labels = [], [], [], []
+    for _ in range(num):
+        short = int(img_size * random.uniform(min_ratio, 1.0))
+        h, w = (img_size, short) if random.random() < 0.5 else (short, img_size)
+        imgs.append(np.random.randint(0, 256, (h, w, 3), dtype=np.uint8))
+        hs.append(h)
+        ws.append(w)
+        # [class_id, x, y, w, h, angle] normalized
+        box = np.random.rand(num_objects, 6) * [15, 1, 1, 0.05, 0.02, 180] + [0, 0, 0, 0.005, 0.005, 0]
+        labels.append(box.astype(np.float32))
+    return imgs, hs, ws, labels
+
+
+def mosaic_canvas_resize(img_size, imgs, hs, ws, labels, hyp):
+    """The previous mosaic_augmentation_obb: a 114 filled canvas, four crops, then a resize to img_size."""
+    labels4 = []
+    s = img_size // 2
+    yc, xc = (int(random.uniform(s // 2, 3 * s // 2)) for _ in range(2))
+    for i in range(len(imgs)):
+        img, h, w = imgs[i], hs[i], ws[i]
+        if i == 0:
+            img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)
+            x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc
+            x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h
+        elif i == 1:
+            x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, s * 2), yc
+            x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
+        elif i == 2:
+            x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(s * 2, yc + h)
+            x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
+        elif i == 3:
+            x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
+            x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
+        img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]
+        padw, padh = x1a - x1b, y1a - y1b
+        labels_per_img = labels[i].copy()
+        if labels_per_img.size:
+            boxes = np.copy(labels_per_img[:, 1:])
+            boxes[:, 0] = w * boxes[:, 0] + padw
+            boxes[:, 1] = h * boxes[:, 1] + padh
+            boxes[:, 2] = w * boxes[:, 2]
+            boxes[:, 3] = h * boxes[:, 3]
+            valid_inds = filter_box_candidates(boxes, x1a, x2a, y1a, y2a, min_bbox_size=2)
+            labels_per_img[:, 1:] = boxes
+            labels_per_img = labels_per_img[valid_inds]
+        labels4.append(labels_per_img)
+    labels4 = np.concatenate(labels4, 0)
+    img4 = cv2.resize(img4, (img_size, img_size))
+    return img4, labels4
+
+
+def run(img_size=1024, num_objects=100, min_ratio=0.5, samples=200, seed=0):
+    """Benchmark mosaic_augmentation_obb against the previous compose then resize implementation.
+    Both draw the same mosaic center of every sample, the outputs are identical for even img_size.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    imgs, hs, ws, labels = make_sources(img_size, num_objects, min_ratio)
+    mosaic_funcs = {"resize": mosaic_canvas_resize, "direct": mosaic_augmentation_obb}
+    costs = {name: 0.0 for name in mosaic_funcs}
+    num_labels = {name: 0 for name in mosaic_funcs}
+    same = True
+    for _ in range(samples):
+        indices = random.choices(range(len(imgs)), k=4)
+        args = [[x[i] for i in indices] for x in (imgs, hs, ws, labels)]
+        state = random.getstate()
+        outputs = {}
+        for name, mosaic_func in mosaic_funcs.items():
+            random.setstate(state)
+            tik = time.perf_counter()
+            outputs[name] = mosaic_func(img_size, *args, {})
+            costs[name] += time.perf_counter() - tik
+            num_labels[name] += len(outputs[name][1])
+        (img, lab), (ref_img, ref_lab) = outputs["direct"], outputs["resize"]
+        same = same and img.shape == ref_img.shape and (img == ref_img).all() and np.array_equal(lab, ref_lab)
+
+    LOGGER.info(("%-12s" + "%14s" * 2) % ("mosaic", "time(ms)", "labels"))
+    for name in mosaic_funcs:
+        LOGGER.info(("%-12s" + "%14.3f" + "%14i") % (name, costs[name] / samples * 1000, num_labels[name]))
+    LOGGER.info(f"same output: {same}")
+
+
+def main(args):
+    run(**vars(args))
+
+
+if __name__ == "__main__":
+    args = get_args_parser()
+    main(args)
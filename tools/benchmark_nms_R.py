@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+ROOT = os.getcwd()
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))
+
+from yolov6.utils.events_R import LOGGER
+from yolov6.utils.nms_R import (nms_rotated, non_max_suppression_obb,
+                                non_max_suppression_obb_cuda,
+                                non_max_suppression_obb_cv2)
+
+
+def get_args_parser(add_help=True):
+    parser = argparse.ArgumentParser(description="YOLOv6 rotated NMS benchmark.", add_help=add_help)
+    parser.add_argument("--batch-size", type=int, default=2, help="number of images of one prediction batch.")
+    parser.add_argument("--img-size", type=int, default=1024, help="image size (pixels).")
+    parser.add_argument("--num-classes", type=int, default=15, help="number of classes, 15 for DOTA.")
+    parser.add_argument("--num-objects", type=int, default=300, help="number of objects per image.")
+    parser.add_argument("--conf-thres", type=float, default=0.03, help="confidence threshold.")
+    parser.add_argument("--iou-thres", type=float, default=0.65, help="NMS IoU threshold.")
+    parser.add_argument("--max-det", type=int, default=2000, help="maximal detections per image.")
+    parser.add_argument("--multi-label", action="store_true", help="one box can have multi labels.")
+    parser.add_argument("--times", type=int, default=5, help="number of timed runs.")
+    parser.add_argument("--ref-times", type=int, default=1, help="number of timed runs of the per image cv2/mmcv references.")
+    parser.add_argument("--device", default="cpu", help="device to run the benchmark i.e. 0 or cpu.")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the fake predictions.")
+    args = parser.parse_args()
+    LOGGER.info(args)
+    return args
+
+
+def make_predictions(batch_size, img_size, num_classes, num_objects, device, strides=(8, 16, 32)):
+    """Fake head outputs [BS, N, 6 + nc] as effidehead_R.Detect, anchors cluster around the objects."""
+    num_anchors = sum((img_size // s) ** 2 for s in strides)
+    pred = torch.zeros(batch_size, num_anchors, 6 + num_classes, device=device)
+    pred[..., :2] = torch.rand(batch_size, num_anchors, 2, device=device) * img_size
+    pred[..., 2:4] = torch.rand(batch_size, num_anchors, 2, device=device) * 48 + 4
+    pred[..., 4] = torch.rand(batch_size, num_anchors, device=device) * 180
+    pred[..., 5] = 1.0
+    pred[..., 6:] = torch.rand(batch_size, num_anchors, num_classes, device=device) * 0.04
+
+    # every object is predicted by 16 anchors jittered in position and angle, with the same size none contains another
+    objects = torch.rand(batch_size, num_objects, 1, 5, device=device) * torch.tensor(
+        [img_size, img_size, 60, 20, 180], device=device
+    ) + torch.tensor([0, 0, 8, 4, 0], device=device)
+    jitter = torch.randn(batch_size, num_objects, 16, 5, device=device) * torch.tensor(
+        [2.0, 2.0, 0.0, 0.0, 4.0], device=device
+    )
+    boxes = (objects + jitter).reshape(batch_size, -1, 5)
+    boxes[..., 2:4].clamp_(min=1.0)
+    idx = torch.randperm(num_anchors, device=device)[: boxes.shape[1]]
+    pred[:, idx, :5] = boxes
+    cls = torch.randint(num_classes, (batch_size, num_objects, 1), device=device).expand(-1, -1, 16)
+    scores = torch.rand(batch_size, num_objects, 16, device=device) * 0.9 + 0.1
+    pred[:, idx, 6:] = 0.0
+    pred[:, idx, 6:] = pred[:, idx, 6:].scatter(-1, cls.reshape(batch_size, -1, 1), scores.reshape(batch_size, -1, 1))
+    return pred
+
+
+def time_nms(nms_func, pred, times, warmup=True, **kwargs):
+    if warmup:
+        nms_func(pred.clone(), **kwargs)
+    if pred.device.type != "cpu":
+        torch.cuda.synchronize()
+    tik = time.time()
+    for _ in range(times):
+        outputs = nms_func(pred.clone(), **kwargs)
+    if pred.device.type != "cpu":
+        torch.cuda.synchronize()
+    return outputs, (time.time() - tik) / times
+
+
+def num_truncated(outputs, ref_outputs):
+    """Number of images without detections whose reference has some, e.g. skipped after the time limit."""
+    return sum(len(out) == 0 and len(ref) > 0 for out, ref in zip(outputs, ref_outputs))
+
+
+def num_diff(outputs, ref_outputs, atol=1e-3):
+    """Number of detections kept by only one of the two outputs, float outputs may differ in the last digits."""
+    diff = 0
+    for out, ref in zip(outputs, ref_outputs):
+        out, ref = out.float(), ref.float().to(out.device)
+        if not len(out) or not len(ref):
+            diff += len(out) + len(ref)
+            continue
+        matched = int((torch.cdist(out, ref, p=float("inf")).min(1)[0] <= atol).sum())
+        diff += len(out) + len(ref) - 2 * matched
+    return diff
+
+
+@torch.no_grad()
+def run(
+    batch_size=8,
+    img_size=1024,
+    num_classes=15,
+    num_objects=300,
+    conf_thres=0.03,
+    iou_thres=0.65,
+    max_det=2000,
+    multi_label=False,
+    times=5,
+    ref_times=1,
+    device="cpu",
+    seed=0,
+):
+    """Benchmark the batched pure torch rotated NMS against the per image cv2 and mmcv implementations.
+    NOTE cv2.dnn.NMSBoxesRotated takes iou = 1 when one box is fully inside the other (e.g. a small noise box), and
+    an iou at the threshold may round to either side, so a few detections of cv2 differ from the other two.
+    The references run without time limit, so their outputs are never truncated, and the slow cv2 one without warmup.
+    """
+    torch.manual_seed(seed)
+    device = torch.device(f"cuda:{device}" if device != "cpu" and torch.cuda.is_available() else "cpu")
+    pred = make_predictions(batch_size, img_size, num_classes, num_objects, device)
+    kwargs = dict(conf_thres=conf_thres, iou_thres=iou_thres, multi_label=multi_label, max_det=max_det)
+
+    results = {}
+    results["batched"] = time_nms(non_max_suppression_obb, pred, times, **kwargs)
+    ref_kwargs = dict(kwargs, time_limit=None)
+    results["cv2"] = time_nms(non_max_suppression_obb_cv2, pred, ref_times, warmup=False, **ref_kwargs)
+    if nms_rotated is not None:
+        results["mmcv"] = time_nms(non_max_suppression_obb_cuda, pred, ref_times, **ref_kwargs)
+    else:
+        LOGGER.warning("mmcv is not installed, skip the mmcv nms_rotated benchmark.")
+
+    ref_outputs = results["batched"][0]
+    LOGGER.info(("%-12s" + "%14s" * 3) % ("NMS", "time(ms)", "detections", "diff"))
+    for name, (outputs, cost) in results.items():
+        num_dets = sum(len(x) for x in outputs)
+        LOGGER.info(("%-12s" + "%14.2f" + "%14i" + "%14i") % (name, cost * 1000, num_dets, num_diff(outputs, ref_outputs)))
+        truncated = num_truncated(outputs, ref_outputs)
+        if truncated:
+            LOGGER.warning(f"WARNING: {name} has no detections on {truncated} image(s) with batched detections, truncated.")
+
+
+def main(args):
+    run(**vars(args))
+
+
+if __name__ == "__main__":
+    args = get_args_parser()
+    main(args)
@@ -26,11 +26,12 @@ def boolean_string(s):
 def get_args_parser(add_help=True):
     parser = argparse.ArgumentParser(description="YOLOv6 PyTorch Evalating", add_help=add_help)
     parser.add_argument("--data", type=str, default="./data/coco.yaml", help="dataset.yaml path")
-    parser.add_argument("--weights", type=str, default="./weights/yolov6s.pt", help="model.pt path(s)")
+    parser.add_argument("--weights", type=str, default="./weights/yolov6s.pt", help="model path, .pt/.torchscript/.onnx/.xml selects the backend.")
     parser.add_argument("--batch-size", type=int, default=32, help="batch size")
     parser.add_argument("--img-size", type=int, default=640, help="inference size (pixels)")
     parser.add_argument("--conf-thres", type=float, default=0.03, help="confidence threshold")
     parser.add_argument("--iou-thres", type=float, default=0.65, help="NMS IoU threshold")
+    parser.add_argument("--max-candidates", type=int, default=30000, help="max candidates per image put into NMS")
     parser.add_argument("--task", default="val", help="val, test, or speed")
     parser.add_argument("--device", default="0", help="cuda device, i.e. 0 or 0,1,2,3 or cpu")
     parser.add_argument("--half", default=False, action="store_true", help="whether to use fp16 infer")
@@ -172,6 +173,7 @@ def run(
     angle_max=180,
     angle_fitting_methods="regression",
     ap_method="VOC12",
+    max_candidates=30000,
 ):
     """ Run the evaluation process
 
@@ -219,6 +221,7 @@ def run(
         angle_max,
         angle_fitting_methods,
         ap_method,
+        max_candidates,
     )
 
     model = val.init_model(model, weights, task)
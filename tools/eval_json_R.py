@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import argparse
+import os
+import sys
+
+ROOT = os.getcwd()
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))
+
+from yolov6.utils.cocoeval_R import RotatedCOCOeval
+from yolov6.utils.events_R import LOGGER
+
+
+def get_args_parser(add_help=True):
+    parser = argparse.ArgumentParser(description="YOLOv6 rotated COCO style evaluation of predictions.json.", add_help=add_help)
+    parser.add_argument("--anno-json", type=str, required=True, help="annotations/instances_<split>.json path.")
+    parser.add_argument("--pred-json", type=str, required=True, help="predictions.json saved by eval_R.py.")
+    parser.add_argument("--workers", type=int, default=8, help="number of processes, 0 runs in the main process.")
+    parser.add_argument("--verbose", action="store_true", help="print AP and AR of each class.")
+    args = parser.parse_args()
+    LOGGER.info(args)
+    return args
+
+
+def run(anno_json, pred_json, workers=8, verbose=False):
+    cocoEval = RotatedCOCOeval(anno_json, pred_json, workers=workers)
+    cocoEval.evaluate()
+    cocoEval.accumulate()
+    cocoEval.summarize()
+    if verbose:
+        cat_imgs, cat_anns = cocoEval.gt_counts()
+        LOGGER.info(("%-16s" + "%12s" * 5) % ("Class", "Images", "Labels", "mAP@.5", "mAP@.5:.95", "mAR@.5:.95"))
+        for cat_id, n_imgs, n_anns, (ap50, ap, ar) in zip(
+            cocoEval.params.catIds, cat_imgs, cat_anns, cocoEval.per_class()
+        ):
+            LOGGER.info(
+                ("%-16s" + "%12i" * 2 + "%12.3g" * 3) % (cocoEval.cat_names[cat_id], n_imgs, n_anns, ap50, ap, ar)
+            )
+    return cocoEval.stats
+
+
+def main(args):
+    run(**vars(args))
+
+
+if __name__ == "__main__":
+    args = get_args_parser()
+    main(args)
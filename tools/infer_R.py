@@ -17,7 +17,7 @@ from yolov6.utils.events_R import LOGGER
 
 def get_args_parser(add_help=True):
     parser = argparse.ArgumentParser(description='YOLOv6 PyTorch Inference.', add_help=add_help)
-    parser.add_argument('--weights', type=str, default='weights/yolov6s.pt', help='model path(s) for inference.')
+    parser.add_argument('--weights', type=str, default='weights/yolov6s.pt', help='model path for inference, .pt/.torchscript/.onnx/.xml selects the backend.')
     parser.add_argument('--source', type=str, default='data/images', help='the source path, e.g. image-file/dir.')
     parser.add_argument('--webcam', action='store_true', help='whether to use webcam.')
     parser.add_argument('--webcam-addr', type=str, default='0', help='the web camera address, local camera or rtsp address.')
@@ -26,6 +26,7 @@ def get_args_parser(add_help=True):
     parser.add_argument('--conf-thres', type=float, default=0.4, help='confidence threshold for inference.')
     parser.add_argument('--iou-thres', type=float, default=0.45, help='NMS IoU threshold for inference.')
     parser.add_argument('--max-det', type=int, default=1000, help='maximal inferences per image.')
+    parser.add_argument('--max-candidates', type=int, default=30000, help='maximal candidates per image put into the NMS, the highest class scores are kept.')
     parser.add_argument('--device', default='0', help='device to run our model i.e. 0 or 0,1,2,3 or cpu.')
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt.')
     parser.add_argument('--not-save-img', action='store_true', help='do not save visuallized inference results.')
@@ -38,6 +39,13 @@ def get_args_parser(add_help=True):
     parser.add_argument('--hide-labels', default=False, action='store_true', help='hide labels.')
     parser.add_argument('--hide-conf', default=False, action='store_true', help='hide confidences.')
     parser.add_argument('--half', action='store_true', help='whether to use FP16 half-precision inference.')
+    parser.add_argument('--tile-size', type=int, default=0, help='sliding window size (pixels) of large scenes, 0 letterboxes the whole image.')
+    parser.add_argument('--tile-overlap', type=int, default=200, help='overlap (pixels) of neighbouring windows.')
+    parser.add_argument('--tile-scales', nargs='+', type=float, default=[1.0], help='scales of the tile pyramid, e.g. --tile-scales 0.5 1.0.')
+    parser.add_argument('--tile-batch', type=int, default=8, help='number of tiles of one forward.')
+    parser.add_argument('--pipeline', action='store_true', help='pipelined inference, decoding/drawing/writing overlap the model.')
+    parser.add_argument('--batch-size', type=int, default=1, help='number of frames of one forward, letterboxed frames are padded to a common shape.')
+    parser.add_argument('--workers', type=int, default=4, help='number of preprocessing/drawing threads of the pipelined inference.')
 
     args = parser.parse_args()
     LOGGER.info(args)
@@ -66,10 +74,18 @@ def run(weights=osp.join(ROOT, 'yolov6s.pt'),
         hide_labels=False,
         hide_conf=False,
         half=False,
+        tile_size=0,
+        tile_overlap=200,
+        tile_scales=(1.0,),
+        tile_batch=8,
+        pipeline=False,
+        batch_size=1,
+        workers=4,
+        max_candidates=30000,
         ):
     """ Inference process, supporting inference on one image file or directory which containing images.
     Args:
-        weights: The path of model.pt, e.g. yolov6s.pt
+        weights: The path of model.pt/.torchscript/.onnx/.xml (OpenVINO), e.g. yolov6s.pt
         source: Source path, supporting image files or dirs containing images.
         yaml: Data yaml file, .
         img_size: Inference image-size, e.g. 640
@@ -87,6 +103,14 @@ def run(weights=osp.join(ROOT, 'yolov6s.pt'),
         hide_labels: Hide labels, e.g. False
         hide_conf: Hide confidences
         half: Use FP16 half-precision inference, e.g. False
+        tile_size: Sliding window size of large scenes, 0 letterboxes the whole image, e.g. 1024
+        tile_overlap: Overlap of neighbouring windows, e.g. 200
+        tile_scales: Scales of the tile pyramid, e.g. [0.5, 1.0]
+        tile_batch: Number of tiles of one forward, e.g. 8
+        pipeline: Pipelined inference, decoding, drawing and writing run in threads beside the model
+        batch_size: Number of frames of one forward, e.g. 8
+        workers: Number of preprocessing/drawing threads of the pipelined inference, e.g. 4
+        max_candidates: Maximal candidates per image put into the NMS, e.g. 30000
     """
     # create save dir
     if save_dir is None:
@@ -104,8 +128,16 @@ def run(weights=osp.join(ROOT, 'yolov6s.pt'),
             os.makedirs(save_txt_path)
 
     # Inference
-    inferer = Inferer(source, webcam, webcam_addr, weights, device, yaml, img_size, half)
-    inferer.infer(conf_thres, iou_thres, classes, agnostic_nms, max_det, save_dir, save_txt, not not_save_img, hide_labels, hide_conf, view_img)
+    inferer = Inferer(source, webcam, webcam_addr, weights, device, yaml, img_size, half,
+                      tile_size, tile_overlap, tile_scales, tile_batch, max_candidates)
+    if pipeline:
+        if view_img:
+            LOGGER.warning('--view-img is not supported in the pipelined inference, ignored.')
+        inferer.infer_pipeline(conf_thres, iou_thres, classes, agnostic_nms, max_det, save_dir, save_txt, not not_save_img, hide_labels, hide_conf,
+                               batch_size, workers)
+    else:
+        inferer.infer(conf_thres, iou_thres, classes, agnostic_nms, max_det, save_dir, save_txt, not not_save_img, hide_labels, hide_conf, view_img,
+                      batch_size)
 
     if save_txt or not not_save_img:
         LOGGER.info(f"Results saved to {save_dir}")
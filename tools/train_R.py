@@ -48,6 +48,20 @@ def get_args_parser(add_help=True):
     )
     parser.add_argument("--check-images", action="store_true", help="check images when initializing datasets")
     parser.add_argument("--check-labels", action="store_true", help="check label files when initializing datasets")
+    parser.add_argument(
+        "--cache-images", default=None, choices=["ram", "disk"], help="cache resized images in shared memory or on disk"
+    )
+    parser.add_argument("--cache-size", default=16.0, type=float, help="byte budget of the image cache (GB)")
+    parser.add_argument(
+        "--batch-augment",
+        action="store_true",
+        help="run mosaic/flip/rotate/hsv/mixup on whole batches on the training device, the loaders only decode",
+    )
+    parser.add_argument(
+        "--batch-slab",
+        action="store_true",
+        help="loader workers write the batches into a pinned shared memory ring instead of collating and pickling",
+    )
     parser.add_argument("--output-dir", default="./runs/train", type=str, help="path to save outputs")
     parser.add_argument("--name", default="exp", type=str, help="experiment name, saved to output_dir/name")
     parser.add_argument("--dist_url", default="env://", type=str, help="url used to set up distributed training")
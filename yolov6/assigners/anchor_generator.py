@@ -1,13 +1,40 @@
+from collections import OrderedDict
+
 import torch
 
+ANCHOR_CACHE_SIZE = 16  # multi-scale training and rect eval only see a few feature shapes
+_anchor_cache = OrderedDict()
+
 
 def generate_anchors(feats, fpn_strides, grid_cell_size=5.0, grid_cell_offset=0.5,  device='cpu', is_eval=False, mode='af'):
-    '''Generate anchors from features.'''
+    '''Generate anchors from features.
+    The anchors of the last ANCHOR_CACHE_SIZE feature shapes (with strides, dtype and device) are cached and shared by
+    the heads and the losses, the returned tensors must not be modified in place.'''
+    assert feats is not None
+    # NOTE export 时 anchors 需要从 trace 的 shape 生成, 不能用缓存的常量
+    if torch.jit.is_tracing() or torch.onnx.is_in_onnx_export():
+        return _generate_anchors(feats, fpn_strides, grid_cell_size, grid_cell_offset, device, is_eval, mode)
+    key = (
+        tuple(tuple(feats[i].shape[2:]) for i in range(len(fpn_strides))), tuple(fpn_strides), grid_cell_size,
+        grid_cell_offset, str(device), is_eval, mode, feats[0].dtype,
+    )
+    if key in _anchor_cache:
+        _anchor_cache.move_to_end(key)
+    else:
+        _anchor_cache[key] = _generate_anchors(feats, fpn_strides, grid_cell_size, grid_cell_offset, device, is_eval, mode)
+        if len(_anchor_cache) > ANCHOR_CACHE_SIZE:
+            _anchor_cache.popitem(last=False)
+    if is_eval:
+        return _anchor_cache[key]
+    anchors, anchor_points, num_anchors_list, stride_tensor = _anchor_cache[key]
+    return anchors, anchor_points, list(num_anchors_list), stride_tensor
+
+
+def _generate_anchors(feats, fpn_strides, grid_cell_size=5.0, grid_cell_offset=0.5,  device='cpu', is_eval=False, mode='af'):
     anchors = []
     anchor_points = []
     stride_tensor = []
     num_anchors_list = []
-    assert feats is not None
     if is_eval:
         for i, stride in enumerate(fpn_strides):
             _, _, h, w = feats[i].shape
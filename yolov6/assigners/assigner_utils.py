@@ -3,9 +3,8 @@ import numpy as np
 import torch.nn.functional as F
 from yolov6.utils.nms_R import xywh2xyxy
 from yolov6.utils.general import Rbbox2dist
-from mmcv.ops import box_iou_rotated
 
-from yolov6.utils.nms_R import rbox2poly, rbox2poly_radius
+from yolov6.utils.nms_R import box_iou_rotated, rbox2poly, rbox2poly_radius, rotated_box_iou
 
 
 def dist_calculator(gt_bboxes, anchor_bboxes):
@@ -203,4 +202,8 @@ def rbbox_overlaps(bboxes1, bboxes2, mode: str = "iou", is_aligned: bool = False
     clamped_bboxes1[:, :2].clamp_(min=-1e7, max=1e7)
     clamped_bboxes2[:, :2].clamp_(min=-1e7, max=1e7)
 
+    if box_iou_rotated is None:  # mmcv is not installed, use the pure torch kernel, angle in degree
+        clamped_bboxes1[:, 4] *= 180.0 / torch.pi
+        clamped_bboxes2[:, 4] *= 180.0 / torch.pi
+        return rotated_box_iou(clamped_bboxes1, clamped_bboxes2, mode, is_aligned)
     return box_iou_rotated(clamped_bboxes1, clamped_bboxes2, mode, is_aligned)
@@ -11,11 +11,12 @@ from yolov6.assigners.assigner_utils import (
     select_candidates_in_gts_R,
     select_highest_overlaps,
 )
+from yolov6.utils.nms_R import rbox2poly
 from mmcv.ops import box_iou_rotated
 
 
 class TaskAlignedAssigner(nn.Module):
-    def __init__(self, topk=13, num_classes=80, alpha=1.0, beta=6.0, eps=1e-9):
+    def __init__(self, topk=13, num_classes=80, alpha=1.0, beta=6.0, eps=1e-9, max_dense_boxes=100, chunk_size=2 ** 24):
         super(TaskAlignedAssigner, self).__init__()
         self.topk = topk
         self.num_classes = num_classes
@@ -23,6 +24,9 @@ class TaskAlignedAssigner(nn.Module):
         self.alpha = alpha
         self.beta = beta
         self.eps = eps
+        # NOTE 超过 max_dense_boxes 个 gt 时使用 forward_chunked, 显存随 chunk_size 而不是 n_max_boxes * num_anchors 增长
+        self.max_dense_boxes = max_dense_boxes
+        self.chunk_size = chunk_size
 
     @torch.no_grad()
     def forward(self, pd_scores, pd_bboxes, pd_angles, anc_points, gt_labels, gt_bboxes, gt_angles, mask_gt):
@@ -55,50 +59,142 @@ class TaskAlignedAssigner(nn.Module):
                 torch.zeros_like(pd_scores[..., 0]).to(device),
             )
 
-        cycle, step, self.bs = (1, self.bs, self.bs) if self.n_max_boxes <= 100 else (self.bs, 1, 1)
-        target_labels_lst, target_bboxes_lst, target_scores_lst, fg_mask_lst = [], [], [], []
-        # loop batch dim in case of numerous object box
-        for i in range(cycle):  # TODO change this
-            start, end = i * step, (i + 1) * step
-            pd_scores_ = pd_scores[start:end, ...]
-            pd_bboxes_ = pd_bboxes[start:end, ...]
-            pd_angles_ = pd_angles[start:end, ...]
-            gt_labels_ = gt_labels[start:end, ...]
-            gt_bboxes_ = gt_bboxes[start:end, ...]
-            gt_angles_ = gt_angles[start:end, ...]
-            mask_gt_ = mask_gt[start:end, ...]
-
-            mask_pos, align_metric, overlaps = self.get_pos_mask(
-                pd_scores_, pd_bboxes_, pd_angles_, gt_labels_, gt_bboxes_, gt_angles_, anc_points, mask_gt_
+        if self.n_max_boxes > self.max_dense_boxes:
+            return self.forward_chunked(
+                pd_scores, pd_bboxes, pd_angles, anc_points, gt_labels, gt_bboxes, gt_angles, mask_gt
             )
 
-            target_gt_idx, fg_mask, mask_pos = select_highest_overlaps(mask_pos, overlaps, self.n_max_boxes)
+        mask_pos, align_metric, overlaps = self.get_pos_mask(
+            pd_scores, pd_bboxes, pd_angles, gt_labels, gt_bboxes, gt_angles, anc_points, mask_gt
+        )
 
-            # assigned target
-            target_labels, target_bboxes, target_angles, target_scores = self.get_targets(
-                gt_labels_, gt_bboxes_, gt_angles_, target_gt_idx, fg_mask
-            )
+        target_gt_idx, fg_mask, mask_pos = select_highest_overlaps(mask_pos, overlaps, self.n_max_boxes)
 
-            # normalize
-            align_metric *= mask_pos
-            pos_align_metrics = align_metric.max(axis=-1, keepdim=True)[0]
-            pos_overlaps = (overlaps * mask_pos).max(axis=-1, keepdim=True)[0]
-            norm_align_metric = (align_metric * pos_overlaps / (pos_align_metrics + self.eps)).max(-2)[0].unsqueeze(-1)
-            target_scores = target_scores * norm_align_metric
-            # append
-            target_labels_lst.append(target_labels)
-            target_bboxes_lst.append(target_bboxes)
-            target_scores_lst.append(target_scores)
-            fg_mask_lst.append(fg_mask)
-
-        # concat
-        target_labels = torch.cat(target_labels_lst, 0)
-        target_bboxes = torch.cat(target_bboxes_lst, 0)
-        target_scores = torch.cat(target_scores_lst, 0)
-        fg_mask = torch.cat(fg_mask_lst, 0)
+        # assigned target
+        target_labels, target_bboxes, target_angles, target_scores = self.get_targets(
+            gt_labels, gt_bboxes, gt_angles, target_gt_idx, fg_mask
+        )
+
+        # normalize
+        align_metric *= mask_pos
+        pos_align_metrics = align_metric.max(axis=-1, keepdim=True)[0]
+        pos_overlaps = (overlaps * mask_pos).max(axis=-1, keepdim=True)[0]
+        norm_align_metric = (align_metric * pos_overlaps / (pos_align_metrics + self.eps)).max(-2)[0].unsqueeze(-1)
+        target_scores = target_scores * norm_align_metric
 
         return target_labels, target_bboxes, target_angles, target_scores, fg_mask.bool()
 
+    @torch.no_grad()
+    def forward_chunked(self, pd_scores, pd_bboxes, pd_angles, anc_points, gt_labels, gt_bboxes, gt_angles, mask_gt):
+        """Same assignment as forward for dense scenes, without any [bs, n_max_boxes, num_anchors] tensor.
+        The (gt, anchor) pairs with the anchor inside the rotated gt are found chunk by chunk of gts, the anchors are
+        pruned by the horizontal hull of each gt first. The metrics are only computed on these pairs and the top-k of
+        each gt is a segmented sort of the pairs, so the memory follows chunk_size and the number of pairs.
+        Anchors of several gts go to the gt of the highest iou among all the gts of the image, like
+        select_highest_overlaps.
+        """
+        bs, n_max_boxes, num_anchors = self.bs, self.n_max_boxes, anc_points.size(0)
+        labels = gt_labels.long().flatten()
+
+        # top-k anchors of each gt among the anchors inside it
+        gt_idx, anc_idx = self.select_candidates_sparse(anc_points, gt_bboxes, gt_angles, mask_gt)
+        align_metric, _ = self.get_pair_metrics(pd_scores, pd_bboxes, gt_bboxes, labels, gt_idx, anc_idx)
+        # NOTE metric 为 0 的 anchor 在 dense topk 中和 gt 外的 anchor 并列, 不作为候选
+        is_candidate = align_metric > 0
+        gt_idx, anc_idx, align_metric = gt_idx[is_candidate], anc_idx[is_candidate], align_metric[is_candidate]
+        order = align_metric.argsort(descending=True, stable=True)
+        gt_idx, anc_idx = gt_idx[order], anc_idx[order]
+        order = gt_idx.argsort(stable=True)
+        gt_idx, anc_idx = gt_idx[order], anc_idx[order]
+        counts = torch.bincount(gt_idx, minlength=bs * n_max_boxes)
+        rank = torch.arange(len(gt_idx), device=gt_idx.device) - (counts.cumsum(0) - counts)[gt_idx]
+        gt_idx, anc_idx = gt_idx[rank < self.topk], anc_idx[rank < self.topk]
+
+        # one gt per anchor, flat anchor index b * num_anchors + l
+        pos_idx = gt_idx // n_max_boxes * num_anchors + anc_idx
+        fg_mask = torch.bincount(pos_idx, minlength=bs * num_anchors)
+        assigned_gt = torch.zeros(bs * num_anchors, dtype=torch.long, device=gt_idx.device)
+        assigned_gt[pos_idx] = gt_idx
+        multi_idx = (fg_mask > 1).nonzero(as_tuple=True)[0]
+        if len(multi_idx):
+            assigned_gt[multi_idx] = self.get_max_overlaps_gt(pd_bboxes, gt_bboxes, multi_idx, num_anchors)
+        fg_mask = (fg_mask > 0).to(pd_scores.dtype).reshape(bs, num_anchors)
+        target_gt_idx = (assigned_gt % n_max_boxes).reshape(bs, num_anchors)
+
+        # assigned target
+        target_labels, target_bboxes, target_angles, target_scores = self.get_targets(
+            gt_labels, gt_bboxes, gt_angles, target_gt_idx, fg_mask
+        )
+
+        # normalize
+        pos_idx = fg_mask.flatten().nonzero(as_tuple=True)[0]
+        gt_idx, anc_idx = assigned_gt[pos_idx], pos_idx % num_anchors
+        align_metric, overlaps = self.get_pair_metrics(pd_scores, pd_bboxes, gt_bboxes, labels, gt_idx, anc_idx)
+        pos_align_metrics = align_metric.new_zeros(bs * n_max_boxes).scatter_reduce(0, gt_idx, align_metric, "amax")
+        pos_overlaps = overlaps.new_zeros(bs * n_max_boxes).scatter_reduce(0, gt_idx, overlaps, "amax")
+        norm_align_metric = align_metric.new_zeros(bs * num_anchors)
+        norm_align_metric[pos_idx] = align_metric * pos_overlaps[gt_idx] / (pos_align_metrics[gt_idx] + self.eps)
+        target_scores = target_scores * norm_align_metric.reshape(bs, num_anchors, 1)
+
+        return target_labels, target_bboxes, target_angles, target_scores, fg_mask.bool()
+
+    def select_candidates_sparse(self, anc_points, gt_bboxes, gt_angles, mask_gt, margin=1.0):
+        """(gt, anchor) pairs of select_candidates_in_gts_R, only for the valid gts.
+        Returns:
+            gt_idx (Tensor): shape(num_pairs), flat gt index b * n_max_boxes + n.
+            anc_idx (Tensor): shape(num_pairs)
+        """
+        num_anchors = anc_points.size(0)
+        valid_idx = mask_gt.flatten().nonzero(as_tuple=True)[0]
+        gt_obbs = torch.cat([gt_bboxes, gt_angles], dim=-1).reshape(-1, 5)[valid_idx]
+        gt_polys = rbox2poly(gt_obbs).reshape(-1, 4, 2)
+        hulls_lt, hulls_rb = gt_polys.min(1)[0] - margin, gt_polys.max(1)[0] + margin
+        anc_x, anc_y = anc_points[None, :, 0], anc_points[None, :, 1]
+        gt_idx, anc_idx = [], []
+        step = max(1, self.chunk_size // max(num_anchors, 1))
+        for start in range(0, len(valid_idx), step):
+            lt, rb = hulls_lt[start : start + step, None], hulls_rb[start : start + step, None]
+            in_hull = (anc_x >= lt[..., 0]) & (anc_x <= rb[..., 0]) & (anc_y >= lt[..., 1]) & (anc_y <= rb[..., 1])
+            i, j = in_hull.nonzero(as_tuple=True)
+            gt_idx.append(i + start)
+            anc_idx.append(j)
+        if not gt_idx:  # no valid gt
+            return valid_idx, valid_idx
+        gt_idx, anc_idx = torch.cat(gt_idx), torch.cat(anc_idx)
+
+        # NOTE 与 select_candidates_in_gts_R 相同的判断
+        a, b, d = gt_polys[gt_idx, 0], gt_polys[gt_idx, 1], gt_polys[gt_idx, 3]
+        ab, ad, ap = b - a, d - a, anc_points[anc_idx] - a
+        norm_ab, norm_ad = torch.sum(ab * ab, axis=-1), torch.sum(ad * ad, axis=-1)
+        ap_dot_ab, ap_dot_ad = torch.sum(ap * ab, axis=-1), torch.sum(ap * ad, axis=-1)
+        eps = 1e-9
+        is_in_box = (ap_dot_ab >= eps) & (ap_dot_ab <= norm_ab) & (ap_dot_ad >= eps) & (ap_dot_ad <= norm_ad)
+        return valid_idx[gt_idx[is_in_box]], anc_idx[is_in_box]
+
+    def get_pair_metrics(self, pd_scores, pd_bboxes, gt_bboxes, labels, gt_idx, anc_idx):
+        """align_metric and overlaps of get_box_metrics for the (gt, anchor) pairs only."""
+        batch_idx = gt_idx // self.n_max_boxes
+        bbox_scores = pd_scores[batch_idx, anc_idx, labels[gt_idx]]
+        overlaps = iou_calculator_xywh(
+            gt_bboxes.reshape(-1, 1, 4)[gt_idx], pd_bboxes[batch_idx, anc_idx].unsqueeze(1)
+        ).reshape(-1)
+        align_metric = bbox_scores.pow(self.alpha) * overlaps.pow(self.beta)
+        return align_metric, overlaps
+
+    def get_max_overlaps_gt(self, pd_bboxes, gt_bboxes, pos_idx, num_anchors):
+        """Flat index of the gt with the highest iou (among all the gts of the image) of each anchor."""
+        batch_idx, anc_idx = pos_idx // num_anchors, pos_idx % num_anchors
+        max_gt_idx = torch.empty_like(pos_idx)
+        # NOTE iou_calculator_xywh 每个 pair 约有 16 个 float 的中间变量
+        step = max(1, self.chunk_size // (16 * self.n_max_boxes))
+        for b in batch_idx.unique().tolist():
+            idx = (batch_idx == b).nonzero(as_tuple=True)[0]
+            for start in range(0, len(idx), step):
+                i = idx[start : start + step]
+                overlaps = iou_calculator_xywh(gt_bboxes[b : b + 1], pd_bboxes[b : b + 1, anc_idx[i]])
+                max_gt_idx[i] = b * self.n_max_boxes + overlaps[0].argmax(0)
+        return max_gt_idx
+
     def get_pos_mask(self, pd_scores, pd_bboxes, pd_angles, gt_labels, gt_bboxes, gt_angles, anc_points, mask_gt):
 
         # NOTE get anchor_align metric
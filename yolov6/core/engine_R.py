@@ -24,6 +24,7 @@ from torch.utils.tensorboard.writer import SummaryWriter
 # from tqdm import tqdm
 
 import tools.eval_R as eval
+from yolov6.data.batch_augment_R import BatchAugment
 from yolov6.data.data_load_R import create_dataloader
 from yolov6.data.data_augment_R import longSideFormat2minAreaRect
 from yolov6.models.losses.loss_distill_ns_R import ComputeLoss as ComputeLoss_distill_ns
@@ -59,6 +60,8 @@ class Trainer:
         self.num_classes = self.data_dict["nc"]
         # NOTE data loader
         self.train_loader, self.val_loader = self.get_data_loader(args, cfg, self.data_dict)
+        # NOTE batch augment, 加载线程只做解码和 letterbox
+        self.batch_augment = BatchAugment(dict(cfg.data_aug)) if args.batch_augment else None
         # get model and optimizer
         # NOTE YOLOv6n 和 YOLOV6s 都是默认蒸馏配置
         self.distill_ns = True if self.args.distill and args.distill_ns else False
@@ -253,6 +256,8 @@ class Trainer:
                         *self.mean_loss,
                     )
                 )
+                if self.train_loader.dataset.img_cache is not None:
+                    LOGGER.info(f"Train: {self.train_loader.dataset.img_cache.summary()}")
         except Exception as _:
             LOGGER.error("ERROR in training steps.")
             raise
@@ -266,7 +271,7 @@ class Trainer:
     def train_in_steps(self, epoch_num, step_num):
         # NOTE images and targets
         # NOTE Targets: torch [num_labels_all_batchs, 7] [bs_id, class_id, x, y, w, h, angle] 相对值
-        images, targets = self.prepro_data(self.batch_data, self.device)
+        images, targets = self.prepro_data(self.batch_data, self.device, self.batch_augment)
         # plot train_batch and save to tensorboard once an epoch
         if self.write_trainbatch_tb and self.main_process and self.step <= 3:
             # TODO
@@ -466,6 +471,7 @@ class Trainer:
                 angle_max=self.cfg.model.head.angle_max,
                 angle_fitting_methods=self.cfg.model.head.angle_fitting_methods,
                 ap_method=get_cfg_value(self.cfg.eval_params, "ap_method", False),
+                max_candidates=get_cfg_value(self.cfg.eval_params, "max_candidates", 30000),
             )
 
         LOGGER.info(f"Epoch: {self.epoch} | mAP@0.5: {results[0]} | mAP@0.50:0.95: {results[1]}")
@@ -546,6 +552,8 @@ class Trainer:
             self.cfg.data_aug.mosaic = 0.0
             self.cfg.data_aug.mixup = 0.0
             self.train_loader, self.val_loader = self.get_data_loader(self.args, self.cfg, self.data_dict)
+            if self.batch_augment is not None:
+                self.batch_augment.hyp.update(mosaic=0.0, mixup=0.0)
         self.model.train()
         if self.rank != -1:
             self.train_loader.sampler.set_epoch(self.epoch)
@@ -701,6 +709,10 @@ class Trainer:
             check_labels=args.check_labels,
             data_dict=data_dict,
             task="train",
+            cache_images=args.cache_images,
+            cache_bytes=args.cache_size * 1e9,
+            batch_augment=args.batch_augment,
+            batch_slab=args.batch_slab,
         )[0]
 
         # create val dataloader
@@ -720,14 +732,19 @@ class Trainer:
                 check_labels=args.check_labels,
                 data_dict=data_dict,
                 task="val",
+                cache_images=args.cache_images,
+                cache_bytes=args.cache_size * 1e9,
             )[0]
 
         return train_loader, val_loader
 
     @staticmethod
-    def prepro_data(batch_data, device):
-        images = batch_data[0].to(device, non_blocking=True).float() / 255
+    def prepro_data(batch_data, device, batch_augment=None):
+        images = batch_data[0].to(device, non_blocking=True)
         targets = batch_data[1].to(device)
+        if batch_augment is not None:
+            images, targets = batch_augment(images, targets)
+        images = images.float() / 255
         return images, targets
 
     def get_model(self, args, cfg, nc, device, distill_ns):
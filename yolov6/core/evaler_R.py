@@ -7,15 +7,13 @@ from pathlib import Path
 import numpy as np
 import torch
 import yaml
-from pycocotools.coco import COCO
-from pycocotools.cocoeval import COCOeval
 from rich.progress import track
 from tqdm import tqdm
 
 from yolov6.data.data_load_R import create_dataloader
-from yolov6.utils.checkpoint import load_checkpoint
+from yolov6.utils.backends_R import TorchBackend, load_backend
+from yolov6.utils.cocoeval_R import RotatedCOCOeval
 from yolov6.utils.events_R import LOGGER, NCOLS
-from yolov6.utils.general import download_ckpt
 from yolov6.utils.nms_R import (non_max_suppression_obb,
                                 non_max_suppression_obb_cuda, rbox2poly)
 from yolov6.utils.torch_utils import get_model_info, time_sync
@@ -25,6 +23,42 @@ python tools/eval.py --task 'train'/'val'/'speed'
 """
 
 
+class RotatedPredictions:
+    """Detections of a dataset kept as one float32 array [n, 10] (poly, score, class) per image.
+    The coco style dicts {"image_id", "category_id", "poly", "score", "file_name"} are only built while dumping json.
+    """
+
+    def __init__(self):
+        self.image_ids, self.file_names, self.records = [], [], []
+        self.num_dets = 0
+
+    def __len__(self):
+        return self.num_dets
+
+    def append(self, image_id, file_name, polys, scores, classes):
+        records = torch.cat((polys, scores[:, None], classes[:, None]), 1).float().cpu().numpy()
+        self.image_ids.append(image_id)
+        self.file_names.append(file_name)
+        self.records.append(records)
+        self.num_dets += len(records)
+
+    def __iter__(self):
+        for image_id, file_name, records in zip(self.image_ids, self.file_names, self.records):
+            polys = records[:, :8].astype(np.float64).round(1).tolist()
+            scores = records[:, 8].astype(np.float64).round(5).tolist()
+            classes = records[:, 9].astype(np.int64).tolist()
+            for poly, score, category_id in zip(polys, scores, classes):
+                yield {"image_id": image_id, "category_id": category_id, "poly": poly, "score": score, "file_name": file_name}
+
+    def dump(self, path):
+        """Stream the json, one image at a time."""
+        with open(path, "w") as f:
+            f.write("[")
+            for i, pred_data in enumerate(self):
+                f.write(", " * (i > 0) + json.dumps(pred_data))
+            f.write("]")
+
+
 class Evaler:
     def __init__(
         self,
@@ -49,6 +83,7 @@ class Evaler:
         angle_max=180,
         angle_fitting_methods="regression",
         ap_method="VOC12",
+        max_candidates=30000,
     ):
         # NOTE both not for DOTA online testing
         # assert do_pr_metric or do_coco_metric, "ERROR: at least set one val metric"
@@ -73,24 +108,23 @@ class Evaler:
         self.angle_max = angle_max
         self.angle_fitting_methods = angle_fitting_methods
         self.ap_method = ap_method
+        self.max_candidates = max_candidates
 
     def init_model(self, model, weights, task):
+        self.dynamic_hw = True
         if task != "train":
-            if not os.path.exists(weights):
-                download_ckpt(weights)
-            model = load_checkpoint(weights, map_location=self.device)
-            self.stride = int(model.stride.max())
+            # NOTE backend 由权重后缀决定: .pt / .torchscript / .onnx / .xml
+            model = load_backend(weights, self.device, self.half)
+            self.stride = model.stride
+            if model.nc is None:
+                model.nc, model.names = self.data["nc"], self.data["names"]
             if self.device.type != "cpu":
-                model(torch.zeros(1, 3, self.img_size, self.img_size).to(self.device).type_as(next(model.parameters())))
-
-            # switch to deploy
-            from yolov6.layers.common import RepVGGBlock
-
-            for layer in model.modules():
-                if isinstance(layer, RepVGGBlock):
-                    layer.switch_to_deploy()
-            LOGGER.info("Switch model to deploy modality.")
-            LOGGER.info("Model Summary: {}".format(get_model_info(model, self.img_size)))
+                model.warmup((self.img_size, self.img_size))
+            if model.end2end:
+                LOGGER.info(f"End2End model, the NMS of the graph is used with {model.end2end}.")
+            self.dynamic_hw = model.dynamic_hw
+            if isinstance(model, TorchBackend):
+                LOGGER.info("Model Summary: {}".format(get_model_info(model.model, self.img_size)))
         model.half() if self.half else model.float()
         return model
 
@@ -109,6 +143,10 @@ class Evaler:
             if self.force_no_pad:
                 pad = 0.0
             rect = not self.not_infer_on_rect
+            # NOTE 静态输入尺寸的模型 (ONNX/OpenVINO) 不能用 rect 推理, 与 Inferer.preprocess_batch 一致
+            if rect and not self.dynamic_hw:
+                LOGGER.info(f"Static input size model, rect inference is disabled, images are letterboxed to {self.img_size}.")
+                rect = False
             dataloader = create_dataloader(
                 self.data[task if task in ("train", "val", "test") else "val"],
                 self.img_size,
@@ -128,19 +166,15 @@ class Evaler:
         Predicts the whole dataset and gets the prediced results and inference time.
         """
         self.speed_result = torch.zeros(4, device=self.device)
-        pred_results = []
+        pred_results = RotatedPredictions()
         pbar = tqdm(dataloader, desc=f"Inferencing model in {task} datasets.")
-        # pbar = tqdm(dataloader, desc=f"Inferencing model in {task} datasets.")
-        # task = progress.add_task("task", total=len(train_loader), epoch_name=f"Epoch {epoch + 1}/{epochs}")
-        # progress.start()
-        # progress.start_task(task)
 
         # whether to compute metric and plot PR curve and P、R、F1 curve under iou50 match rule
         if self.do_pr_metric:
-            stats, ap = [], []
-            seen = 0
+            from yolov6.utils.metrics_R import MetricAccumulator
+
             iouv = torch.linspace(0.5, 0.95, 10)  # iou vector for mAP@0.5:0.95
-            niou = iouv.numel()
+            metric = MetricAccumulator(iouv)
             if self.plot_confusion_matrix:
                 # from yolov6.utils.metrics import ConfusionMatrix
                 from yolov6.utils.metrics_R import ConfusionMatrix
@@ -149,8 +183,6 @@ class Evaler:
 
         for i, (imgs, targets, paths, shapes) in enumerate(pbar):
 
-            # NOTE 暂时这么设置
-            # targets = targets[..., :-1]
             # pre-process
             t1 = time_sync()
             imgs = imgs.to(self.device, non_blocking=True)
@@ -161,25 +193,51 @@ class Evaler:
             # Inference
             t2 = time_sync()
             # NOTE [BS, x, y, w, h, angle, conf, classes ] angle转化完, 绝对值
-            # import ipdb; ipdb.set_trace()
-            outputs, _ = model(imgs)
+            outputs = model(imgs)
+            end2end = getattr(model, "end2end", None)
+            if isinstance(outputs, (list, tuple)) and not end2end:  # training model returns (outputs, featmaps)
+                outputs = outputs[0]
             self.speed_result[2] += time_sync() - t2  # inference time
             # post-process
             t3 = time_sync()
             # outputs = non_max_suppression_obb(outputs, self.conf_thres, self.iou_thres, multi_label=True)
             # NOTE [N, x, y, w, h, angle, conf, classes]
-            outputs = non_max_suppression_obb_cuda(outputs, self.conf_thres, self.iou_thres, multi_label=True)
+            # NOTE End2End 模型在图内完成 NMS, 输出已经是每张图的检测结果
+            if not end2end:
+                outputs = non_max_suppression_obb_cuda(
+                    outputs, self.conf_thres, self.iou_thres, multi_label=True, max_candidates=self.max_candidates
+                )
 
             self.speed_result[3] += time_sync() - t3  # post-process time
             self.speed_result[0] += len(outputs)
-            # NOTE self.do_pr_metric
-            if self.do_pr_metric:
-                import copy
 
-                eval_outputs = copy.deepcopy([x.detach().cpu() for x in outputs])
+            # NOTE 原图尺度, 原地修改, metric 和 coco 结果共用, 不再 deepcopy
+            for si, pred in enumerate(outputs):
+                self.scale_coords(imgs[si].shape[1:], pred[:, :4], shapes[si][0], shapes[si][1])  # native-space pred
+
+            # Statistics per image, matched on the device of predictions
+            # This code is based on
+            # https://github.com/ultralytics/yolov5/blob/master/val.py
+            if self.do_pr_metric:
+                targets = targets.to(self.device)
+                labels_list = []
+                for si, pred in enumerate(outputs):
+                    labels = targets[targets[:, 0] == si, 1:]
+                    if len(labels):
+                        # target boxes
+                        tbox = labels[:, 1:5].clone()
+                        tbox[:, [0, 2]] *= imgs[si].shape[1:][1]
+                        tbox[:, [1, 3]] *= imgs[si].shape[1:][0]
+                        self.scale_coords(imgs[si].shape[1:], tbox, shapes[si][0], shapes[si][1])  # native-space labels
+                        labels = torch.cat((labels[:, 0:1], tbox, labels[:, -1:]), 1)  # native-space labels
+                    labels_list.append(labels)
+                    if self.plot_confusion_matrix and len(pred) and len(labels):
+                        # TODO FIXME
+                        confusion_matrix.process_batch(pred, labels)
+                metric.update(outputs, labels_list)  # NOTE 整个 batch 一次匹配
 
             # save result TODO  add DOTA
-            pred_results.extend(self.convert_to_coco_format(outputs, imgs, paths, shapes, self.ids))
+            self.convert_to_coco_format(outputs, imgs, paths, shapes, self.ids, pred_results)
 
             # for tensorboard visualization, maximum images to show: 8
             if i == 0:
@@ -187,54 +245,9 @@ class Evaler:
                 vis_outputs = outputs[:vis_num]
                 vis_paths = paths[:vis_num]
 
-            if not self.do_pr_metric:
-                continue
-
-            # Statistics per image
-            # This code is based on
-            # https://github.com/ultralytics/yolov5/blob/master/val.py
-            for si, pred in enumerate(eval_outputs):
-                labels = targets[targets[:, 0] == si, 1:]
-                nl = len(labels)
-                tcls = labels[:, 0].tolist() if nl else []  # target class
-                seen += 1
-
-                if len(pred) == 0:
-                    if nl:
-                        stats.append((torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls))
-                    continue
-
-                # Predictions
-                predn = pred.clone()
-                self.scale_coords(imgs[si].shape[1:], predn[:, :4], shapes[si][0], shapes[si][1])  # native-space pred
-
-                # Assign all predictions as incorrect
-                correct = torch.zeros(pred.shape[0], niou, dtype=torch.bool)
-                if nl:
-                    # target boxes
-                    tbox = labels[:, 1:5]
-                    angle = labels[:, -1:].clone()
-                    tbox[:, [0, 2]] *= imgs[si].shape[1:][1]
-                    tbox[:, [1, 3]] *= imgs[si].shape[1:][0]
-
-                    self.scale_coords(imgs[si].shape[1:], tbox, shapes[si][0], shapes[si][1])  # native-space labels
-
-                    labelsn = torch.cat((labels[:, 0:1], tbox, angle), 1)  # native-space labels
-
-                    from yolov6.utils.metrics_R import process_batch
-
-                    correct = process_batch(predn, labelsn, iouv)
-
-                    if self.plot_confusion_matrix:
-                        # TODO FIXME
-                        confusion_matrix.process_batch(predn, labelsn)
-
-                # Append statistics (correct, conf, pcls, tcls)
-                stats.append((correct.cpu(), pred[:, 5].cpu(), pred[:, 6].cpu(), tcls))
-
         if self.do_pr_metric:
             # Compute statistics
-            stats = [np.concatenate(x, 0) for x in zip(*stats)]  # to numpy
+            stats, seen = metric.result(), metric.seen  # to numpy
             if len(stats) and stats[0].any():
 
                 from yolov6.utils.metrics_R import ap_per_class
@@ -293,7 +306,7 @@ class Evaler:
     def eval_model(self, pred_results, model, dataloader, task):
         """Evaluate models
         For task speed, this function only evaluates the speed of model and outputs inference time.
-        For task val, this function evaluates the speed and mAP by pycocotools, and returns
+        For task val, this function evaluates the speed and rotated mAP (COCO style), and returns
         inference time and mAP value.
         """
         LOGGER.info(f"\nEvaluating speed.")
@@ -303,7 +316,7 @@ class Evaler:
         if not self.do_coco_metric and self.do_pr_metric:
             return self.pr_metric_result
 
-        LOGGER.info(f"\nEvaluating mAP by pycocotools.")
+        LOGGER.info(f"\nEvaluating rotated mAP.")
         if task != "speed" and len(pred_results):
             if "anno_path" in self.data:
                 anno_json = self.data["anno_path"]
@@ -315,8 +328,7 @@ class Evaler:
                 anno_json = os.path.join(dataset_root, "annotations", f"instances_{base_name}.json")
             pred_json = os.path.join(self.save_dir, "predictions.json")
             LOGGER.info(f"Saving {pred_json}...")
-            with open(pred_json, "w") as f:
-                json.dump(pred_results, f)
+            pred_results.dump(pred_json)
 
             # NOTE for DOTA eval
             if not self.do_coco_metric and not self.do_pr_metric:
@@ -324,36 +336,22 @@ class Evaler:
                 LOGGER.info('\nSaved Json')
                 return (0.0, 0.0)
 
-            # NOTE for coco eval
-            anno = COCO(anno_json)
-            pred = anno.loadRes(pred_json)
-            cocoEval = COCOeval(anno, pred, "bbox")
+            # NOTE rotated coco style eval, ious of the poly predictions instead of their horizontal boxes
+            cocoEval = RotatedCOCOeval(anno_json, pred_results)
             if self.is_coco:
                 imgIds = [int(os.path.basename(x).split(".")[0]) for x in dataloader.dataset.img_paths]
                 cocoEval.params.imgIds = imgIds
             cocoEval.evaluate()
             cocoEval.accumulate()
 
-            # print each class ap from pycocotool result
+            # print each class ap from the rotated eval result
             if self.verbose:
-
-                import copy
-
-                val_dataset_img_count = cocoEval.cocoGt.imgToAnns.__len__()
-                val_dataset_anns_count = 0
-                label_count_dict = {"images": set(), "anns": 0}
-                label_count_dicts = [copy.deepcopy(label_count_dict) for _ in range(model.nc)]
-                for _, ann_i in cocoEval.cocoGt.anns.items():
-                    if ann_i["ignore"]:
-                        continue
-                    val_dataset_anns_count += 1
-                    nc_i = (
-                        self.coco80_to_coco91_class().index(ann_i["category_id"])
-                        if self.is_coco
-                        else ann_i["category_id"]
-                    )
-                    label_count_dicts[nc_i]["images"].add(ann_i["image_id"])
-                    label_count_dicts[nc_i]["anns"] += 1
+                cat_imgs, cat_anns = cocoEval.gt_counts()
+                if self.is_coco:
+                    cat_order = [cocoEval.params.catIds.index(c) for c in self.coco80_to_coco91_class()]
+                    cat_imgs, cat_anns = cat_imgs[cat_order], cat_anns[cat_order]
+                val_dataset_img_count = len(cocoEval.gts)
+                val_dataset_anns_count = int(cat_anns.sum())
 
                 s = ("%-16s" + "%12s" * 7) % (
                     "Class",
@@ -398,8 +396,8 @@ class Evaler:
                         pf
                         % (
                             model.names[nc_i],
-                            len(label_count_dicts[nc_i]["images"]),
-                            label_count_dicts[nc_i]["anns"],
+                            cat_imgs[nc_i],
+                            cat_anns[nc_i],
                             p[i],
                             r[i],
                             f1[i],
@@ -463,33 +461,17 @@ class Evaler:
             coords[:, 1] = coords[:, 1].clip(0, img0_shape[0])
         return coords
 
-    def convert_to_coco_format(self, outputs, imgs, paths, shapes, ids):
-        # NOTE [N, x, y, w, h, angle, conf, classes]
-        pred_results = []
+    def convert_to_coco_format(self, outputs, imgs, paths, shapes, ids, pred_results=None):
+        """Append native-space predictions [N, x, y, w, h, angle, conf, classes] to RotatedPredictions as polys."""
+        pred_results = RotatedPredictions() if pred_results is None else pred_results
         for i, pred in enumerate(outputs):
             if len(pred) == 0:
                 continue
-            path, shape = Path(paths[i]), shapes[i][0]
-            self.scale_coords(imgs[i].shape[1:], pred[:, :4], shape, shapes[i][1])
+            path = Path(paths[i])
             image_id = int(path.stem) if self.is_coco else path.stem
             # TODO, add flag
-            poly = rbox2poly(pred[:, :5].clone())
-
-            pred_polys = torch.cat((poly, pred[:, 5:].clone()), dim=1)
-            # NOTE for DOTA
-            # torch cuda => numpy
-            # for ind in range(pred.shape[0]):
-            #     category_id = ids[int(cls[ind])]
-            #     poly = [round(x, 1) for x in poly[ind].tolist()]
-            #     score = round(scores[ind].item(), 5)
-            #     pred_data = {"image_id": image_id, "category_id": category_id, "poly": poly, "score": score, "file_name": path.stem}
-            #     pred_results.append(pred_data)
-            for p in pred_polys.tolist():
-                category_id = int(p[-1])
-                poly = [round(x, 1) for x in p[:8]]
-                score = round(p[-2], 5)
-                pred_data = {"image_id": image_id, "category_id": category_id, "poly": poly, "score": score, "file_name": path.stem}
-                pred_results.append(pred_data)
+            poly = rbox2poly(pred[:, :5])
+            pred_results.append(image_id, path.stem, poly, pred[:, 5], pred[:, 6])
         return pred_results
 
     @staticmethod
@@ -8,21 +8,41 @@ import torch
 import numpy as np
 import os.path as osp
 
+import queue
+import threading
+
 from tqdm import tqdm
 from pathlib import Path
 from PIL import ImageFont
 from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
 from yolov6.utils.events_R import LOGGER, load_yaml
-from yolov6.layers.common import DetectBackend
+from yolov6.utils.backends_R import load_backend
 from yolov6.data.data_augment_R import letterbox
 from yolov6.data.datasets_R import LoadData
-from yolov6.utils.nms_R import non_max_suppression_obb_cuda
+from yolov6.utils.nms_R import batched_nms_rotated, non_max_suppression_obb, non_max_suppression_obb_cuda
 from yolov6.utils.torch_utils import get_model_info
 from yolov6.data.data_augment_R import longSideFormat2minAreaRect
 
 class Inferer:
-    def __init__(self, source, webcam, webcam_addr, weights, device, yaml, img_size, half):
+    def __init__(
+        self,
+        source,
+        webcam,
+        webcam_addr,
+        weights,
+        device,
+        yaml,
+        img_size,
+        half,
+        tile_size=0,
+        tile_overlap=200,
+        tile_scales=(1.0,),
+        tile_batch=8,
+        max_candidates=30000,
+    ):
 
         self.__dict__.update(locals())
 
@@ -31,26 +51,26 @@ class Inferer:
         self.img_size = img_size
         cuda = self.device != "cpu" and torch.cuda.is_available()
         self.device = torch.device(f"cuda:{device}" if cuda else "cpu")
-        self.model = DetectBackend(weights, device=self.device)
+        self.model = load_backend(weights, self.device, half)
         self.stride = self.model.stride
         self.class_names = load_yaml(yaml)["names"]
         self.img_size = self.check_img_size(self.img_size, s=self.stride)  # check image size
-        self.half = half
-
-        # Switch model to deploy status
-        self.model_switch(self.model.model, self.img_size)
-
-        # Half precision
-        if self.half & (self.device.type != "cpu"):
-            self.model.model.half()
-        else:
-            self.model.model.float()
-            self.half = False
+        self.half = self.model.fp16
+        if self.model.end2end:
+            LOGGER.info(f"End2End model, the NMS of the graph is used with {self.model.end2end}.")
+
+        # Tiled inference of large scenes, tile_size 0 letterboxes the whole image
+        self.tile_size = self.make_divisible(tile_size, int(self.stride)) if tile_size else 0
+        assert not self.tile_size or 0 <= tile_overlap < self.tile_size, (
+            f"tile overlap {tile_overlap} must be in [0, tile size)"
+        )
+        self.tile_overlap = tile_overlap
+        self.tile_scales = tuple(tile_scales)
+        self.tile_batch = tile_batch
+        self.max_candidates = max_candidates
 
         if self.device.type != "cpu":
-            self.model(
-                torch.zeros(1, 3, *self.img_size, *self.img_size).to(self.device).type_as(next(self.model.model.parameters()))
-            )  # warmup
+            self.model.warmup(self.img_size)  # warmup
 
         # Load data
         self.webcam = webcam
@@ -58,16 +78,6 @@ class Inferer:
         self.files = LoadData(source, webcam, webcam_addr)
         self.source = source
 
-    def model_switch(self, model, img_size):
-        """Model switch to deploy status"""
-        from yolov6.layers.common import RepVGGBlock
-
-        for layer in model.modules():
-            if isinstance(layer, RepVGGBlock):
-                layer.switch_to_deploy()
-
-        LOGGER.info("Switch model to deploy modality.")
-
     def infer(
         self,
         conf_thres,
@@ -81,116 +91,351 @@ class Inferer:
         hide_labels,
         hide_conf,
         view_img=True,
+        batch_size=1,
     ):
         """Model Inference and results visualization"""
-        vid_path, vid_writer, windows = None, None, []
+        writer = ResultWriter()
+        windows = []
         fps_calculator = CalcFPS()
-        for img_src, img_path, vid_cap in tqdm(self.files):
-            img, img_src = self.process_image(img_src, self.img_size, self.stride, self.half)
-            img = img.to(self.device)
-            if len(img.shape) == 3:
-                img = img[None]
-                # expand for batch dim
+        pbar = tqdm(total=len(self.files))
+        for frames in self.files.batches(batch_size):
+            imgs_src = [frame[0] for frame in frames]
+            batch, shapes = self.preprocess_batch(imgs_src)
             t1 = time.time()
-            pred_results = self.model(img)
-            det = non_max_suppression_obb_cuda(pred_results, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)[0]
+            dets = self.infer_batch(batch, shapes, imgs_src, conf_thres, iou_thres, classes, agnostic_nms, max_det)
             t2 = time.time()
 
-            if self.webcam:
-                save_path = osp.join(save_dir, self.webcam_addr)
-                txt_path = osp.join(save_dir, self.webcam_addr)
-            else:
-                # Create output files in nested dirs that mirrors the structure of the images' dirs
-                rel_path = osp.relpath(osp.dirname(img_path), osp.dirname(self.source))
-                save_path = osp.join(save_dir, rel_path, osp.basename(img_path))  # im.jpg
-                txt_path = osp.join(save_dir, rel_path, "labels", osp.splitext(osp.basename(img_path))[0])
-                os.makedirs(osp.join(save_dir, rel_path), exist_ok=True)
-
-            gn = torch.tensor(img_src.shape)[[1, 0, 1, 0]]  # normalization gain whwh
-            img_ori = img_src.copy()
-
-            # check image and font
-            assert (
-                img_ori.data.contiguous
-            ), "Image needs to be contiguous. Please apply to input images with np.ascontiguousarray(im)."
-            self.font_check()
-
-            if len(det):
-                det[:, :4] = self.rescale(img.shape[2:], det[:, :4], img_src.shape).round()
-                for *obb, conf, cls in reversed(det):
-                    if save_txt:  # Write to file
-                        # xywh = (
-                        #     (self.box_convert(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()
-                        # )  # normalized xywh
-                        line = (cls, *obb, conf)
-                        with open(txt_path + ".txt", "a") as f:
-                            f.write(("%g " * len(line)).rstrip() % line + "\n")
+            # FPS counter
+            fps_calculator.update(len(frames) / (t2 - t1))
+            avg_fps = fps_calculator.accumulate()
+
+            for (img_src, img_path, file_type, vid_info), det in zip(frames, dets):
+                save_path, txt_path = self.get_save_paths(img_path, save_dir)
+
+                # check image and font
+                assert (
+                    img_src.data.contiguous
+                ), "Image needs to be contiguous. Please apply to input images with np.ascontiguousarray(im)."
+                self.font_check()
 
+                img_src = self.draw_frame(
+                    img_src, det if save_img else det[:0], hide_labels, hide_conf, avg_fps if file_type == "video" else None
+                )
+                if save_txt and len(det):
+                    writer.write_txt(txt_path, self.det_lines(det))
+
+                if view_img:
+                    if img_path not in windows:
+                        windows.append(img_path)
+                        cv2.namedWindow(
+                            str(img_path), cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO
+                        )  # allow window resize (Linux)
+                        cv2.resizeWindow(str(img_path), img_src.shape[1], img_src.shape[0])
+                    cv2.imshow(str(img_path), img_src)
+                    cv2.waitKey(1)  # 1 millisecond
+
+                # Save results (image with detections)
+                if save_img:
+                    writer.save_frame(img_src, save_path, file_type, self.video_info(vid_info, img_src))
+            pbar.update(len(frames))
+        pbar.close()
+        writer.close()
+
+    def infer_pipeline(
+        self,
+        conf_thres,
+        iou_thres,
+        classes,
+        agnostic_nms,
+        max_det,
+        save_dir,
+        save_txt,
+        save_img,
+        hide_labels,
+        hide_conf,
+        batch_size=8,
+        workers=4,
+        queue_size=32,
+    ):
+        """Pipelined inference: decode -> preprocess -> model -> NMS -> draw -> write.
+        Batches of frames are decoded by one thread and letterboxed in a thread pool, the model and NMS run in the
+        calling thread, the boxes are drawn in the thread pool and one writer thread saves the txt files and
+        images/videos in order. Stages are connected by bounded queues, so the model is the only bottleneck when
+        decoding, drawing and writing keep up.
+        """
+        pool = ThreadPoolExecutor(max(workers, 1))
+        pre_queue, post_queue = queue.Queue(max(queue_size // batch_size, 2)), queue.Queue(queue_size)
+        errors, decoded = [], [False]
+
+        def decode():
+            try:
+                for frames in self.files.batches(batch_size):
+                    if errors:
+                        break
+                    pre_queue.put((pool.submit(self.preprocess_batch, [frame[0] for frame in frames]), frames))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                pre_queue.put(None)
+
+        def write():
+            writer = ResultWriter()
+            while True:
+                item = post_queue.get()
+                if item is None:
+                    break
+                if errors:  # NOTE 出错后继续取出队列, 避免主线程阻塞
+                    continue
+                future, det, save_path, txt_path, file_type, vid_info = item
+                try:
+                    img_src = future.result()
+                    if save_txt and len(det):
+                        writer.write_txt(txt_path, self.det_lines(det))
                     if save_img:
-                        class_num = int(cls)  # integer class
-                        label = (
-                            None
-                            if hide_labels
-                            else (
-                                self.class_names[class_num]
-                                if hide_conf
-                                else f"{self.class_names[class_num]} {conf:.2f}"
-                            )
-                        )
-
-                        self.plot_box_and_label(
-                            img_ori,
-                            max(round(sum(img_ori.shape) / 2 * 0.003), 2),
-                            obb,
-                            label,
-                            color=self.generate_colors(class_num, True),
-                        )
-
-                img_src = np.asarray(img_ori)
+                        writer.save_frame(img_src, save_path, file_type, self.video_info(vid_info, img_src))
+                except Exception as e:
+                    errors.append(e)
+            writer.close()
 
-            # FPS counter
-            fps_calculator.update(1.0 / (t2 - t1))
-            avg_fps = fps_calculator.accumulate()
+        self.font_check()
+        fps_calculator = CalcFPS()
+        pbar = tqdm(total=len(self.files))
+        decoder, saver = threading.Thread(target=decode, daemon=True), threading.Thread(target=write, daemon=True)
+        decoder.start()
+        saver.start()
+        try:
+            while not errors:
+                item = pre_queue.get()
+                if item is None:
+                    decoded[0] = True
+                    break
+                (batch, shapes), frames = item[0].result(), item[1]
+                imgs_src = [frame[0] for frame in frames]
+                t1 = time.time()
+                dets = self.infer_batch(batch, shapes, imgs_src, conf_thres, iou_thres, classes, agnostic_nms, max_det)
+                t2 = time.time()
+                fps_calculator.update(len(frames) / (t2 - t1))
+                avg_fps = fps_calculator.accumulate()
+                for (img_src, img_path, file_type, vid_info), det in zip(frames, dets):
+                    save_path, txt_path = self.get_save_paths(img_path, save_dir)
+                    future = pool.submit(
+                        self.draw_frame,
+                        img_src,
+                        det if save_img else det[:0],
+                        hide_labels,
+                        hide_conf,
+                        avg_fps if file_type == "video" else None,
+                    )
+                    post_queue.put((future, det, save_path, txt_path, file_type, vid_info))
+                pbar.update(len(frames))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            while not decoded[0]:  # NOTE 出错时取空队列, decoder 才能退出
+                decoded[0] = pre_queue.get() is None
+            post_queue.put(None)
+            saver.join()
+            pool.shutdown()
+            pbar.close()
+        if errors:
+            raise errors[0]
+
+    def preprocess_batch(self, imgs_src, color=(144, 144, 144)):
+        """Letterbox the frames and pad them at the right and bottom to the largest letterboxed shape of the batch,
+        the padding does not move the boxes so every frame is rescaled with its own letterboxed shape.
+        Returns:
+            batch: (ndarray) uint8 [B, H, W, 3] BGR, normalized on the device, None for tiled inference.
+            shapes: list of the letterboxed (h, w) of the frames.
+        """
+        if self.tile_size:
+            return None, None
+        # NOTE 静态输入尺寸的模型 (ONNX/OpenVINO) 不能用最小矩形 letterbox
+        auto = self.model.dynamic_hw
+        imgs = [letterbox(img_src, self.img_size, stride=self.stride, auto=auto)[0] for img_src in imgs_src]
+        shapes = [img.shape[:2] for img in imgs]
+        if len(set(shapes)) == 1:
+            return np.stack(imgs), shapes
+        batch = np.empty((len(imgs), max(s[0] for s in shapes), max(s[1] for s in shapes), 3), dtype=np.uint8)
+        for out, img in zip(batch, imgs):
+            h, w = img.shape[:2]
+            out[:h, :w] = img
+            out[h:], out[:h, w:] = color, color
+        return batch, shapes
+
+    def infer_batch(self, batch, shapes, imgs_src, conf_thres, iou_thres, classes, agnostic_nms, max_det):
+        """One forward of a batch from preprocess_batch (or the sliding windows of each scene for tiled inference),
+        the rotated NMS results are split back per frame.
+        Returns:
+            dets: list of (ndarray) [n, 7], [x, y, w, h, angle, conf, cls] with rounded boxes in the frame coordinates.
+        """
+        if self.tile_size:
+            dets = [self.infer_tiles(img_src, conf_thres, iou_thres, classes, agnostic_nms, max_det) for img_src in imgs_src]
+        else:
+            img = torch.from_numpy(batch).to(self.device)
+            img = img.permute(0, 3, 1, 2).flip(1)  # BHWC to BCHW, BGR to RGB
+            img = (img.half() if self.half else img.float()) / 255
+            pred_results = self.model(img)
+            if len(set(shapes)) > 1:
+                pred_results = self.drop_padding(pred_results, shapes)
+            dets = self.postprocess(pred_results, conf_thres, iou_thres, classes, agnostic_nms, max_det)
+            for det, shape, img_src in zip(dets, shapes, imgs_src):
+                if len(det):
+                    det[:, :4] = self.rescale(shape, det[:, :4], img_src.shape)
+        for i, det in enumerate(dets):
+            det[:, :4] = det[:, :4].round()
+            dets[i] = det.cpu().numpy()
+        return dets
+
+    def drop_padding(self, pred_results, shapes):
+        """Drop the predictions whose center is in the padding of preprocess_batch, i.e. outside the letterboxed shape
+        of their own frame, before the NMS so they do not take the max_det budget (End2End models: after their NMS).
+        """
+        shapes = torch.tensor(shapes, device=self.device, dtype=torch.float32)  # [B, 2] (h, w)
+        if getattr(self.model, "end2end", None):
+            return [det[(det[:, 0] < shape[1]) & (det[:, 1] < shape[0])] for det, shape in zip(pred_results, shapes)]
+        outside = (pred_results[..., 0] >= shapes[:, None, 1]) | (pred_results[..., 1] >= shapes[:, None, 0])
+        # NOTE conf 和 class scores 置 0, NMS 的 topk 按 class scores 选候选
+        scores = pred_results[..., 5:].masked_fill(outside[..., None], 0)
+        return torch.cat((pred_results[..., :5], scores), -1)
+
+    def postprocess(
+        self, pred_results, conf_thres, iou_thres, classes, agnostic_nms, max_det, nms=non_max_suppression_obb_cuda
+    ):
+        """Rotated NMS of the model outputs, End2End models already return the detections of each image, only the
+        classes filter is applied on them (the thresholds are fixed at export).
+        """
+        if not getattr(self.model, "end2end", None):
+            return nms(
+                pred_results, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det, max_candidates=self.max_candidates
+            )
+        if classes is None:
+            return pred_results
+        classes = torch.tensor(classes, device=self.device)
+        return [det[torch.isin(det[:, 6].long(), classes)] for det in pred_results]
+
+    def get_save_paths(self, img_path, save_dir):
+        """Image/video and txt (without suffix) paths of one frame."""
+        if self.webcam:
+            save_path = osp.join(save_dir, self.webcam_addr)
+            txt_path = osp.join(save_dir, self.webcam_addr)
+        else:
+            # Create output files in nested dirs that mirrors the structure of the images' dirs
+            rel_path = osp.relpath(osp.dirname(img_path), osp.dirname(self.source))
+            save_path = osp.join(save_dir, rel_path, osp.basename(img_path))  # im.jpg
+            txt_path = osp.join(save_dir, rel_path, "labels", osp.splitext(osp.basename(img_path))[0])
+            os.makedirs(osp.join(save_dir, rel_path), exist_ok=True)
+        return save_path, txt_path
+
+    @staticmethod
+    def video_info(vid_info, img_src):
+        """(fps, w, h) of the video writer, streams without capture info are saved at 30 FPS."""
+        return vid_info if vid_info else (30, img_src.shape[1], img_src.shape[0])
 
-            if self.files.type == "video":
-                self.draw_text(
-                    img_src,
-                    f"FPS: {avg_fps:0.1f}",
-                    pos=(20, 20),
-                    font_scale=1.0,
-                    text_color=(204, 85, 17),
-                    text_color_bg=(255, 255, 255),
-                    font_thickness=2,
+    @staticmethod
+    def det_lines(det):
+        """txt lines "cls x y w h angle conf" of [n, 7] detections."""
+        return "".join(("%g " * 7).rstrip() % (cls, *obb, conf) + "\n" for *obb, conf, cls in det[::-1].tolist())
+
+    def draw_frame(self, img_src, det, hide_labels, hide_conf, fps=None):
+        """Boxes of det [n, 7] (numpy, in img_src coordinates) and the FPS of videos drawn on img_src.
+        img_src is copied before drawing the boxes.
+        """
+        if len(det):
+            img_src = img_src.copy()
+            lw = max(round(sum(img_src.shape) / 2 * 0.003), 2)
+            for *obb, conf, cls in det[::-1].tolist():
+                class_num = int(cls)  # integer class
+                label = (
+                    None
+                    if hide_labels
+                    else (self.class_names[class_num] if hide_conf else f"{self.class_names[class_num]} {conf:.2f}")
                 )
+                self.plot_box_and_label(img_src, lw, obb, label, color=self.generate_colors(class_num, True))
+
+        if fps is not None:
+            self.draw_text(
+                img_src,
+                f"FPS: {fps:0.1f}",
+                pos=(20, 20),
+                font_scale=1.0,
+                text_color=(204, 85, 17),
+                text_color_bg=(255, 255, 255),
+                font_thickness=2,
+            )
+        return img_src
+
+    def infer_tiles(self, img_src, conf_thres, iou_thres, classes, agnostic_nms, max_det):
+        """Sliding window inference of one large scene.
+        Tiles of every scale are cut and resized one batch at a time from img_src, so the scene is never resized or
+        copied as a whole. The detections of each tile are mapped back to the scene on the device and merged by one
+        global rotated NMS.
+        Returns:
+            det: (tensor) [n, 7], [x, y, w, h, angle, conf, cls] in the scene coordinates.
+        """
+        tile_size = self.tile_size
+        tiles = self.generate_tiles(img_src.shape[0], img_src.shape[1], tile_size, self.tile_overlap, self.tile_scales)
+        batch = np.empty((self.tile_batch, tile_size, tile_size, 3), dtype=np.uint8)
+        dets, tile_ids, tile_params = [], [], []
+        while True:
+            batch_tiles = list(islice(tiles, self.tile_batch))
+            if not batch_tiles:
+                break
+            for i, tile in enumerate(batch_tiles):
+                tile_params.append(self.load_tile(img_src, tile, batch[i]))
+            img = torch.from_numpy(batch[: len(batch_tiles)]).to(self.device)
+            img = img.permute(0, 3, 1, 2).flip(1)  # BHWC to BCHW, BGR to RGB
+            img = (img.half() if self.half else img.float()) / 255
+            pred_results = self.model(img)
+            for det in self.postprocess(
+                pred_results, conf_thres, iou_thres, classes, agnostic_nms, max_det, nms=non_max_suppression_obb
+            ):
+                tile_ids.append(torch.full((len(det),), len(tile_ids), device=self.device, dtype=torch.long))
+                dets.append(det)
+        det, tile_ids = torch.cat(dets), torch.cat(tile_ids)
+        if not len(det):
+            return det
+
+        # NOTE tile -> scene: x / sx + x0, y / sy + y0, w, h / scale
+        tile_params = torch.tensor(tile_params, device=self.device, dtype=det.dtype)[tile_ids]
+        det[:, :2] = det[:, :2] / tile_params[:, 2:4] + tile_params[:, :2]
+        det[:, 2:4] /= tile_params[:, 4:5]
+        groups = torch.zeros_like(tile_ids) if agnostic_nms else det[:, 6].long()
+        keep = batched_nms_rotated(det[:, :5].float(), det[:, 5].float(), groups, iou_thres)[:max_det]
+        return det[keep]
 
-            if view_img:
-                if img_path not in windows:
-                    windows.append(img_path)
-                    cv2.namedWindow(
-                        str(img_path), cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO
-                    )  # allow window resize (Linux)
-                    cv2.resizeWindow(str(img_path), img_src.shape[1], img_src.shape[0])
-                cv2.imshow(str(img_path), img_src)
-                cv2.waitKey(1)  # 1 millisecond
-
-            # Save results (image with detections)
-            if save_img:
-                if self.files.type == "image":
-                    cv2.imwrite(save_path, img_src)
-                else:  # 'video' or 'stream'
-                    if vid_path != save_path:  # new video
-                        vid_path = save_path
-                        if isinstance(vid_writer, cv2.VideoWriter):
-                            vid_writer.release()  # release previous video writer
-                        if vid_cap:  # video
-                            fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                            w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                            h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                        else:  # stream
-                            fps, w, h = 30, img_ori.shape[1], img_ori.shape[0]
-                        save_path = str(Path(save_path).with_suffix(".mp4"))  # force *.mp4 suffix on results videos
-                        vid_writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (w, h))
-                    vid_writer.write(img_src)
+    @staticmethod
+    def generate_tiles(height, width, tile_size, overlap, scales=(1.0,)):
+        """Sliding windows (scale, x0, y0, x1, y1) in the scene pixels, the last window of a row/column is aligned
+        to the scene border like ImgSplit. One window covers tile_size / scale scene pixels.
+        """
+
+        def get_starts(length, window, step):
+            if length <= window:
+                return [0]
+            return list(range(0, length - window, step)) + [length - window]
+
+        for scale in scales:
+            window = max(int(round(tile_size / scale)), 1)
+            step = max(int(round((tile_size - overlap) / scale)), 1)
+            for y0 in get_starts(height, window, step):
+                for x0 in get_starts(width, window, step):
+                    yield scale, x0, y0, min(x0 + window, width), min(y0 + window, height)
+
+    @staticmethod
+    def load_tile(img_src, tile, out, color=(144, 144, 144)):
+        """Cut and resize one window into out [tile_size, tile_size, 3], padded at the right and bottom.
+        Returns:
+            (x0, y0, sx, sy, scale) to map the tile coordinates back to the scene.
+        """
+        scale, x0, y0, x1, y1 = tile
+        tile_size = out.shape[0]
+        crop = img_src[y0:y1, x0:x1]
+        w, h = min(int(round((x1 - x0) * scale)), tile_size), min(int(round((y1 - y0) * scale)), tile_size)
+        if (w, h) != (x1 - x0, y1 - y0):
+            crop = cv2.resize(crop, (w, h), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+        out[:h, :w] = crop
+        out[h:], out[:h, w:] = color, color
+        return x0, y0, w / (x1 - x0), h / (y1 - y0), scale
 
     @staticmethod
     def process_image(img_src, img_size, stride, half):
@@ -282,7 +527,7 @@ class Inferer:
         angle = int(box[4])
         rect = ((cx, cy), (w, h), angle)
         poly = cv2.boxPoints(longSideFormat2minAreaRect(rect))
-        poly = np.int0(poly)
+        poly = np.intp(poly)
         cv2.drawContours(
             image,
             contours=[poly],
@@ -363,6 +608,45 @@ class Inferer:
         return (color[2], color[1], color[0]) if bgr else color
 
 
+class ResultWriter:
+    """Saves the results of the frames in order: the txt lines of a frame are written at once and the file stays
+    open while the next frames (of a video) write to the same path, drawn frames go to images or video writers.
+    """
+
+    def __init__(self):
+        self.txt_path, self.txt_file = None, None
+        self.vid_path, self.vid_writer = None, None
+
+    def write_txt(self, txt_path, lines):
+        if txt_path != self.txt_path:
+            if self.txt_file is not None:
+                self.txt_file.close()
+            os.makedirs(osp.dirname(txt_path), exist_ok=True)
+            self.txt_path, self.txt_file = txt_path, open(txt_path + ".txt", "a")
+        self.txt_file.write(lines)
+
+    def save_frame(self, img, save_path, file_type, vid_info):
+        if file_type == "image":
+            cv2.imwrite(save_path, img)
+        else:  # 'video' or 'stream'
+            if self.vid_path != save_path:  # new video
+                self.vid_path = save_path
+                if isinstance(self.vid_writer, cv2.VideoWriter):
+                    self.vid_writer.release()  # release previous video writer
+                fps, w, h = vid_info
+                save_path = str(Path(save_path).with_suffix(".mp4"))  # force *.mp4 suffix on results videos
+                self.vid_writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (w, h))
+            self.vid_writer.write(img)
+
+    def close(self):
+        if self.txt_file is not None:
+            self.txt_file.close()
+        if isinstance(self.vid_writer, cv2.VideoWriter):
+            self.vid_writer.release()
+        self.txt_path, self.txt_file = None, None
+        self.vid_path, self.vid_writer = None, None
+
+
 class CalcFPS:
     def __init__(self, nsamples: int = 50):
         self.framerate = deque(maxlen=nsamples)
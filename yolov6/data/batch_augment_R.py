@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+# Batched OBB augments on the training device, the same augments as TrainValDataset (data_augment_R) but applied
+# to the collated uint8 batches, so the loader workers only decode and letterbox.
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+class BatchAugment:
+    """Mosaic, HSV, flips, rotation and mixup of a whole batch with tensor ops.
+
+    The probabilities and gains are the data_aug hyp of the config, as in TrainValDataset:
+        - mosaic of 4 images of the batch with probability hyp["mosaic"] (mosaic_augmentation_obb);
+        - the other images get HSV jitter, up-down / left-right flips and a random rotation (PolyRandomRotate);
+        - mixup with another image of the batch, hyp["mixup_mosaic"] for the mosaic images, hyp["mixup"] else.
+
+    Args:
+        hyp: (dict) data_aug of the config.
+    """
+
+    def __init__(self, hyp):
+        self.hyp = hyp
+
+    @torch.no_grad()
+    def __call__(self, images, targets):
+        """
+        Args:
+            images: (uint8 tensor) [B, 3, H, W], the letterboxed RGB images of the loader.
+            targets: (tensor) [n, 7], [img_idx, class_id, x, y, w, h, angle] normalized by the image size.
+        Returns:
+            images: (float tensor) [B, 3, H, W] in [0, 255].
+            targets: (tensor) [m, 7], same format.
+        """
+        batch_size, _, h, w = images.shape
+        images = images.float()
+        # NOTE 转为像素坐标, w 按图像宽归一化, h 按图像高归一化 (同 TrainValDataset)
+        targets = targets * targets.new_tensor([1, 1, w, h, w, h, 1])
+
+        is_mosaic = torch.zeros(batch_size, dtype=torch.bool, device=images.device)
+        if self.prob("mosaic") > 0:
+            is_mosaic = self.random_mask(batch_size, self.prob("mosaic"), images.device)
+            images, targets = self.mosaic(images, targets, is_mosaic.nonzero().squeeze(1))
+        # NOTE mosaic 的图像不做 general augment (同 TrainValDataset.__getitem__)
+        general = ~is_mosaic
+        if self.prob("hsv") > 0:
+            images = self.augment_hsv(images, self.select(general, self.prob("hsv")))
+        if self.prob("flipud") > 0:
+            images, targets = self.flip(images, targets, self.select(general, self.prob("flipud")), dim=2)
+        if self.prob("fliplr") > 0:
+            images, targets = self.flip(images, targets, self.select(general, self.prob("fliplr")), dim=3)
+        if self.prob("rotate") > 0:
+            images, targets = self.rotate(images, targets, self.select(general, self.prob("rotate")))
+        if self.prob("mixup") > 0 or self.prob("mixup_mosaic") > 0:
+            prob = torch.where(is_mosaic, self.prob("mixup_mosaic"), self.prob("mixup"))
+            idx = (torch.rand(batch_size, device=images.device) < prob).nonzero().squeeze(1)
+            images, targets = self.mixup(images, targets, idx)
+
+        targets[:, [2, 4]] = targets[:, [2, 4]].clip(0, w - 1e-3) / w
+        targets[:, [3, 5]] = targets[:, [3, 5]].clip(0, h - 1e-3) / h
+        return images, targets
+
+    def prob(self, key):
+        # NOTE 缺省的概率为 0, 旧的 config 没有 hsv / rotate / mixup_mosaic
+        return self.hyp.get(key, 0.0)
+
+    @staticmethod
+    def random_mask(size, prob, device):
+        return torch.rand(size, device=device) < prob
+
+    def select(self, candidates, prob):
+        """Indices of the candidate images picked with probability prob."""
+        return (candidates & self.random_mask(len(candidates), prob, candidates.device)).nonzero().squeeze(1)
+
+    def mosaic(self, images, targets, idx):
+        """Mosaic of the images idx, each with itself and 3 random images of the batch (mosaic_augmentation_obb).
+        The canvas is the image size, the mosaic center is uniform in the middle half of the canvas.
+        """
+        if not len(idx):
+            return images, targets
+        num, device = len(idx), images.device
+        batch_size, _, h, w = images.shape
+        # tiles: top left, top right, bottom left, bottom right, in random order
+        tiles = torch.cat((idx[:, None], torch.randint(0, batch_size, (num, 3), device=device)), 1)
+        tiles = tiles.gather(1, torch.rand(num, 4, device=device).argsort(1))
+        yc = (torch.rand(num, device=device) * (h // 2) + h // 4).long()
+        xc = (torch.rand(num, device=device) * (w // 2) + w // 4).long()
+        is_right = torch.tensor([0, 1, 0, 1], device=device, dtype=torch.bool)
+        is_bottom = torch.tensor([0, 0, 1, 1], device=device, dtype=torch.bool)
+        # NOTE tile 右下角对齐 mosaic 中心 (左上), 其余 tile 依次类推, 偏移 [num, 4]
+        padw = torch.where(is_right, xc[:, None], xc[:, None] - w)
+        padh = torch.where(is_bottom, yc[:, None], yc[:, None] - h)
+
+        ys = torch.arange(h, device=device)
+        xs = torch.arange(w, device=device)
+        quadrant = (ys[None, :, None] >= yc[:, None, None]).long() * 2 + (xs[None, None, :] >= xc[:, None, None])
+        mosaic = images.new_zeros((num, *images.shape[1:]))
+        for i in range(4):
+            tile = batch_roll(images[tiles[:, i]], padh[:, i], padw[:, i])
+            mosaic = torch.where((quadrant == i)[:, None], tile, mosaic)
+        images[idx] = mosaic
+
+        # labels of every (mosaic, tile) pair, kept when inside the region of the tile
+        tiles, padw, padh = tiles.flatten(), padw.flatten(), padh.flatten()
+        pair, t = (targets[None, :, 0] == tiles[:, None]).nonzero(as_tuple=True)
+        new = targets[t]
+        new[:, 0] = idx[pair // 4].to(new.dtype)
+        new[:, 2] += padw[pair]
+        new[:, 3] += padh[pair]
+        right, bottom = is_right.repeat(num)[pair], is_bottom.repeat(num)[pair]
+        x_c, y_c = xc[pair // 4], yc[pair // 4]
+        x_min, x_max = torch.where(right, x_c, 0), torch.where(right, w, x_c)
+        y_min, y_max = torch.where(bottom, y_c, 0), torch.where(bottom, h, y_c)
+        new = new[filter_box_candidates(new[:, 2:6], x_min, x_max, y_min, y_max, min_bbox_size=2)]
+
+        is_mosaic = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        is_mosaic[idx] = True
+        targets = torch.cat((targets[~is_mosaic[targets[:, 0].long()]], new), 0)
+        return images, targets
+
+    def augment_hsv(self, images, idx):
+        """HSV jitter of the images idx with random gains, the hue gain is a scale of the hue (augment_hsv)."""
+        if not len(idx):
+            return images
+        gains = torch.rand(len(idx), 3, device=images.device) * 2 - 1
+        gains = gains * gains.new_tensor([self.hyp["hsv_h"], self.hyp["hsv_s"], self.hyp["hsv_v"]]) + 1
+        hue, sat, val = rgb2hsv(images[idx]).unbind(1)
+        hue = (hue * gains[:, 0, None, None]) % 360
+        sat = (sat * gains[:, 1, None, None]).clip(0, 1)
+        val = (val * gains[:, 2, None, None]).clip(0, 255)
+        images[idx] = hsv2rgb(torch.stack((hue, sat, val), 1))
+        return images
+
+    @staticmethod
+    def flip(images, targets, idx, dim):
+        """Flip of the images idx, dim 2 up-down (RFlipVertical), dim 3 left-right (RFlipHorizontal)."""
+        if not len(idx):
+            return images, targets
+        images[idx] = images[idx].flip(dim)
+        col, size = (3, images.shape[2]) if dim == 2 else (2, images.shape[3])
+        flipped = torch.isin(targets[:, 0].long(), idx)
+        targets[flipped, col] = size - targets[flipped, col]
+        # * angle = 180 - angle, angle 180° 无定义 转到 0°
+        targets[flipped, 6] = (180 - targets[flipped, 6]) % 180
+        return images, targets
+
+    def rotate(self, images, targets, idx):
+        """Rotation of the images idx around the image center, angle uniform in [-180, 180) or a multiple of 90
+        for the images with rect_classes (PolyRandomRotate, mode "range", zero border). The boxes whose center leaves
+        the image are dropped.
+        """
+        if not len(idx):
+            return images, targets
+        batch_size, _, h, w = images.shape
+        device = images.device
+        angle = (torch.rand(len(idx), device=device) * 2 - 1) * 180
+        if self.hyp.get("rect_classes"):
+            is_rect = torch.isin(targets[:, 1], targets.new_tensor(self.hyp["rect_classes"]))
+            has_rect = torch.zeros(batch_size, dtype=torch.bool, device=device)
+            has_rect[targets[is_rect, 0].long()] = True
+            discrete = angle.new_tensor([90, 180, -90, -180])[torch.randint(0, 4, (len(idx),), device=device)]
+            angle = torch.where(has_rect[idx], discrete, angle)
+
+        # NOTE affine_grid 为输出到输入的映射, 即 cv2.getRotationMatrix2D 的逆, 坐标归一化到 [-1, 1]
+        cos, sin = torch.cos(angle * math.pi / 180), torch.sin(angle * math.pi / 180)
+        zeros = torch.zeros_like(cos)
+        theta = torch.stack((cos, -sin * h / w, zeros, sin * w / h, cos, zeros), 1).view(-1, 2, 3)
+        grid = F.affine_grid(theta, [len(idx), images.shape[1], h, w], align_corners=False)
+        images[idx] = F.grid_sample(images[idx], grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+
+        angles = torch.full((batch_size,), math.nan, device=device)
+        angles[idx] = angle
+        angle = angles[targets[:, 0].long()]
+        rotated = ~angle.isnan()
+        a = angle[rotated, None] * math.pi / 180
+        ctr = targets[rotated, 2:4] - targets.new_tensor([w / 2, h / 2])
+        targets[rotated, 2] = torch.cos(a[:, 0]) * ctr[:, 0] + torch.sin(a[:, 0]) * ctr[:, 1] + w / 2
+        targets[rotated, 3] = -torch.sin(a[:, 0]) * ctr[:, 0] + torch.cos(a[:, 0]) * ctr[:, 1] + h / 2
+        theta = (targets[rotated, 6] - angle[rotated]) % 180
+        targets[rotated, 6] = torch.where(theta >= 180, 0, theta)
+        # NOTE filter_border, 中心在图像内且边长大于 5
+        x, y, bw, bh = targets[:, 2], targets[:, 3], targets[:, 4], targets[:, 5]
+        inside = (x > 0) & (x < w) & (y > 0) & (y < h) & (bw > 5) & (bh > 5)
+        return images, targets[~rotated | inside]
+
+    @staticmethod
+    def mixup(images, targets, idx):
+        """Mixup of the images idx with random images of the batch, ratio 0.5, labels of both images (mixup)."""
+        if not len(idx):
+            return images, targets
+        other = torch.randint(0, len(images), (len(idx),), device=images.device)
+        images[idx] = images[idx] * 0.5 + images[other] * 0.5
+        pair, t = (targets[None, :, 0] == other[:, None]).nonzero(as_tuple=True)
+        new = targets[t]
+        new[:, 0] = idx[pair].to(new.dtype)
+        return images, torch.cat((targets, new), 0)
+
+
+def batch_roll(images, dy, dx):
+    """Roll every image of the batch by its own offset, out[b, :, y, x] = images[b, :, y - dy[b], x - dx[b]]."""
+    batch_size, channels, h, w = images.shape
+    rows = (torch.arange(h, device=images.device)[None] - dy[:, None]) % h
+    cols = (torch.arange(w, device=images.device)[None] - dx[:, None]) % w
+    images = images.gather(2, rows[:, None, :, None].expand(batch_size, channels, h, w))
+    return images.gather(3, cols[:, None, None, :].expand(batch_size, channels, h, w))
+
+
+def filter_box_candidates(bboxes, w_min, w_max, h_min, h_max, min_bbox_size=2, ratio=0.1):
+    """Tensor version of data_augment_R.filter_box_candidates, the region bounds may be tensors of every box."""
+    bbox_x, bbox_y, bbox_w, bbox_h = bboxes[:, 0], bboxes[:, 1], bboxes[:, 2], bboxes[:, 3]
+    ratio *= 0.5
+    return (
+        (bbox_x > w_min)
+        & (bbox_x < w_max)
+        & (bbox_y > h_min)
+        & (bbox_y < h_max)
+        & ((bbox_x + ratio * bbox_w) < w_max)
+        & ((bbox_x - ratio * bbox_w) > w_min)
+        & ((bbox_y + ratio * bbox_h) < h_max)
+        & ((bbox_y - ratio * bbox_h) > h_min)
+        & (bbox_w > min_bbox_size)
+        & (bbox_h > min_bbox_size)
+    )
+
+
+def rgb2hsv(images, eps=1e-8):
+    """[B, 3, H, W] RGB in [0, 255] to HSV, hue in [0, 360) degrees, saturation in [0, 1], value in [0, 255]."""
+    r, g, b = images.unbind(1)
+    val, argmax = images.max(1)
+    delta = val - images.min(1)[0]
+    sat = delta / val.clamp(min=eps)
+    d = delta.clamp(min=eps)
+    hue = torch.stack((((g - b) / d) % 6, (b - r) / d + 2, (r - g) / d + 4), 1).gather(1, argmax[:, None])[:, 0]
+    hue = torch.where(delta > 0, hue * 60, torch.zeros_like(hue))
+    return torch.stack((hue, sat, val), 1)
+
+
+def hsv2rgb(images):
+    """Inverse of rgb2hsv."""
+    hue, sat, val = images[:, 0:1], images[:, 1:2], images[:, 2:3]
+    n = torch.tensor([5, 3, 1], device=images.device, dtype=images.dtype).view(1, 3, 1, 1)
+    k = (n + hue / 60) % 6
+    return val - val * sat * torch.minimum(k, 4 - k).clamp(0, 1)
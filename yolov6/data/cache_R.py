@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import atexit
+import glob
+import hashlib
+import json
+import os
+import os.path as osp
+import shutil
+
+import numpy as np
+
+from yolov6.utils.events_R import LOGGER
+
+LABEL_CACHE_VERSION = 2
+# NOTE one record per found image, including the corrupt ones, so that they are not checked again
+LABEL_CACHE_ARRAYS = ("img_paths", "img_stats", "label_stats", "shapes", "img_valid", "label_valid", "labels", "offsets")
+
+
+class LabelStore:
+    """Per image label view over one contiguous [L, 6] float32 array.
+    labels of the i-th image are labels[offsets[i]:offsets[i + 1]], the returned arrays are views, so they are
+    read-only when the store is memory-mapped and have to be copied before being modified.
+    """
+
+    def __init__(self, labels, offsets, indices=None):
+        self.labels = labels
+        self.offsets = offsets
+        self.indices = indices  # optional reordering, e.g. the aspect ratio sort of rect training
+
+    def __len__(self):
+        return len(self.offsets) - 1 if self.indices is None else len(self.indices)
+
+    def __getitem__(self, index):
+        if self.indices is not None:
+            index = self.indices[index]
+        return self.labels[self.offsets[index] : self.offsets[index + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        """Number of labels of every image."""
+        lengths = np.diff(self.offsets)
+        return lengths if self.indices is None else lengths[self.indices]
+
+    def select(self, indices):
+        """New store of the images at indices, labels are not copied."""
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        return LabelStore(self.labels, self.offsets, indices)
+
+    @classmethod
+    def from_list(cls, labels_list):
+        """Pack a list of [n, 6] arrays."""
+        offsets = np.zeros(len(labels_list) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(l) for l in labels_list])
+        labels = (
+            np.concatenate(labels_list, 0).astype(np.float32)
+            if offsets[-1]
+            else np.zeros((0, 6), dtype=np.float32)
+        )
+        return cls(np.ascontiguousarray(labels.reshape(-1, 6)), offsets)
+
+    @classmethod
+    def merge(cls, store, old_indices, new_labels):
+        """Pack labels of the updated records without a python loop over the unchanged ones.
+
+        Args:
+            store: LabelStore of the old records, None if there is no old cache.
+            old_indices: [N] index of each record in store.
+            new_labels: {record index: [n, 6] array} of the re-checked records, they override store.
+        Returns:
+            LabelStore of the N records.
+        """
+        num = len(old_indices)
+        reuse = np.ones(num, dtype=bool)
+        reuse[list(new_labels)] = False
+        if store is None:
+            assert not reuse.any(), "records without new labels need an old store."
+            store = cls(np.zeros((0, 6), dtype=np.float32), np.zeros(1, dtype=np.int64))
+        src = np.asarray(old_indices, dtype=np.int64)[reuse]
+        src_start = store.offsets[src]
+        counts = np.zeros(num, dtype=np.int64)
+        counts[reuse] = store.offsets[src + 1] - src_start
+        for i, labels_per_img in new_labels.items():
+            counts[i] = len(labels_per_img)
+        offsets = np.zeros(num + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+
+        labels = np.zeros((offsets[-1], 6), dtype=np.float32)
+        reuse_counts = counts[reuse]
+        rows = np.arange(reuse_counts.sum()) - np.repeat(np.cumsum(reuse_counts) - reuse_counts, reuse_counts)
+        labels[np.repeat(offsets[:-1][reuse], reuse_counts) + rows] = store.labels[
+            np.repeat(src_start, reuse_counts) + rows
+        ]
+        for i, labels_per_img in new_labels.items():
+            labels[offsets[i] : offsets[i + 1]] = labels_per_img
+        return cls(labels, offsets)
+
+
+def get_file_stats(paths):
+    """[N, 2] int64 (mtime_ns, size) records of the files, (-1, -1) for the missing ones."""
+    stats = np.full((len(paths), 2), -1, dtype=np.int64)
+    for i, p in enumerate(paths):
+        try:
+            st = os.stat(p)
+        except OSError:
+            continue
+        stats[i] = st.st_mtime_ns, st.st_size
+    return stats
+
+
+def match_records(cached_paths, paths):
+    """Index of each path in cached_paths, -1 for the new ones."""
+    paths = np.asarray(paths, dtype=str)
+    indices = np.full(len(paths), -1, dtype=np.int64)
+    if len(cached_paths) == 0 or len(paths) == 0:
+        return indices
+    order = np.argsort(cached_paths, kind="stable")
+    sorted_paths = np.asarray(cached_paths)[order]
+    pos = np.searchsorted(sorted_paths, paths).clip(max=len(sorted_paths) - 1)
+    found = sorted_paths[pos] == paths
+    indices[found] = order[pos[found]]
+    return indices
+
+
+def save_label_cache(cache_dir, arrays, **meta):
+    """Save the label/shape cache of a split as .npy files plus a meta.json.
+
+    Args:
+        cache_dir: cache directory, e.g. images/.train_cache
+        arrays: {name: array} of LABEL_CACHE_ARRAYS, labels is a LabelStore that provides labels and offsets.
+        meta: extra json serializable records.
+    """
+    labels = arrays.pop("labels")
+    if labels.indices is not None:
+        labels = LabelStore.from_list(list(labels))
+    arrays.update(labels=labels.labels, offsets=labels.offsets)
+    assert set(arrays) == set(LABEL_CACHE_ARRAYS), f"label cache needs arrays {LABEL_CACHE_ARRAYS}."
+
+    os.makedirs(cache_dir, exist_ok=True)
+    meta_file = osp.join(cache_dir, "meta.json")
+    if osp.exists(meta_file):
+        os.remove(meta_file)  # invalidate first, the cache is only valid when meta.json is written at last
+    for name, array in arrays.items():
+        tmp_file = osp.join(cache_dir, name + ".tmp.npy")
+        np.save(tmp_file, np.ascontiguousarray(array))
+        os.replace(tmp_file, osp.join(cache_dir, name + ".npy"))
+    meta.update(version=LABEL_CACHE_VERSION, num_images=len(arrays["img_paths"]), num_labels=len(arrays["labels"]))
+    with open(meta_file, "w") as f:
+        json.dump(meta, f)
+
+
+def load_label_cache(cache_dir, mmap_mode="r"):
+    """Load the label/shape cache, arrays are memory-mapped read-only so dataloader workers share the pages.
+
+    Returns:
+        dict with meta records, LABEL_CACHE_ARRAYS and labels (LabelStore), None if no valid cache.
+    """
+    meta_file = osp.join(cache_dir, "meta.json")
+    if not osp.exists(meta_file):
+        return None
+    try:
+        with open(meta_file, "r") as f:
+            cache = json.load(f)
+        assert cache.get("version") == LABEL_CACHE_VERSION, "cache version mismatch"
+        for name in LABEL_CACHE_ARRAYS:
+            cache[name] = np.load(osp.join(cache_dir, name + ".npy"), mmap_mode=mmap_mode)
+        num_images, num_labels = cache["num_images"], cache["num_labels"]
+        assert all(len(cache[name]) == num_images for name in LABEL_CACHE_ARRAYS[:-2]), "records length mismatch"
+        assert len(cache["offsets"]) == num_images + 1 and cache["offsets"][-1] == len(cache["labels"]) == num_labels
+    except Exception as e:
+        LOGGER.warning(f"WARNING: ignoring invalid label cache {cache_dir}: {e}")
+        return None
+    cache["labels"] = LabelStore(cache["labels"], cache.pop("offsets"))
+    return cache
+
+
+class ImageCache:
+    """LRU cache of decoded and resized uint8 images with a byte budget, one .npy file per image.
+
+    mode "disk": files are kept in cache_dir on the local disk and reused by the next runs.
+    mode "ram": files are kept in shared memory (/dev/shm) and removed at exit.
+    The ranks of a DDP run share one cache_dir and one budget: local rank 0 (rank -1/0) creates it first, clears the
+    counters of the last run and removes the ram cache at exit, the other ranks are expected to wait for it (the
+    dataset is built under torch_distributed_zero_first).
+    Images are loaded memory-mapped read-only, so dataloader workers share them through the page cache. The LRU order
+    is the mtime of the files, which is refreshed on every hit. Every process counts its hits/misses in its own
+    counters.<pid>.npy file, so no counter is written by two workers, and the files are summed by summary().
+    """
+
+    COUNTERS = "counters"
+
+    def __init__(self, cache_dir, max_bytes, mode="disk", rank=-1):
+        assert mode in ("ram", "disk"), f"Not supported image cache mode: {mode}"
+        self.mode = mode
+        main_process = rank in (-1, 0)
+        if mode == "ram":
+            # NOTE 同一次 DDP 训练的各 rank 共用一个目录, 并发的训练按 MASTER_PORT 区分
+            run_id = os.getpid() if rank == -1 else os.getenv("MASTER_PORT", "")
+            key = hashlib.md5(f"{osp.abspath(cache_dir)}_{run_id}".encode()).hexdigest()[:8]
+            cache_dir = osp.join("/dev/shm", f"yolov6_R{osp.basename(cache_dir.rstrip(os.sep))}_{key}")
+            if main_process:
+                shutil.rmtree(cache_dir, ignore_errors=True)  # left by a killed run
+        os.makedirs(cache_dir, exist_ok=True)
+        free_bytes = shutil.disk_usage(cache_dir).free + self.get_size(cache_dir)
+        if max_bytes > free_bytes:
+            LOGGER.warning(
+                f"WARNING: image cache budget {max_bytes / 1e9:.1f}GB > {free_bytes / 1e9:.1f}GB free in {cache_dir}, "
+                f"using the free size instead."
+            )
+            max_bytes = free_bytes
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self.new_bytes = 0  # bytes written by this process since the last eviction scan
+        self.counters, self.counters_pid = None, None
+        if main_process:
+            for counters_file in glob.glob(osp.join(cache_dir, f"{self.COUNTERS}.*.npy")):  # counts of the last run
+                os.remove(counters_file)
+            if mode == "ram":
+                atexit.register(shutil.rmtree, cache_dir, True)
+        self.evict()  # NOTE the budget may be smaller than that of the last run
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["counters"], state["counters_pid"] = None, None  # NOTE memmap can not be pickled to spawned workers
+        return state
+
+    def count(self, i):
+        """Add one hit (i = 0) or miss (i = 1) to the counters of this process."""
+        pid = os.getpid()
+        if self.counters_pid != pid:  # NOTE fork 出的 worker 继承了父进程的 memmap, 按 pid 重新打开
+            counters_file = osp.join(self.cache_dir, f"{self.COUNTERS}.{pid}.npy")
+            if not osp.exists(counters_file):
+                np.save(counters_file, np.zeros(2, dtype=np.int64))  # hits, misses
+            self.counters, self.counters_pid = np.load(counters_file, mmap_mode="r+"), pid
+        self.counters[i] += 1
+
+    @staticmethod
+    def get_key(*args):
+        """Cache key of an image, e.g. path, file stats and the resize setting."""
+        return hashlib.md5("_".join(str(x) for x in args).encode()).hexdigest()
+
+    def get(self, key):
+        """Memory-mapped read-only image, None if not cached."""
+        cache_file = osp.join(self.cache_dir, key + ".npy")
+        try:
+            im = np.load(cache_file, mmap_mode="r")
+            os.utime(cache_file)  # NOTE refresh LRU order
+        except (OSError, ValueError):  # not cached or evicted by another worker
+            self.count(1)
+            return None
+        self.count(0)
+        return im
+
+    def put(self, key, im):
+        if im.nbytes > self.max_bytes:
+            return
+        cache_file = osp.join(self.cache_dir, key + ".npy")
+        tmp_file = osp.join(self.cache_dir, f"{key}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_file, "wb") as f:
+                np.save(f, np.ascontiguousarray(im))
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            if not osp.isdir(self.cache_dir):  # removed at exit
+                return
+            LOGGER.warning(f"WARNING: failed to cache image in {self.cache_dir}: {e}")
+            if osp.exists(tmp_file):
+                os.remove(tmp_file)
+            return
+        self.new_bytes += im.nbytes
+        if self.new_bytes > self.max_bytes // 20:  # NOTE 每写入 5% 预算扫描一次目录
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used images until the cache is below 90% of the budget."""
+        self.new_bytes = 0
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".npy") or entry.name.startswith(self.COUNTERS):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:  # removed by another worker
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        total = sum(x[1] for x in entries)
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(entries):
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    @staticmethod
+    def get_size(cache_dir):
+        return sum(e.stat().st_size for e in os.scandir(cache_dir) if e.is_file()) if osp.isdir(cache_dir) else 0
+
+    def summary(self):
+        hits, misses = 0, 0
+        for counters_file in glob.glob(osp.join(self.cache_dir, f"{self.COUNTERS}.*.npy")):
+            try:
+                counters = np.load(counters_file)
+            except (OSError, ValueError):  # being created by a new worker
+                continue
+            hits, misses = hits + int(counters[0]), misses + int(counters[1])
+        return (
+            f"image cache ({self.mode}) {hits} hit(s), {misses} miss(es), "
+            f"hit rate {hits / max(hits + misses, 1):.1%}, {self.get_size(self.cache_dir) / 1e9:.2f}/"
+            f"{self.max_bytes / 1e9:.2f}GB"
+        )
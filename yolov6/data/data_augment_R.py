@@ -245,7 +245,7 @@ def poly2obb_np_le180(poly):
         obbs (ndarray): [x_ctr,y_ctr,w,h,angle]
     """
     bboxps = np.array(poly).reshape((4, 2))
-    rbbox = cv2.minAreaRect(np.int0(bboxps))
+    rbbox = cv2.minAreaRect(np.intp(bboxps))
     x, y, width, height, theta = rbbox[0][0], rbbox[0][1], rbbox[1][0], rbbox[1][1], rbbox[2]
     longSide = max(width, height)
     shortSide = min(width, height)
@@ -279,6 +279,34 @@ def poly2obb_np_le180(poly):
     return x, y, longSide, shortSide, theta
 
 
+def polys2obbs_np_le180(polys):
+    """Vectorized poly2obb_np_le180 for rectangles, closed form instead of cv2.minAreaRect.
+
+    Args:
+        polys (ndarray): [N, 8], [x0,y0,x1,y1,x2,y2,x3,y3] in any vertex order along the contour.
+
+    Returns:
+        obbs (ndarray): [N, 5], [x_ctr,y_ctr,longSide,shortSide,angle] angle∈[0, 180), the rows of boxes with a side
+            less than 2 are zeros like the None of poly2obb_np_le180.
+    """
+    points = np.asarray(polys, dtype=np.float64).reshape(-1, 4, 2)
+    center = points.mean(1)
+    # NOTE 对边取平均, 一般四边形也可以
+    vector1 = (points[:, 1] - points[:, 0] + points[:, 2] - points[:, 3]) / 2.0
+    vector2 = (points[:, 3] - points[:, 0] + points[:, 2] - points[:, 1]) / 2.0
+    side1, side2 = np.linalg.norm(vector1, axis=-1), np.linalg.norm(vector2, axis=-1)
+    longSide, shortSide = np.maximum(side1, side2), np.minimum(side1, side2)
+    vector = np.where((side1 >= side2)[:, None], vector1, vector2)
+    theta = np.degrees(np.arctan2(vector[:, 1], vector[:, 0])) % 180.0
+    # * 正方形 minAreaRect 给出 [0, 90) 的角度
+    is_square = np.around(longSide, 2) == np.around(shortSide, 2)
+    theta = np.where(is_square, theta % 90.0, theta)
+    theta[theta >= 180.0] = 0.0  # float rounding of % 180
+    obbs = np.stack((center[:, 0], center[:, 1], longSide, shortSide, theta), axis=-1)
+    obbs[shortSide < 2] = 0
+    return obbs
+
+
 class PolyRandomRotate(object):
     """Rotate img & bbox.
     Reference: https://github.com/hukaixuan19970627/OrientedRepPoints_DOTA
@@ -373,6 +401,7 @@ class PolyRandomRotate(object):
 
     def __call__(self, img, labels):
         """Call function of PolyRandomRotate."""
+        class_labels = labels[..., 0:1]
         if not self.is_rotate:
             # results["rotate"] = False
             angle = 0
@@ -384,13 +413,9 @@ class PolyRandomRotate(object):
                 i = np.random.randint(len(self.angles_range))
                 angle = self.angles_range[i]
 
-            class_labels = labels[..., 0:1]
-            for classid in class_labels:
-                if self.rect_classes:
-                    if classid in self.rect_classes:
-                        np.random.shuffle(self.discrete_range)
-                        angle = self.discrete_range[0]
-                        break
+            if self.rect_classes and np.isin(class_labels, self.rect_classes).any():
+                np.random.shuffle(self.discrete_range)
+                angle = self.discrete_range[0]
 
         # h, w, c = results["img_shape"]
         h, w, c = img.shape
@@ -407,7 +432,6 @@ class PolyRandomRotate(object):
         self.rm_coords = self.create_rotation_matrix(image_center, angle, bound_h, bound_w)
         self.rm_image = self.create_rotation_matrix(image_center, angle, bound_h, bound_w, offset=-0.5)
 
-        ori_img = img.copy()
         img = self.apply_image(img, bound_h, bound_w)
         # results["img"] = img
         # results["img_shape"] = (bound_h, bound_w, c)
@@ -419,12 +443,7 @@ class PolyRandomRotate(object):
             # gt_bboxes = np.concatenate([gt_bboxes, np.zeros((gt_bboxes.shape[0], 1))], axis=-1)
             polys = obb2poly_bp_le180(gt_bboxes).reshape(-1, 2)
             polys = self.apply_coords(polys).reshape(-1, 8)
-            gt_bboxes = []
-            for pt in polys:
-                pt = np.array(pt, dtype=np.float32)
-                obb = poly2obb_np_le180(pt) if poly2obb_np_le180(pt) is not None else [0, 0, 0, 0, 0]
-                gt_bboxes.append(obb)
-            gt_bboxes = np.array(gt_bboxes, dtype=np.float32)
+            gt_bboxes = polys2obbs_np_le180(polys).astype(np.float32)
             keep_inds = self.filter_border(gt_bboxes, bound_h, bound_w)
             gt_bboxes = gt_bboxes[keep_inds, :]
             class_labels = class_labels[keep_inds]
@@ -747,29 +766,38 @@ def mosaic_augmentation(img_size, imgs, hs, ws, labels, hyp):
 
 
 def mosaic_augmentation_obb(img_size, imgs, hs, ws, labels, hyp):
-    """Applies Mosaic augmentation."""
+    """Applies Mosaic augmentation.
+    The four images are cropped into the quadrants of an img_size canvas around a random mosaic center, the images
+    are loaded at img_size already, so the mosaic is composed at the target resolution without a final resize.
+    """
     # NOTE mosaic 对遥感场景尺度变化影响很大, 需要修改
     assert len(imgs) == 4, "Mosaic augmentation of current version only supports 4 images."
 
     labels4 = []
     s = img_size // 2
     yc, xc = (int(random.uniform(s // 2, 3 * s // 2)) for _ in range(2))  # mosaic center x, y
+    # NOTE 四张图覆盖各自象限时不需要填充 114
+    covered = ws[0] >= xc and hs[0] >= yc and ws[1] >= img_size - xc and hs[1] >= yc
+    covered = covered and ws[2] >= xc and hs[2] >= img_size - yc and ws[3] >= img_size - xc and hs[3] >= img_size - yc
+    if covered:
+        img4 = np.empty((img_size, img_size, imgs[0].shape[2]), dtype=np.uint8)
+    else:
+        img4 = np.full((img_size, img_size, imgs[0].shape[2]), 114, dtype=np.uint8)
     for i in range(len(imgs)):
         # Load image
         img, h, w = imgs[i], hs[i], ws[i]
         # place img in img4
         if i == 0:  # top left
-            img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
             x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
             x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
         elif i == 1:  # top right
-            x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, s * 2), yc
+            x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, img_size), yc
             x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
         elif i == 2:  # bottom left
-            x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(s * 2, yc + h)
+            x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(img_size, yc + h)
             x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
         elif i == 3:  # bottom right
-            x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
+            x1a, y1a, x2a, y2a = xc, yc, min(xc + w, img_size), min(img_size, yc + h)
             x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
 
         img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
@@ -798,7 +826,6 @@ def mosaic_augmentation_obb(img_size, imgs, hs, ws, labels, hyp):
     labels4 = np.concatenate(labels4, 0)
 
     # NOTE 不做affine,一个是label不好调整, 另一个参考mmyolo的RTM, affine会造成影响
-    # NOTE img5, labels4 需要重新resize
     # img4, labels4 = random_affine(img4, labels4,
     #                               degrees=hyp['degrees'],
     #                               translate=hyp['translate'],
@@ -806,9 +833,6 @@ def mosaic_augmentation_obb(img_size, imgs, hs, ws, labels, hyp):
     #                               shear=hyp['shear'],
     #                               new_shape=(img_size, img_size))
 
-    img4 = cv2.resize(img4, (img_size, img_size))
-    # labels4[:, 1:5] /= 2.0
-
     return img4, labels4
 
 
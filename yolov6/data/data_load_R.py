@@ -4,9 +4,12 @@
 # https://github.com/ultralytics/yolov5/blob/master/utils/dataloaders.py
 
 import os
+
+import numpy as np
 from torch.utils.data import dataloader, distributed
 
 from .datasets_R import TrainValDataset
+from .slab_R import BatchSlab, SlabDataset, SlotSampler
 from yolov6.utils.events_R import LOGGER
 from yolov6.utils.torch_utils import torch_distributed_zero_first
 
@@ -27,8 +30,13 @@ def create_dataloader(
     shuffle=False,
     data_dict=None,
     task="Train",
+    cache_images=None,
+    cache_bytes=16e9,
+    batch_augment=False,
+    batch_slab=False,
 ):
     """Create general dataloader.
+    batch_slab: the workers write the batches into a shared memory ring (BatchSlab) instead of collating them.
 
     Returns dataloader and dataset
     """
@@ -52,6 +60,9 @@ def create_dataloader(
             rank=rank,
             data_dict=data_dict,
             task=task,
+            cache_images=cache_images,
+            cache_bytes=cache_bytes,
+            batch_augment=batch_augment,
         )
 
     batch_size = min(batch_size, len(dataset))
@@ -65,6 +76,27 @@ def create_dataloader(
     sampler = (
         None if rank == -1 else distributed.DistributedSampler(dataset, shuffle=shuffle)
     )
+    if batch_slab:
+        assert not rect, "batch slab needs images of the same shape, not supported with --rect."
+        # NOTE 在途 batch 数 workers * prefetch_factor(2), 另留 3 个给正在使用和拷贝到设备的 batch
+        num_slots = workers * 2 + 3
+        lengths = dataset.labels.lengths()
+        max_labels = int(lengths.max()) if len(lengths) else 0
+        # NOTE mosaic + mixup 最多 8 张图的 labels, 超出容量的 batch 走 worker 队列
+        slab = BatchSlab(num_slots, batch_size, (3, img_size, img_size), batch_size * min(8 * max_labels, 512))
+        return (
+            TrainValDataLoader(
+                SlabDataset(dataset, slab),
+                batch_size=batch_size,
+                shuffle=shuffle and sampler is None,
+                num_workers=workers,
+                sampler=sampler,
+                pin_memory=False,
+                collate_fn=SlabDataset.collate_fn,
+                slab=slab,
+            ),
+            dataset,
+        )
     return (
         TrainValDataLoader(
             dataset,
@@ -85,9 +117,13 @@ class TrainValDataLoader(dataloader.DataLoader):
     Uses same syntax as vanilla DataLoader
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, slab=None, **kwargs):
         super().__init__(*args, **kwargs)
-        object.__setattr__(self, "batch_sampler", _RepeatSampler(self.batch_sampler))
+        self.slab = slab
+        batch_sampler = _RepeatSampler(self.batch_sampler)
+        if slab is not None:
+            batch_sampler = SlotSampler(batch_sampler, slab.num_slots)
+        object.__setattr__(self, "batch_sampler", batch_sampler)
         self.iterator = super().__iter__()
 
     def __len__(self):
@@ -95,7 +131,13 @@ class TrainValDataLoader(dataloader.DataLoader):
 
     def __iter__(self):
         for i in range(len(self)):
-            yield next(self.iterator)
+            if self.slab is None:
+                yield next(self.iterator)
+                continue
+            # NOTE next 会派发新的 batch, 其 slot 之前的 batch 需已拷贝到设备
+            self.slab.wait(in_flight=2)
+            yield self.slab.unpack(next(self.iterator))
+            self.slab.record()
 
 
 class _RepeatSampler:
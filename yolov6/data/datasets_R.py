@@ -21,7 +21,11 @@ from torch.utils.data import Dataset
 from tqdm import tqdm
 
 from yolov6.utils.events_R import LOGGER
+from yolov6.utils.nms_R import rbox2poly
 
+from .cache_R import (ImageCache, LabelStore, get_file_stats,
+                      load_label_cache, match_records, save_label_cache)
+from .shards_R import ShardReader
 from .data_augment_R import (RFlipHorizontal, RFlipVertical, RRotate,
                              augment_hsv, letterbox, mixup,
                              mosaic_augmentation_obb, random_affine, PolyRandomRotate, plot_single_obb_img_test)
@@ -57,6 +61,9 @@ class TrainValDataset(Dataset):
         rank=-1,
         data_dict=None,
         task="train",
+        cache_images=None,
+        cache_bytes=16e9,
+        batch_augment=False,
     ):
         assert task.lower() in ("train", "val", "test", "speed"), f"Not supported task: {task}"
         t1 = time.time()
@@ -64,11 +71,19 @@ class TrainValDataset(Dataset):
         self.main_process = self.rank in (-1, 0)
         self.task = self.task.capitalize()
         self.class_names = data_dict["names"]
+        self.shards = None
         self.img_paths, self.labels = self.get_imgs_labels(self.img_dir)  # TODO, check this
         self.augment = augment
+        # NOTE batch_augment: mosaic / mixup / general augment 在训练设备上按 batch 做 (BatchAugment), 这里只加载
+        self.sample_augment = augment and not batch_augment
+        self.img_cache = None
+        if cache_images:
+            # NOTE 缓存 resize 后的 uint8 图像, ram: /dev/shm, disk: images/.train_img_cache
+            cache_dir = osp.join(osp.dirname(img_dir), "." + osp.basename(img_dir) + "_img_cache")
+            self.img_cache = ImageCache(cache_dir, cache_bytes, mode=cache_images, rank=rank)
 
         if self.rect:
-            shapes = [self.img_info[p]["shape"] for p in self.img_paths]
+            shapes = self.img_shapes
             self.shapes = np.array(shapes, dtype=np.float64)
             self.batch_indices = np.floor(np.arange(len(shapes)) / self.batch_size).astype(
                 np.int_
@@ -89,8 +104,18 @@ class TrainValDataset(Dataset):
         This function applies mosaic and mixup augments during training.
         During validation, letterbox augment is applied.
         """
+        img, labels_out, path, shapes = self.get_sample(index)
+
+        # Convert
+        img = img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+        img = np.ascontiguousarray(img)
+
+        return torch.from_numpy(img), labels_out, path, shapes
+
+    def get_sample(self, index):
+        """Augmented HWC BGR image and labels_out of a sample, __getitem__ without the CHW / RGB conversion."""
         # Mosaic Augmentation
-        if self.augment and random.random() < self.hyp["mosaic"]:
+        if self.sample_augment and random.random() < self.hyp["mosaic"]:
             img, labels = self.get_mosaic_obb(index)  # NOTE get_mosaic_obb 现在不可使用,还有问题
             shapes = None
             # test_img = plot_single_obb_img_test(img.copy(), labels.copy())
@@ -103,7 +128,7 @@ class TrainValDataset(Dataset):
             #     img, labels = self.general_augment(img, labels)
         else:
             img, labels, shapes = self.get_general_obb(index)
-            if self.augment and random.random() < self.hyp["mixup"] :
+            if self.sample_augment and random.random() < self.hyp["mixup"] :
                 shapes = None
                 img_other, labels_other, _ = self.get_general_obb(random.randint(0, len(self.img_paths) - 1))
                 img, labels = mixup(img, labels, img_other, labels_other)
@@ -127,11 +152,7 @@ class TrainValDataset(Dataset):
         if len(labels):
             labels_out[:, 1:] = torch.from_numpy(labels)
 
-        # Convert
-        img = img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
-        img = np.ascontiguousarray(img)
-
-        return torch.from_numpy(img), labels_out, self.img_paths[index], shapes
+        return img, labels_out, self.img_paths[index], shapes
 
     def load_image(self, index, force_load_size=None):
         """Load image.
@@ -141,24 +162,35 @@ class TrainValDataset(Dataset):
             Image, original shape of image, resized image shape
         """
         path = self.img_paths[index]
-        try:
-            im = cv2.imread(path)
-            assert im is not None, f"opencv cannot read image correctly or {path} not exists"
-        except:
-            im = cv2.cvtColor(np.asarray(Image.open(path)), cv2.COLOR_RGB2BGR)
-            assert im is not None, f"Image Not Found {path}, workdir: {os.getcwd()}"
+        load_size = force_load_size if force_load_size else self.img_size
+        if self.img_cache is not None:
+            key = self.img_cache.get_key(path, *self.img_stats[index], load_size, self.augment)
+            im = self.img_cache.get(key)  # NOTE 只读 memmap
+            if im is not None:
+                w0, h0 = self.img_shapes[index]
+                return im, (int(h0), int(w0)), im.shape[:2]
+        if self.shards is not None:
+            im = self.shards.read(path)
+            assert im is not None, f"opencv cannot decode {path} from {self.img_dir}"
+        else:
+            try:
+                im = cv2.imread(path)
+                assert im is not None, f"opencv cannot read image correctly or {path} not exists"
+            except:
+                im = cv2.cvtColor(np.asarray(Image.open(path)), cv2.COLOR_RGB2BGR)
+                assert im is not None, f"Image Not Found {path}, workdir: {os.getcwd()}"
 
         h0, w0 = im.shape[:2]  # origin shape
-        if force_load_size:
-            r = force_load_size / max(h0, w0)
-        else:
-            r = self.img_size / max(h0, w0)
+        r = load_size / max(h0, w0)
         if r != 1:
             im = cv2.resize(
                 im,
                 (int(w0 * r), int(h0 * r)),
                 interpolation=cv2.INTER_AREA if r < 1 and not self.augment else cv2.INTER_LINEAR,
             )
+        # NOTE 原图尺寸从 img_shapes 读取, 不一致时(exif)不缓存
+        if self.img_cache is not None and tuple(self.img_shapes[index]) == (w0, h0):
+            self.img_cache.put(key, im)
         return im, (h0, w0), im.shape[:2]
 
     @staticmethod
@@ -170,52 +202,45 @@ class TrainValDataset(Dataset):
         return torch.stack(img, 0), torch.cat(label, 0), path, shapes
 
     def get_imgs_labels(self, img_dir):
+        assert osp.exists(img_dir), f"{img_dir} is an invalid directory path!"
+        if osp.isfile(img_dir):
+            # NOTE DOTA split shards/index.json of ImgSplit_multi_process out_format='shards'
+            self.shards = ShardReader(img_dir)
+            cache_info = self.shards.get_records(self.class_names, save_cache=self.main_process)
+        else:
+            cache_info = self.get_file_records(img_dir)
 
-        # TODO check labels
+        if self.task.lower() == "val":
+            if self.data_dict.get("is_coco", False):  # use original json file when evaluating on coco dataset.
+                assert osp.exists(
+                    self.data_dict["anno_path"]
+                ), "Eval on coco dataset must provide valid path of the annotation file in config file: data/coco.yaml"
+            else:
+                assert self.class_names, "Class names is required when converting labels to coco format for evaluating."
+                save_dir = osp.join(osp.dirname(osp.dirname(img_dir)), "annotations")
+                if not osp.exists(save_dir):
+                    os.mkdir(save_dir)
+                save_path = osp.join(save_dir, "instances_" + osp.basename(img_dir) + ".json")
+                TrainValDataset.generate_coco_format_labels(
+                    cache_info["img_paths"], cache_info["shapes"], cache_info["labels"], self.class_names, save_path
+                )
+        # NOTE img_paths [N] str, shapes [N, 2] (w, h), labels LabelStore 基于只读 memmap, worker 之间共享
+        img_paths, labels = cache_info["img_paths"], cache_info["labels"]
+        self.img_shapes = cache_info["shapes"]
+        self.img_stats = cache_info["img_stats"]
+        LOGGER.info(f"{self.task}: Final numbers of valid images: {len(img_paths)}/ labels: {len(labels)}. ")
+        return img_paths, labels
 
-        assert osp.exists(img_dir), f"{img_dir} is an invalid directory path!"
-        # '/home/haohao/HRSC2016_new/images/.train.json'
-        valid_img_record = osp.join(osp.dirname(img_dir), "." + osp.basename(img_dir) + ".json")
+    def get_file_records(self, img_dir):
+        """Image/label records of an image dir, checked incrementally against the binary label cache."""
+        # NOTE binary cache '/home/haohao/HRSC2016_new/images/.train_cache/{img_paths,shapes,labels,...}.npy'
+        cache_dir = osp.join(osp.dirname(img_dir), "." + osp.basename(img_dir) + "_cache")
         NUM_THREADS = min(8, os.cpu_count())
 
         img_paths = glob.glob(osp.join(img_dir, "**/*"), recursive=True)  # NOTE 查找所有 img_path
         img_paths = sorted(p for p in img_paths if p.split(".")[-1].lower() in IMG_FORMATS and os.path.isfile(p))
         assert img_paths, f"No images found in {img_dir}."
 
-        img_hash = self.get_hash(img_paths)
-        if osp.exists(valid_img_record):
-            with open(valid_img_record, "r") as f:
-                cache_info = json.load(f)
-                if "image_hash" in cache_info and cache_info["image_hash"] == img_hash:
-                    img_info = cache_info["information"]
-                else:
-                    self.check_images = True
-        else:
-            self.check_images = True
-
-        # check images
-        if self.check_images and self.main_process:
-            img_info = {}
-            nc, msgs = 0, []  # number corrupt, messages
-            LOGGER.info(f"{self.task}: Checking formats of images with {NUM_THREADS} process(es): ")
-            with Pool(NUM_THREADS) as pool:
-                pbar = tqdm(pool.imap(TrainValDataset.check_image, img_paths), total=len(img_paths),)
-                for img_path, shape_per_img, nc_per_img, msg in pbar:
-                    if nc_per_img == 0:  # not corrupted
-                        img_info[img_path] = {"shape": shape_per_img}
-                    nc += nc_per_img
-                    if msg:
-                        msgs.append(msg)
-                    pbar.desc = f"{nc} image(s) corrupted"
-            pbar.close()
-            if msgs:
-                LOGGER.info("\n".join(msgs))
-
-            cache_info = {"information": img_info, "image_hash": img_hash}
-            # save valid image paths.
-            with open(valid_img_record, "w") as f:
-                json.dump(cache_info, f)
-
         # check and load anns
         base_dir = osp.basename(img_dir)
         if base_dir != "":
@@ -234,27 +259,77 @@ class TrainValDataset(Dataset):
             rel_path = osp.relpath(full_path, base_path)
             return osp.join(osp.dirname(rel_path), osp.splitext(osp.basename(rel_path))[0] + new_ext)
 
-        img_paths = list(img_info.keys())
-        label_paths = sorted(osp.join(label_dir, _new_rel_path_with_ext(img_dir, p, ".txt")) for p in img_paths)
+        # NOTE label_paths 与 img_paths 一一对应, 不能单独排序
+        label_paths = [osp.join(label_dir, _new_rel_path_with_ext(img_dir, p, ".txt")) for p in img_paths]
         assert label_paths, f"No labels found in {label_dir}."
-        label_hash = self.get_hash(label_paths)
-        if "label_hash" not in cache_info or cache_info["label_hash"] != label_hash:
-            self.check_labels = True
 
+        # NOTE 每个文件一条 (path, mtime, size) 记录, 只检查新增或修改过的 images/labels
+        num_imgs = len(img_paths)
+        img_stats, label_stats = get_file_stats(img_paths), get_file_stats(label_paths)
+        cache_info = load_label_cache(cache_dir)
+        old_indices = np.full(num_imgs, -1, dtype=np.int64)
+        if cache_info is not None:
+            old_indices = match_records(cache_info["img_paths"], img_paths)
+        found = old_indices >= 0
+        img_changed, label_changed = ~found, ~found
+        if found.any():
+            img_changed[found] = (cache_info["img_stats"][old_indices[found]] != img_stats[found]).any(1)
+            label_changed[found] = (cache_info["label_stats"][old_indices[found]] != label_stats[found]).any(1)
+        if self.check_images:
+            img_changed[:] = True
         if self.check_labels:
-            cache_info["label_hash"] = label_hash
+            label_changed[:] = True
+
+        shapes = np.zeros((num_imgs, 2), dtype=np.int64)
+        img_valid, label_valid = np.zeros(num_imgs, dtype=bool), np.zeros(num_imgs, dtype=bool)
+        if found.any():
+            shapes[found] = cache_info["shapes"][old_indices[found]]
+            img_valid[found] = cache_info["img_valid"][old_indices[found]]
+            label_valid[found] = cache_info["label_valid"][old_indices[found]]
+        num_removed = len(cache_info["img_paths"]) - found.sum() if cache_info is not None else 0
+        if self.main_process and cache_info is not None:
+            LOGGER.info(
+                f"{self.task}: {found.sum()} cached record(s), {(~found).sum()} new, {num_removed} removed, "
+                f"{img_changed.sum()} image(s) and {label_changed.sum()} label(s) to check."
+            )
+
+        # check images
+        check_indices = np.nonzero(img_changed)[0]
+        if len(check_indices):
+            nc, msgs = 0, []  # number corrupt, messages
+            LOGGER.info(f"{self.task}: Checking formats of images with {NUM_THREADS} process(es): ")
+            with Pool(NUM_THREADS) as pool:
+                pbar = pool.imap(TrainValDataset.check_image, [img_paths[i] for i in check_indices])
+                pbar = tqdm(pbar, total=len(check_indices)) if self.main_process else pbar
+                for i, (img_path, shape_per_img, nc_per_img, msg) in zip(check_indices, pbar):
+                    img_valid[i] = nc_per_img == 0  # not corrupted
+                    shapes[i] = shape_per_img if nc_per_img == 0 else (0, 0)
+                    nc += nc_per_img
+                    if msg:
+                        msgs.append(msg)
+                    if self.main_process:
+                        pbar.desc = f"{nc} image(s) corrupted"
+            if self.main_process:
+                pbar.close()
+            if msgs:
+                LOGGER.info("\n".join(msgs))
+
+        # check labels
+        check_indices = np.nonzero(label_changed)[0]
+        new_labels = {}
+        if len(check_indices):
             nm, nf, ne, nc, msgs = 0, 0, 0, 0, []  # number corrupt, messages
             LOGGER.info(f"{self.task}: Checking formats of labels with {NUM_THREADS} process(es): ")
             with Pool(NUM_THREADS) as pool:
                 pbar = pool.imap(
-                    TrainValDataset.check_label_files, zip(img_paths, label_paths)
+                    TrainValDataset.check_label_files, [(img_paths[i], label_paths[i]) for i in check_indices]
                 )  # NOTE 线程, check_label_files
-                pbar = tqdm(pbar, total=len(label_paths)) if self.main_process else pbar
-                for (img_path, labels_per_file, nc_per_file, nm_per_file, nf_per_file, ne_per_file, msg,) in pbar:
-                    if nc_per_file == 0:
-                        img_info[img_path]["labels"] = labels_per_file
-                    else:
-                        img_info.pop(img_path)
+                pbar = tqdm(pbar, total=len(check_indices)) if self.main_process else pbar
+                for i, (img_path, labels_per_file, nc_per_file, nm_per_file, nf_per_file, ne_per_file, msg,) in zip(
+                    check_indices, pbar
+                ):
+                    label_valid[i] = nc_per_file == 0
+                    new_labels[i] = labels_per_file if nc_per_file == 0 else np.zeros((0, 6), dtype=np.float32)
                     nc += nc_per_file
                     nm += nm_per_file
                     nf += nf_per_file
@@ -267,41 +342,36 @@ class TrainValDataset(Dataset):
                         )
             if self.main_process:
                 pbar.close()
-                with open(valid_img_record, "w") as f:
-                    json.dump(cache_info, f)
             if msgs:
                 LOGGER.info("\n".join(msgs))
-            if nf == 0:
+            if nf == 0 and len(check_indices) == num_imgs:
                 LOGGER.warning(f"WARNING: No labels found in {osp.dirname(img_paths[0])}. ")
 
-        if self.task.lower() == "val":
-            if self.data_dict.get("is_coco", False):  # use original json file when evaluating on coco dataset.
-                assert osp.exists(
-                    self.data_dict["anno_path"]
-                ), "Eval on coco dataset must provide valid path of the annotation file in config file: data/coco.yaml"
-            else:
-                assert self.class_names, "Class names is required when converting labels to coco format for evaluating."
-                save_dir = osp.join(osp.dirname(osp.dirname(img_dir)), "annotations")
-                if not osp.exists(save_dir):
-                    os.mkdir(save_dir)
-                save_path = osp.join(save_dir, "instances_" + osp.basename(img_dir) + ".json")
-                TrainValDataset.generate_coco_format_labels(img_info, self.class_names, save_path)
-        img_paths, labels = list(
-            zip(
-                *[
-                    (
-                        img_path,
-                        np.array(info["labels"], dtype=np.float32)
-                        if info["labels"]
-                        else np.zeros((0, 6), dtype=np.float32),  # NOTE 5 -> 6
-                    )
-                    for img_path, info in img_info.items()
-                ]
+        same_records = cache_info is not None and not num_removed and (old_indices == np.arange(num_imgs)).all()
+        if not same_records or len(new_labels) or img_changed.any():
+            labels = LabelStore.merge(cache_info["labels"] if cache_info is not None else None, old_indices, new_labels)
+            arrays = dict(
+                img_paths=np.array(img_paths),
+                img_stats=img_stats,
+                label_stats=label_stats,
+                shapes=shapes,
+                img_valid=img_valid,
+                label_valid=label_valid,
+                labels=labels,
             )
-        )
-        self.img_info = img_info  # {'img_path': {'shape':(); 'labels':[[]] }}
-        LOGGER.info(f"{self.task}: Final numbers of valid images: {len(img_paths)}/ labels: {len(labels)}. ")
-        return img_paths, labels
+            if self.main_process:
+                save_label_cache(cache_dir, arrays)
+                cache_info = load_label_cache(cache_dir)  # NOTE reload memory-mapped
+            else:
+                cache_info = arrays
+
+        # NOTE 只保留 image 和 label 都有效的记录
+        valid_indices = np.nonzero(img_valid & label_valid)[0]
+        cache_info["img_paths"] = cache_info["img_paths"][valid_indices]
+        cache_info["shapes"] = cache_info["shapes"][valid_indices]
+        cache_info["img_stats"] = cache_info["img_stats"][valid_indices]
+        cache_info["labels"] = cache_info["labels"].select(valid_indices)
+        return cache_info
 
     def get_mosaic_obb(self, index):
         """Gets images and labels after mosaic augments"""
@@ -349,7 +419,7 @@ class TrainValDataset(Dataset):
             boxes[:, 3] = h * boxes[:, 3]
             labels[:, 1:] = boxes
 
-        if self.augment:
+        if self.sample_augment:
             img, labels = self.general_augment(img, labels)
 
         return img, labels, shapes
@@ -386,9 +456,11 @@ class TrainValDataset(Dataset):
         s = self.shapes  # wh
         ar = s[:, 1] / s[:, 0]  # aspect ratio
         irect = ar.argsort()
-        self.img_paths = [self.img_paths[i] for i in irect]
-        self.labels = [self.labels[i] for i in irect]
+        self.img_paths = self.img_paths[irect]
+        self.labels = self.labels.select(irect)
         self.shapes = s[irect]  # wh
+        self.img_shapes = self.img_shapes[irect]
+        self.img_stats = self.img_stats[irect]
         ar = ar[irect]
 
         # Set training image shapes
@@ -449,7 +521,7 @@ class TrainValDataset(Dataset):
                 nf = 1  # label found
                 with open(lb_path, "r") as f:
                     labels = [x.split() for x in f.read().strip().splitlines() if len(x)]
-                    labels = np.array(labels, dtype=np.float32)
+                    labels = np.array(labels, dtype=np.float32).reshape(-1, 6) if labels else np.zeros((0, 6), dtype=np.float32)
                 if len(labels):
                     assert all(len(l) == 6 for l in labels), f"{lb_path}: wrong label format."
                     assert (labels >= 0).all(), f"{lb_path}: Label values error: all values in label file must > 0"
@@ -463,13 +535,12 @@ class TrainValDataset(Dataset):
                     if len(indices) < len(labels):  # duplicate row check
                         labels = labels[indices]  # remove duplicates
                         msg += f"WARNING: {lb_path}: {len(labels) - len(indices)} duplicate labels removed"
-                    labels = labels.tolist()
                 else:
                     ne = 1  # label empty
-                    labels = []
+                    labels = np.zeros((0, 6), dtype=np.float32)
             else:
                 nm = 1  # label missing
-                labels = []
+                labels = np.zeros((0, 6), dtype=np.float32)
 
             return img_path, labels, nc, nm, nf, ne, msg
         except Exception as e:
@@ -478,23 +549,22 @@ class TrainValDataset(Dataset):
             return img_path, None, nc, nm, nf, ne, msg
 
     @staticmethod
-    def generate_coco_format_labels(img_info, class_names, save_path):
-        # for evaluation with pycocotools
+    def generate_coco_format_labels(img_paths, shapes, labels, class_names, save_path):
+        # for the rotated coco style evaluation, bbox is kept for pycocotools
         dataset = {"categories": [], "annotations": [], "images": []}
         for i, class_name in enumerate(class_names):
             dataset["categories"].append({"id": i, "name": class_name, "supercategory": ""})
 
         ann_id = 0
         LOGGER.info(f"Convert to COCO format")
-        for i, (img_path, info) in enumerate(track(img_info.items())):
-            labels = info["labels"] if info["labels"] else []
+        for i, img_path in enumerate(track(img_paths)):
             img_id = osp.splitext(osp.basename(img_path))[0]
-            img_w, img_h = info["shape"]
+            img_w, img_h = (int(x) for x in shapes[i])
             dataset["images"].append(
                 {"file_name": os.path.basename(img_path), "id": img_id, "width": img_w, "height": img_h,}
             )
-            if labels:
-                for label in labels:
+            if len(labels[i]):
+                for label in labels[i].tolist():
                     c, x, y, w, h = label[:5]
                     # convert x,y,w,h to x1,y1,x2,y2
                     x1 = (x - w / 2) * img_w
@@ -505,10 +575,13 @@ class TrainValDataset(Dataset):
                     cls_id = int(c)
                     w = max(0, x2 - x1)
                     h = max(0, y2 - y1)
+                    # rotated polygon in pixels for the rotated evaluation
+                    poly = rbox2poly(np.array([x * img_w, y * img_h, label[3] * img_w, label[4] * img_h, label[5]]))
                     dataset["annotations"].append(
                         {
                             "area": h * w,
                             "bbox": [x1, y1, w, h],
+                            "poly": poly.round(2).tolist(),
                             "category_id": cls_id,
                             "id": ann_id,
                             "image_id": img_id,
@@ -594,5 +667,27 @@ class LoadData:
         self.cap = cv2.VideoCapture(path)
         self.frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
+    def batches(self, batch_size=1):
+        """Group the frames by batch_size, images and video frames alike.
+        Returns:
+            generator of lists of (img, path, type, vid_info), vid_info is (fps, w, h) of the video capture, read
+            with the frame since the capture is released at the end of the video, None for images.
+        """
+        batch = []
+        for img, path, cap in self:
+            vid_info = None
+            if self.type == "video" and cap:
+                vid_info = (
+                    cap.get(cv2.CAP_PROP_FPS),
+                    int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                    int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                )
+            batch.append((img, path, self.type, vid_info))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
     def __len__(self):
         return self.nf  # number of files
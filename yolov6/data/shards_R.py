@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+# Reader of the patches written by data/scrpits/DOTA_devkit/ImgSplit_multi_process.py with out_format='shards'
+import json
+import os.path as osp
+
+import cv2
+import numpy as np
+
+from yolov6.utils.events_R import LOGGER
+
+from .cache_R import LabelStore, get_file_stats, load_label_cache, save_label_cache
+from .data_augment_R import poly2obb_np_le180
+
+
+class ShardReader:
+    """Encoded patches stored in binary shards, indexed by shards/index.json.
+
+    index.json: {"version": 1, "ext": ".png", "patches": [{"name", "shard", "offset", "length", "width", "height",
+    "labels": ["x1 y1 ... x4 y4 name difficult", ...]}, ...]}. A patch is addressed by the virtual path
+    shards/<name><ext>, shards are memory-mapped lazily in each dataloader worker.
+    """
+
+    def __init__(self, index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        assert index.get("version") == 1, f"Not supported shard index version: {index.get('version')}"
+        self.index_path = index_path
+        self.root = osp.dirname(index_path)
+        self.ext = index["ext"]
+        self.patches = index["patches"]
+        self.img_paths = np.array([osp.join(self.root, p["name"] + self.ext) for p in self.patches])
+        self.shard_names = sorted({p["shard"] for p in self.patches})
+        shard_ids = {name: i for i, name in enumerate(self.shard_names)}
+        self.records = np.array(
+            [(shard_ids[p["shard"]], p["offset"], p["length"]) for p in self.patches], dtype=np.int64
+        ).reshape(-1, 3)
+        self.path_index = {p: i for i, p in enumerate(self.img_paths)}
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.patches)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shards"] = {}  # NOTE reopen the memmaps in the workers
+        return state
+
+    def read(self, path):
+        """Decoded BGR patch of a virtual path."""
+        shard_id, offset, length = self.records[self.path_index[path]]
+        if shard_id not in self.shards:
+            self.shards[shard_id] = np.memmap(osp.join(self.root, self.shard_names[shard_id]), dtype=np.uint8, mode="r")
+        return cv2.imdecode(self.shards[shard_id][offset : offset + length], cv2.IMREAD_COLOR)
+
+    def get_records(self, class_names, save_cache=True):
+        """Image/label records in the label cache format, labels are converted from the DOTA polygons once and cached
+        next to index.json until it changes, only the main process saves the cache.
+
+        Returns:
+            dict of LABEL_CACHE_ARRAYS, img_stats are the (offset, length) of the patches in their shards.
+        """
+        cache_dir = osp.join(self.root, "." + osp.splitext(osp.basename(self.index_path))[0] + "_cache")
+        index_stats = get_file_stats([self.index_path])[0].tolist()
+        cache_info = load_label_cache(cache_dir)
+        if (
+            cache_info is not None
+            and cache_info.get("index_stats") == index_stats
+            and cache_info.get("class_names") == list(class_names)
+        ):
+            return cache_info
+
+        labels, num_skipped = [], 0
+        for p in self.patches:
+            labels_per_img, skipped = self.convert_labels(p["labels"], p["width"], p["height"], class_names)
+            labels.append(labels_per_img)
+            num_skipped += skipped
+        if num_skipped:
+            LOGGER.info(f"{num_skipped} shard label(s) of unknown classes or degenerated polygons skipped.")
+        num = len(self.patches)
+        arrays = dict(
+            img_paths=self.img_paths,
+            img_stats=self.records[:, 1:].copy(),
+            label_stats=np.zeros((num, 2), dtype=np.int64),
+            shapes=np.array([(p["width"], p["height"]) for p in self.patches], dtype=np.int64).reshape(-1, 2),
+            img_valid=np.ones(num, dtype=bool),
+            label_valid=np.ones(num, dtype=bool),
+            labels=LabelStore.from_list(labels),
+        )
+        if not save_cache:
+            return arrays
+        save_label_cache(cache_dir, arrays, index_stats=index_stats, class_names=list(class_names))
+        return load_label_cache(cache_dir)
+
+    @staticmethod
+    def convert_labels(lines, width, height, class_names):
+        """DOTA lines to [n, 6] normalized [class, x, y, longSide, shortSide, angle], difficult 2 (cut) is skipped.
+
+        Returns:
+            labels, number of skipped lines of unknown classes or degenerated polygons.
+        """
+        labels, skipped = [], 0
+        for line in lines:
+            parts = line.split()
+            if len(parts) < 10 or parts[9] == "2":
+                continue
+            if parts[8] not in class_names:
+                skipped += 1
+                continue
+            try:
+                obb = poly2obb_np_le180([float(x) for x in parts[:8]])
+            except ValueError:  # angle out of [0, 180)
+                obb = None
+            if obb is None:
+                skipped += 1
+                continue
+            x, y, long_side, short_side, theta = obb
+            labels.append([class_names.index(parts[8]), x / width, y / height, long_side / width, short_side / height, theta])
+        labels = np.array(labels, dtype=np.float32).reshape(-1, 6)
+        labels[:, 1:3] = labels[:, 1:3].clip(0, 1)  # NOTE long/short side 可以超过 1 (对角线)
+        return labels, skipped
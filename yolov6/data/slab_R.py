@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+# Zero-copy batch transfer of the train loader: the workers write the uint8 CHW images of a batch straight into a
+# slot of a shared memory ring (pinned when CUDA is available) and the labels into a side buffer, only the slot id,
+# paths and shapes go through the worker queue.
+from collections import deque
+
+import torch
+from torch.utils.data import Dataset
+
+from yolov6.utils.events_R import LOGGER
+
+
+class BatchSlab:
+    """Ring of num_slots shared memory batches.
+
+    Args:
+        num_slots: (int) number of batches in the ring, more than the batches in flight of the DataLoader.
+        batch_size: (int) images of one batch.
+        img_shape: (tuple) (3, H, W) of every image.
+        label_capacity: (int) label rows of one slot, larger batches send their labels through the worker queue.
+        pin: (bool) page-lock the images for asynchronous copies to the device.
+    """
+
+    def __init__(self, num_slots, batch_size, img_shape, label_capacity, pin=True):
+        self.num_slots = num_slots
+        self.images = torch.empty((num_slots, batch_size, *img_shape), dtype=torch.uint8).share_memory_()
+        self.labels = torch.zeros((num_slots, label_capacity, 7)).share_memory_()
+        self.pinned = False
+        if pin and torch.cuda.is_available():
+            # NOTE 共享内存不能 pin_memory (会拷贝), 直接注册为 page-locked
+            err = torch.cuda.cudart().cudaHostRegister(self.images.data_ptr(), self.images.nbytes, 0)
+            self.pinned = int(err) == 0
+            if not self.pinned:
+                LOGGER.warning(f"WARNING: failed to pin the batch slab ({err}), copies to the device are synchronous.")
+        # events of the batches whose slot can be rewritten once the device has read it
+        self.events = deque()
+
+    def put(self, slot, pos, img):
+        """Write the HWC BGR image into the position pos of slot as CHW RGB."""
+        assert img.shape[:2] == self.images.shape[-2:], f"image shape {img.shape} does not match the slab"
+        self.images[slot, pos].numpy()[:] = img.transpose((2, 0, 1))[::-1]
+
+    def put_labels(self, slot, labels):
+        """Labels of the slot in the side buffer, returns the number of rows or the labels when they do not fit."""
+        if len(labels) > self.labels.shape[1]:
+            return labels
+        self.labels[slot, : len(labels)] = labels
+        return len(labels)
+
+    def unpack(self, batch):
+        """(images, targets, paths, shapes) of a batch of SlabDataset, images are a view of the slab."""
+        slot, num_images, labels, paths, shapes = batch
+        targets = self.labels[slot, :labels].clone() if isinstance(labels, int) else labels
+        return self.images[slot, :num_images], targets, paths, shapes
+
+    def record(self):
+        """Mark that the consumer has queued the device copy of the last batch."""
+        if self.pinned:
+            event = torch.cuda.Event()
+            event.record()
+            self.events.append(event)
+
+    def wait(self, in_flight):
+        """Wait until the device has read the batches that are older than the last in_flight ones."""
+        while len(self.events) > in_flight:
+            self.events.popleft().synchronize()
+
+
+class SlabDataset(Dataset):
+    """TrainValDataset whose batches are written into a BatchSlab by the workers.
+    The batch sampler yields [(slot, index), ...], the batch is returned as (slot, num_images, labels, paths, shapes).
+    """
+
+    def __init__(self, dataset, slab):
+        self.dataset = dataset
+        self.slab = slab
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitems__(self, items):
+        slot = items[0][0]
+        labels, paths, shapes = [], [], []
+        for pos, (_, index) in enumerate(items):
+            img, labels_out, path, shape = self.dataset.get_sample(index)
+            self.slab.put(slot, pos, img)
+            labels_out[:, 0] = pos  # add target image index for build_targets()
+            labels.append(labels_out)
+            paths.append(path)
+            shapes.append(shape)
+        labels = self.slab.put_labels(slot, torch.cat(labels, 0))
+        return slot, len(items), labels, tuple(paths), tuple(shapes)
+
+    @staticmethod
+    def collate_fn(batch):
+        """The batch is collated in the slab already."""
+        return batch
+
+
+class SlotSampler:
+    """Batch sampler that tags every batch with its slot of the ring, batches are consumed in order."""
+
+    def __init__(self, batch_sampler, num_slots):
+        self.batch_sampler = batch_sampler
+        self.sampler = batch_sampler.sampler
+        self.num_slots = num_slots
+
+    def __iter__(self):
+        for i, batch in enumerate(self.batch_sampler):
+            slot = i % self.num_slots
+            yield [(slot, index) for index in batch]
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+# End2End export of the rotated models, the rotated NMS is built from standard ONNX ops (opset >= 13), so the graph
+# runs on ONNX Runtime / OpenVINO / TensorRT without a custom plugin.
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from yolov6.utils.nms_R import _rotated_intersection_area, rbox2hull
+
+
+class ONNX_OBB(nn.Module):
+    """Top-k filtering and rotated NMS of the eval outputs [B, N, 6 + nc], with fixed size outputs.
+
+    The NMS is Cluster-NMS: the suppression matrix of the pre_topk candidates (higher score suppresses lower score,
+    same class unless agnostic) is computed once, then keep = valid & ~any(S[i, j] & keep[i]) is iterated nms_iters
+    times. The fixed point of the iteration is the greedy NMS keep set, it is reached once nms_iters is larger than
+    the longest suppression chain, which is a few iterations for real scenes.
+    Only the pairs with overlapped horizontal hulls go through the polygon clipping (NonZero + ScatterElements).
+
+    Outputs:
+        num_dets: (int32) [B, 1].
+        det_boxes: [B, max_obj, 5], [x, y, w, h, angle(degree)].
+        det_scores: [B, max_obj].
+        det_classes: (int32) [B, max_obj], the rows after num_dets are zeros with class -1.
+    """
+
+    def __init__(self, max_obj=100, iou_thres=0.45, score_thres=0.25, pre_topk=1000, nms_iters=20, agnostic=False,
+                 device=None):
+        super().__init__()
+        self.device = device if device else torch.device("cpu")
+        self.max_obj = max_obj
+        self.iou_thres = iou_thres
+        self.score_thres = score_thres
+        self.pre_topk = pre_topk
+        self.nms_iters = nms_iters
+        self.agnostic = agnostic
+
+    def forward(self, x):
+        # NOTE [B, N, x, y, w, h, angle, conf, classes], conf = obj_conf * cls_conf
+        scores, classes = (x[:, :, 6:] * x[:, :, 5:6]).max(-1)
+        num_topk = min(self.pre_topk, x.shape[1])
+        scores, topk_idx = scores.topk(num_topk, dim=1)
+        # NOTE 展平后 Gather, OpenVINO 的 GatherElements 不支持 slice 后的 data
+        batch_size, num_anchors = x.shape[:2]
+        flat_idx = (topk_idx + torch.arange(batch_size, device=x.device)[:, None] * num_anchors).flatten()
+        boxes = x[:, :, :5].reshape(-1, 5)[flat_idx].reshape(batch_size, num_topk, 5).float()
+        classes = classes.gather(1, topk_idx)
+        valid = scores > self.score_thres
+
+        suppress = self.suppression_matrix(boxes, classes, valid)
+        keep = valid.float()
+        for _ in range(self.nms_iters):
+            keep = valid.float() * (1 - (suppress * keep[:, :, None]).amax(1))
+        keep = keep > 0
+
+        num_out = min(self.max_obj, num_topk)
+        det_scores, det_idx = torch.where(keep, scores, torch.full_like(scores, -1)).topk(num_out, dim=1)
+        num_dets = keep.sum(1, keepdim=True).clamp(max=num_out)
+        is_det = torch.arange(num_out, device=x.device)[None] < num_dets
+        det_boxes = boxes.gather(1, det_idx[..., None].expand(-1, -1, 5)) * is_det[..., None]
+        det_scores = det_scores * is_det
+        det_classes = torch.where(is_det, classes.gather(1, det_idx), torch.full_like(det_idx, -1))
+        if num_out < self.max_obj:  # fewer anchors than max_obj
+            pad = self.max_obj - num_out
+            det_boxes = F.pad(det_boxes, (0, 0, 0, pad))
+            det_scores = F.pad(det_scores, (0, pad))
+            det_classes = F.pad(det_classes, (0, pad), value=-1)
+        return num_dets.int(), det_boxes.to(x.dtype), det_scores.to(x.dtype), det_classes.int()
+
+    def suppression_matrix(self, boxes, classes, valid):
+        """(float) [B, K, K], 1 where the candidate i suppresses the candidate j, candidates sorted by score."""
+        batch_size, num_topk = boxes.shape[:2]
+        hulls = rbox2hull(boxes.reshape(-1, 5)).reshape(batch_size, num_topk, 4)
+        lt = torch.maximum(hulls[:, :, None, :2], hulls[:, None, :, :2])
+        rb = torch.minimum(hulls[:, :, None, 2:], hulls[:, None, :, 2:])
+        pairs = ((rb - lt) > 0).all(-1) & (valid[:, :, None] & valid[:, None, :])
+        rank = torch.arange(num_topk, device=boxes.device)
+        pairs = pairs & (rank[:, None] < rank[None])  # NOTE triu 需要 opset 14
+        if not self.agnostic:
+            pairs = pairs & (classes[:, :, None] == classes[:, None, :])
+
+        b, i, j = pairs.nonzero(as_tuple=True)
+        # NOTE 补一个 (0, 0, 0) 的空 pair, 0 个 pair 时导出的 Reshape/Mul 在 ONNX Runtime 中无法推断形状
+        pad = torch.zeros(1, dtype=b.dtype, device=b.device)
+        b, i, j = torch.cat((b, pad)), torch.cat((i, pad)), torch.cat((j, pad))
+        boxes = boxes.reshape(-1, 5)
+        boxes1, boxes2 = boxes[b * num_topk + i], boxes[b * num_topk + j]
+        inter = _rotated_intersection_area(boxes1, boxes2)
+        area1, area2 = boxes1[:, 2] * boxes1[:, 3], boxes2[:, 2] * boxes2[:, 3]
+        ious = inter / (area1 + area2 - inter).clamp(min=1e-6)
+        suppress = torch.zeros(batch_size * num_topk * num_topk, device=boxes.device)
+        suppress = suppress.scatter(0, (b * num_topk + i) * num_topk + j, ((ious > self.iou_thres) & (i < j)).float())
+        return suppress.reshape(batch_size, num_topk, num_topk)
+
+
+class End2EndOBB(nn.Module):
+    """export onnx model of the rotated detector with the rotated NMS in the graph."""
+
+    def __init__(self, model, max_obj=100, iou_thres=0.45, score_thres=0.25, pre_topk=1000, nms_iters=20,
+                 agnostic=False, device=None, with_preprocess=False):
+        super().__init__()
+        device = device if device else torch.device("cpu")
+        self.with_preprocess = with_preprocess
+        self.model = model.to(device)
+        self.end2end = ONNX_OBB(max_obj, iou_thres, score_thres, pre_topk, nms_iters, agnostic, device)
+        self.end2end.eval()
+
+    def forward(self, x):
+        if self.with_preprocess:
+            x = x[:, [2, 1, 0], ...]
+            x = x * (1 / 255)
+        x = self.model(x)
+        if isinstance(x, (list, tuple)):
+            x = x[0]
+        return self.end2end(x)
@@ -3,10 +3,9 @@
 
 import torch
 import torch.nn as nn
-import numpy as np
 import torch.nn.functional as F
 from yolov6.assigners.anchor_generator import generate_anchors
-from yolov6.utils.general import dist2bbox, bbox2dist, xywh2xyxy, box_iou
+from yolov6.utils.general import dist2bbox, bbox2dist, xywh2xyxy, box_iou, pad_targets
 from yolov6.utils.figure_iou import IOUloss
 from yolov6.assigners.atss_assigner import ATSSAssigner
 from yolov6.assigners.tal_assigner import TaskAlignedAssigner
@@ -178,11 +177,7 @@ class ComputeLoss:
 
     def preprocess(self, targets, batch_size, scale_tensor):
         # TODO change this 添加角度
-        targets_list = np.zeros((batch_size, 1, 5)).tolist()
-        for i, item in enumerate(targets.cpu().numpy().tolist()):
-            targets_list[int(item[0])].append(item[1:])
-        max_len = max((len(l) for l in targets_list))
-        targets = torch.from_numpy(np.array(list(map(lambda l:l + [[-1,0,0,0,0]]*(max_len - len(l)), targets_list)))[:,1:,:]).to(targets.device)
+        targets = pad_targets(targets, batch_size)
         batch_target = targets[:, :, 1:5].mul_(scale_tensor)
         targets[..., 1:] = xywh2xyxy(batch_target)
         return targets
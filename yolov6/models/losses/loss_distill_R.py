@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
 
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -10,7 +9,7 @@ from yolov6.assigners.anchor_generator import generate_anchors
 from yolov6.assigners.atss_assigner_R import ATSSAssigner
 from yolov6.assigners.tal_assigner_R import TaskAlignedAssigner
 from yolov6.utils.figure_iou import IOUloss
-from yolov6.utils.general import bbox2dist, dist2bbox, xywh2xyxy
+from yolov6.utils.general import bbox2dist, dist2bbox, xywh2xyxy, pad_targets
 
 
 class ComputeLoss:
@@ -339,13 +338,7 @@ class ComputeLoss:
         return loss_cw
 
     def preprocess(self, targets, batch_size, scale_tensor):
-        targets_list = np.zeros((batch_size, 1, 6)).tolist()
-        for i, item in enumerate(targets.cpu().numpy().tolist()):
-            targets_list[int(item[0])].append(item[1:])
-        max_len = max((len(l) for l in targets_list))
-        targets = torch.from_numpy(
-            np.array(list(map(lambda l: l + [[-1, 0, 0, 0, 0, 0]] * (max_len - len(l)), targets_list)))[:, 1:, :]
-        ).to(targets.device)
+        targets = pad_targets(targets, batch_size)
         batch_target = targets[:, :, 1:5].mul_(scale_tensor)
         targets[..., 1:5] = xywh2xyxy(batch_target)
         return targets
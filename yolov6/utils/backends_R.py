@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+# Inference backends of the rotated models, selected by the suffix of the weights.
+#
+# Contract shared by all the backends:
+#   input:  (tensor) float [B, 3, H, W], RGB in [0, 1], on any device.
+#   output: (tensor) [B, N, 6 + num_classes], [x, y, w, h, angle, conf, cls scores...] on the backend device,
+#           the input of non_max_suppression_obb / non_max_suppression_obb_cuda.
+#           End2End models (deploy/ONNX/export_onnx_R.py --end2end) run the NMS in the graph, their output is the
+#           list of detections [n, 7], [x, y, w, h, angle, conf, cls] of each image, like the NMS output.
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from yolov6.utils.events_R import LOGGER
+
+
+class Backend:
+    """Base class of the backends, a backend is called like the deployed PyTorch model.
+
+    Attributes:
+        stride: (int) max stride of the model, 32 if the format does not store it.
+        fp16: (bool) whether the model runs in half precision.
+        nc / names: number and names of the classes if the format stores them, None otherwise.
+        dynamic_hw: (bool) whether the model accepts any input height/width (multiple of the stride).
+        end2end: (dict or None) NMS settings (conf_thres, iou_thres, max_det, agnostic) of an End2End model.
+    """
+
+    suffixes = ()
+
+    def __init__(self, weights, device):
+        self.weights = str(weights)
+        self.device = device
+        self.stride = 32
+        self.fp16 = False
+        self.nc, self.names = None, None
+        self.dynamic_hw = True
+        self.end2end = None
+
+    def __call__(self, img):
+        return self.forward(img)
+
+    def forward(self, img):
+        raise NotImplementedError
+
+    def warmup(self, img_size=(640, 640)):
+        self.forward(torch.zeros(1, 3, *img_size, device=self.device, dtype=torch.half if self.fp16 else torch.float))
+
+    # NOTE 和 nn.Module 相同的接口, 训练/评估代码不需要区分 backend
+    def eval(self):
+        return self
+
+    def float(self):
+        return self
+
+    def half(self):
+        return self
+
+    @staticmethod
+    def first_output(y):
+        return y[0] if isinstance(y, (list, tuple)) else y
+
+
+class TorchBackend(Backend):
+    """PyTorch checkpoint, RepVGG blocks are switched to the deploy modality."""
+
+    suffixes = (".pt",)
+
+    def __init__(self, weights, device, half=False):
+        super().__init__(weights, device)
+        from yolov6.layers.common import RepVGGBlock
+        from yolov6.utils.checkpoint import load_checkpoint
+        from yolov6.utils.general import download_ckpt
+
+        if not os.path.exists(self.weights):
+            download_ckpt(self.weights)  # try to download model from github automatically.
+        self.model = load_checkpoint(self.weights, map_location=device)
+        self.stride = int(self.model.stride.max())
+        self.nc, self.names = getattr(self.model, "nc", None), getattr(self.model, "names", None)
+        for layer in self.model.modules():
+            if isinstance(layer, RepVGGBlock):
+                layer.switch_to_deploy()
+        LOGGER.info("Switch model to deploy modality.")
+        self.half() if half and device.type != "cpu" else self.float()
+
+    def forward(self, img):
+        return self.first_output(self.model(img.to(self.device).type(torch.half if self.fp16 else torch.float)))
+
+    def eval(self):
+        self.model.eval()
+        return self
+
+    def float(self):
+        self.model.float()
+        self.fp16 = False
+        return self
+
+    def half(self):
+        self.model.half()
+        self.fp16 = True
+        return self
+
+
+class TorchScriptBackend(TorchBackend):
+    """TorchScript module, the stride and names are read from the config.txt extra file if it is saved."""
+
+    suffixes = (".torchscript", ".ts")
+
+    def __init__(self, weights, device, half=False):
+        Backend.__init__(self, weights, device)
+        extra_files = {"config.txt": ""}  # model metadata
+        self.model = torch.jit.load(self.weights, _extra_files=extra_files, map_location=device)
+        if extra_files["config.txt"]:
+            meta = json.loads(extra_files["config.txt"])
+            self.stride, self.names = int(meta.get("stride", 32)), meta.get("names")
+            self.nc = len(self.names) if self.names else None
+        self.half() if half and device.type != "cpu" else self.float()
+
+
+class NumpyBackend(Backend):
+    """Backends running on numpy arrays. Models with a static batch size run the batch in chunks (the last one
+    padded), a static input shape must match the letterboxed images.
+    """
+
+    def __init__(self, weights, device, input_shape, input_dtype):
+        super().__init__(weights, device)
+        self.input_shape = tuple(input_shape)  # [B, 3, H, W], -1 for the dynamic axes
+        self.input_dtype = input_dtype
+        self.fp16 = input_dtype == np.float16
+        self.dynamic_hw = -1 in self.input_shape[2:]
+
+    def forward(self, img):
+        img = img.detach().cpu().numpy().astype(self.input_dtype, copy=False)
+        static_batch, static_hw = self.input_shape[0], self.input_shape[2:]
+        assert all(s in (-1, x) for s, x in zip(static_hw, img.shape[2:])), (
+            f"input size {tuple(img.shape[2:])} does not match the static model input {static_hw}, "
+            f"use the same image size (and no rectangular inference) or export with dynamic axes."
+        )
+        if static_batch in (-1, len(img)):
+            outputs = self.run(img)
+        else:
+            chunks = []
+            for i in range(0, len(img), static_batch):
+                chunk = img[i : i + static_batch]
+                n = len(chunk)
+                if n < static_batch:
+                    chunk = np.concatenate((chunk, np.zeros((static_batch - n, *chunk.shape[1:]), dtype=chunk.dtype)))
+                chunks.append([y[:n] for y in self.run(chunk)])
+            outputs = [np.concatenate(y) for y in zip(*chunks)]
+        outputs = [torch.from_numpy(y).to(self.device) for y in outputs]
+        return self.end2end_dets(*outputs) if self.end2end else outputs[0]
+
+    def run(self, img):
+        """Output arrays of the model, only the first one is used except for End2End models."""
+        raise NotImplementedError
+
+    @staticmethod
+    def end2end_dets(num_dets, det_boxes, det_scores, det_classes):
+        """Fixed size End2End outputs to the detections [n, 7] of each image."""
+        dets = torch.cat((det_boxes, det_scores[..., None], det_classes[..., None].to(det_boxes.dtype)), -1).float()
+        return [det[:n] for det, n in zip(dets, num_dets.flatten().tolist())]
+
+
+class ONNXRuntimeBackend(NumpyBackend):
+    """ONNX model run by ONNX Runtime, CUDA provider first on GPU devices."""
+
+    suffixes = (".onnx",)
+
+    def __init__(self, weights, device, half=False):
+        import onnxruntime
+
+        providers = ["CPUExecutionProvider"]
+        if device.type != "cpu" and "CUDAExecutionProvider" in onnxruntime.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+        self.session = onnxruntime.InferenceSession(str(weights), providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [x.name for x in self.session.get_outputs()]
+        inp = self.session.get_inputs()[0]
+        shape = [s if isinstance(s, int) else -1 for s in inp.shape]
+        super().__init__(weights, device, shape, np.float16 if inp.type == "tensor(float16)" else np.float32)
+        meta = self.session.get_modelmeta().custom_metadata_map
+        if "stride" in meta:
+            self.stride = int(meta["stride"])
+        if "names" in meta:
+            self.names = json.loads(meta["names"])
+            self.nc = len(self.names)
+        if "end2end" in meta:
+            self.end2end = json.loads(meta["end2end"])
+
+    def run(self, img):
+        return self.session.run(self.output_names if self.end2end else self.output_names[:1], {self.input_name: img})
+
+
+class OpenVINOBackend(NumpyBackend):
+    """OpenVINO IR (.xml with its .bin) compiled for the CPU."""
+
+    suffixes = (".xml",)
+
+    def __init__(self, weights, device, half=False):
+        try:
+            from openvino import Core
+        except ImportError:  # openvino < 2023.1
+            from openvino.runtime import Core
+
+        core = Core()
+        network = core.read_model(model=str(weights), weights=str(Path(weights).with_suffix(".bin")))
+        shape = [d.get_length() if d.is_static else -1 for d in network.inputs[0].get_partial_shape()]
+        self.compiled_model = core.compile_model(network, device_name="CPU")
+        self.request = self.compiled_model.create_infer_request()
+        # NOTE IR 内部可以是 FP16 权重, 输入仍然是 FP32
+        super().__init__(weights, device, shape, np.float32)
+        meta = Path(weights).with_suffix(".json")
+        if meta.exists():
+            with open(meta) as f:
+                meta = json.load(f)
+            self.stride, self.names = int(meta.get("stride", 32)), meta.get("names")
+            self.nc = len(self.names) if self.names else None
+            self.end2end = meta.get("end2end")
+
+    def run(self, img):
+        # NOTE 输出 buffer 被下一次推理复用, 需要拷贝
+        outputs = self.request.infer([img])
+        num_outputs = len(self.compiled_model.outputs) if self.end2end else 1
+        return [outputs[self.compiled_model.output(i)].copy() for i in range(num_outputs)]
+
+
+BACKENDS = (TorchBackend, TorchScriptBackend, ONNXRuntimeBackend, OpenVINOBackend)
+
+
+def load_backend(weights, device, half=False):
+    """Backend of the weights selected by the file suffix.
+    Args:
+        weights: path of .pt / .torchscript / .ts / .onnx / .xml.
+        device: (torch.device) device of the outputs, and of the model for the PyTorch backends.
+        half: FP16 inference of the PyTorch backends on GPU, the ONNX/OpenVINO precision is set at export.
+    """
+    suffix = Path(str(weights)).suffix.lower()
+    for backend in BACKENDS:
+        if suffix in backend.suffixes:
+            LOGGER.info(f"Loading {weights} for {backend.__name__} inference...")
+            return backend(weights, device, half)
+    supported = ", ".join(s for backend in BACKENDS for s in backend.suffixes)
+    raise ValueError(f"{suffix} format is not supported, supported formats: {supported}.")
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+# The evaluation protocol follows pycocotools.cocoeval.COCOeval with rotated boxes
+# https://github.com/cocodataset/cocoapi/blob/master/PythonAPI/pycocotools/cocoeval.py
+
+import json
+import os
+import time
+from collections import defaultdict
+from multiprocessing.pool import Pool
+
+import numpy as np
+import torch
+
+from yolov6.utils.events_R import LOGGER
+from yolov6.utils.nms_R import poly2rbox, rotated_box_iou
+
+
+class Params:
+    """Params of the rotated evaluation, the same fields as pycocotools."""
+
+    def __init__(self, max_dets=(1, 10, 100)):
+        self.imgIds = []
+        self.catIds = []
+        self.iouThrs = np.linspace(0.5, 0.95, int(np.round((0.95 - 0.5) / 0.05)) + 1, endpoint=True)
+        self.recThrs = np.linspace(0.0, 1.00, int(np.round((1.00 - 0.0) / 0.01)) + 1, endpoint=True)
+        self.maxDets = list(max_dets)
+        self.areaRng = [[0 ** 2, 1e5 ** 2], [0 ** 2, 32 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
+        self.areaRngLbl = ["all", "small", "medium", "large"]
+        self.useCats = 1
+
+
+class RotatedCOCOeval:
+    """COCO style AP/AR of rotated boxes at IoU 0.5:0.95 with area ranges and maxDets.
+
+    Args:
+        gt: annotation json path or dict, annotations have "poly" [x1 y1 ... x4 y4] ("bbox" as horizontal boxes if
+            missing), "area", "category_id", "image_id" and optional "iscrowd"/"ignore".
+        dt: predictions.json path or iterable of {"image_id", "category_id", "poly", "score"} as written by Evaler.
+        max_dets: maxDets of the evaluation, the last one is used for matching.
+        workers: number of processes of the per image matching, 0 runs in the main process.
+
+    Usage is the same as COCOeval: evaluate(), accumulate(), summarize(), results are in eval and stats.
+    """
+
+    def __init__(self, gt, dt, max_dets=(1, 10, 100), workers=min(8, os.cpu_count() or 1)):
+        if isinstance(gt, str):
+            with open(gt, "r") as f:
+                gt = json.load(f)
+        if isinstance(dt, str):
+            with open(dt, "r") as f:
+                dt = json.load(f)
+        dt = list(dt)  # e.g. Evaler.RotatedPredictions, no json round trip
+        self.params = Params(max_dets)
+        self.params.imgIds = [img["id"] for img in gt["images"]]
+        self.params.catIds = sorted(cat["id"] for cat in gt["categories"])
+        self.cat_names = {cat["id"]: cat["name"] for cat in gt["categories"]}
+        self.workers = workers
+        self.gts = self._load_anns(gt["annotations"], is_gt=True)
+        self.dts = self._load_anns(dt, is_gt=False)
+        self.eval = {}
+        self.stats = []
+
+    @staticmethod
+    def _load_anns(anns, is_gt):
+        """Group annotations by image once: {image_id: dict of arrays}."""
+        groups = defaultdict(list)
+        for i, ann in enumerate(anns):
+            groups[ann["image_id"]].append(i)
+        missing_poly = False
+        results = {}
+        for image_id, inds in groups.items():
+            img_anns = [anns[i] for i in inds]
+            if all("poly" in ann for ann in img_anns):
+                rboxes = poly2rbox(np.array([ann["poly"] for ann in img_anns], dtype=np.float64).reshape(-1, 8))
+            else:  # NOTE horizontal boxes of the old annotation files
+                missing_poly = True
+                bboxes = np.array([ann["bbox"] for ann in img_anns], dtype=np.float64).reshape(-1, 4)
+                rboxes = np.concatenate((bboxes[:, :2] + bboxes[:, 2:] / 2, bboxes[:, 2:], np.zeros((len(bboxes), 1))), 1)
+            record = {
+                "rboxes": rboxes.astype(np.float32),
+                "cats": np.array([ann["category_id"] for ann in img_anns]),
+            }
+            if is_gt:
+                record["area"] = np.array([ann.get("area", 0.0) for ann in img_anns], dtype=np.float64)
+                record["iscrowd"] = np.array([ann.get("iscrowd", 0) for ann in img_anns], dtype=bool)
+                record["ignore"] = np.array([ann.get("ignore", 0) for ann in img_anns], dtype=bool) | record["iscrowd"]
+            else:
+                record["area"] = rboxes[:, 2] * rboxes[:, 3]
+                record["scores"] = np.array([ann["score"] for ann in img_anns], dtype=np.float64)
+            results[image_id] = record
+        if missing_poly:
+            LOGGER.warning("WARNING: annotations without poly are evaluated as horizontal boxes.")
+        return results
+
+    def evaluate(self):
+        """Match detections with ground truths of every image, in a process pool."""
+        tic = time.time()
+        p = self.params
+        cat_ids = p.catIds if p.useCats else [-1]
+        tasks = []
+        for img_id in p.imgIds:
+            gt, dt = self.gts.get(img_id), self.dts.get(img_id)
+            if gt is None and dt is None:
+                continue
+            tasks.append((gt, dt, cat_ids, p))
+        if self.workers > 0 and len(tasks) > 1:
+            with Pool(min(self.workers, len(tasks)), initializer=torch.set_num_threads, initargs=(1,)) as pool:
+                results = pool.map(evaluate_img, tasks, chunksize=max(1, len(tasks) // (self.workers * 16)))
+        else:
+            results = [evaluate_img(task) for task in tasks]
+        # [K][A] lists of per image (scores, matched, dt_ignore, num_gt)
+        self.eval_imgs = [[[] for _ in p.areaRng] for _ in cat_ids]
+        for result in results:
+            for k, a, record in result:
+                self.eval_imgs[k][a].append(record)
+        LOGGER.info(f"Rotated evaluation of {len(tasks)} images DONE (t={time.time() - tic:.2f}s).")
+
+    def accumulate(self):
+        """Precision/recall of every IoU threshold, recall threshold, category, area range and maxDets."""
+        p = self.params
+        T, R, K, A, M = len(p.iouThrs), len(p.recThrs), len(p.catIds) if p.useCats else 1, len(p.areaRng), len(p.maxDets)
+        precision = -np.ones((T, R, K, A, M))
+        recall = -np.ones((T, K, A, M))
+        scores = -np.ones((T, R, K, A, M))
+        for k in range(K):
+            for a in range(A):
+                records = self.eval_imgs[k][a]
+                if not records:
+                    continue
+                npig = sum(r[3] for r in records)
+                if npig == 0:
+                    continue
+                for m, max_det in enumerate(p.maxDets):
+                    dt_scores = np.concatenate([r[0][:max_det] for r in records])
+                    inds = np.argsort(-dt_scores, kind="mergesort")
+                    dt_scores_sorted = dt_scores[inds]
+                    dtm = np.concatenate([r[1][:, :max_det] for r in records], axis=1)[:, inds]
+                    dt_ig = np.concatenate([r[2][:, :max_det] for r in records], axis=1)[:, inds]
+                    tps = np.logical_and(dtm, np.logical_not(dt_ig))
+                    fps = np.logical_and(np.logical_not(dtm), np.logical_not(dt_ig))
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float64)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float64)
+                    for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
+                        nd = len(tp)
+                        rc = tp / npig
+                        pr = tp / (fp + tp + np.spacing(1))
+                        recall[t, k, a, m] = rc[-1] if nd else 0
+                        # precision envelope
+                        pr = np.maximum.accumulate(pr[::-1])[::-1] if nd else pr
+                        q, ss = np.zeros(R), np.zeros(R)
+                        ri = np.searchsorted(rc, p.recThrs, side="left")
+                        valid = ri < nd
+                        q[valid] = pr[ri[valid]]
+                        ss[valid] = dt_scores_sorted[ri[valid]]
+                        precision[t, :, k, a, m] = q
+                        scores[t, :, k, a, m] = ss
+        self.eval = {"counts": [T, R, K, A, M], "precision": precision, "recall": recall, "scores": scores}
+
+    def _summarize(self, ap=1, iouThr=None, areaRng="all", maxDets=100):
+        p = self.params
+        iStr = " {:<18} {} @[ IoU={:<9} | area={:>6s} | maxDets={:>3d} ] = {:0.3f}"
+        titleStr = "Average Precision" if ap == 1 else "Average Recall"
+        typeStr = "(AP)" if ap == 1 else "(AR)"
+        iouStr = f"{p.iouThrs[0]:0.2f}:{p.iouThrs[-1]:0.2f}" if iouThr is None else f"{iouThr:0.2f}"
+        aind = [i for i, aRng in enumerate(p.areaRngLbl) if aRng == areaRng]
+        mind = [i for i, mDet in enumerate(p.maxDets) if mDet == maxDets]
+        s = self.eval["precision"] if ap == 1 else self.eval["recall"]
+        if iouThr is not None:
+            s = s[np.where(np.isclose(iouThr, p.iouThrs))[0]]
+        s = s[:, :, :, aind, mind] if ap == 1 else s[:, :, aind, mind]
+        mean_s = np.mean(s[s > -1]) if len(s[s > -1]) else -1
+        LOGGER.info(iStr.format(titleStr, typeStr, iouStr, areaRng, maxDets, mean_s))
+        return mean_s
+
+    def summarize(self):
+        """The 12 COCO stats, maxDets are taken from params."""
+        max_dets = self.params.maxDets
+        stats = np.zeros((12,))
+        stats[0] = self._summarize(1, maxDets=max_dets[-1])
+        stats[1] = self._summarize(1, iouThr=0.5, maxDets=max_dets[-1])
+        stats[2] = self._summarize(1, iouThr=0.75, maxDets=max_dets[-1])
+        stats[3] = self._summarize(1, areaRng="small", maxDets=max_dets[-1])
+        stats[4] = self._summarize(1, areaRng="medium", maxDets=max_dets[-1])
+        stats[5] = self._summarize(1, areaRng="large", maxDets=max_dets[-1])
+        stats[6] = self._summarize(0, maxDets=max_dets[0])
+        stats[7] = self._summarize(0, maxDets=max_dets[1])
+        stats[8] = self._summarize(0, maxDets=max_dets[-1])
+        stats[9] = self._summarize(0, areaRng="small", maxDets=max_dets[-1])
+        stats[10] = self._summarize(0, areaRng="medium", maxDets=max_dets[-1])
+        stats[11] = self._summarize(0, areaRng="large", maxDets=max_dets[-1])
+        self.stats = stats
+
+    def per_class(self):
+        """AP@0.5, AP@0.5:0.95 and AR@0.5:0.95 of each category (area all, last maxDets), -1 if no ground truth."""
+        precision = self.eval["precision"][..., 0, -1]  # [T, R, K]
+        recall = self.eval["recall"][..., 0, -1]  # [T, K]
+        results = []
+        for k in range(precision.shape[2]):
+            p, p50, r = precision[:, :, k], precision[0, :, k], recall[:, k]
+            results.append(
+                (
+                    np.mean(p50[p50 > -1]) if (p50 > -1).any() else -1,
+                    np.mean(p[p > -1]) if (p > -1).any() else -1,
+                    np.mean(r[r > -1]) if (r > -1).any() else -1,
+                )
+            )
+        return np.array(results).reshape(-1, 3)
+
+    def gt_counts(self):
+        """Number of images and not ignored annotations of each category."""
+        num_imgs, num_anns = np.zeros(len(self.params.catIds), dtype=np.int64), np.zeros(len(self.params.catIds), dtype=np.int64)
+        cat_index = {c: i for i, c in enumerate(self.params.catIds)}
+        for img_id in self.params.imgIds:
+            gt = self.gts.get(img_id)
+            if gt is None:
+                continue
+            cats = np.array([cat_index[c] for c in gt["cats"][~gt["ignore"]]], dtype=np.int64)
+            num_anns += np.bincount(cats, minlength=len(num_anns))
+            num_imgs[np.unique(cats)] += 1
+        return num_imgs, num_anns
+
+
+def evaluate_img(args):
+    """Match the detections of one image for all categories and area ranges, the same rules as COCOeval.evaluateImg.
+
+    Returns:
+        list of (category index, area index, (scores [D], matched [T, D], dt_ignore [T, D], num not ignored gts)).
+    """
+    gt, dt, cat_ids, p = args
+    T = len(p.iouThrs)
+    empty_gt = {"rboxes": np.zeros((0, 5), np.float32), "cats": np.zeros(0), "area": np.zeros(0),
+                "iscrowd": np.zeros(0, bool), "ignore": np.zeros(0, bool)}
+    empty_dt = {"rboxes": np.zeros((0, 5), np.float32), "cats": np.zeros(0), "area": np.zeros(0), "scores": np.zeros(0)}
+    gt, dt = gt or empty_gt, dt or empty_dt
+    # NOTE all categories at once, iou of crowd ground truths is the iof of detections
+    ious = rotated_box_iou(dt["rboxes"], gt["rboxes"])
+    if gt["iscrowd"].any():
+        ious[:, gt["iscrowd"]] = rotated_box_iou(dt["rboxes"], gt["rboxes"][gt["iscrowd"]], mode="iof")
+    thrs = np.minimum(p.iouThrs, 1 - 1e-10)
+
+    results = []
+    for k, cat_id in enumerate(cat_ids):
+        g_inds = np.nonzero(gt["cats"] == cat_id)[0] if p.useCats else np.arange(len(gt["cats"]))
+        d_inds = np.nonzero(dt["cats"] == cat_id)[0] if p.useCats else np.arange(len(dt["cats"]))
+        if len(g_inds) == 0 and len(d_inds) == 0:
+            continue
+        d_inds = d_inds[np.argsort(-dt["scores"][d_inds], kind="mergesort")][: p.maxDets[-1]]
+        for a, (lo, hi) in enumerate(p.areaRng):
+            g_ig = gt["ignore"][g_inds] | (gt["area"][g_inds] < lo) | (gt["area"][g_inds] > hi)
+            g_order = np.argsort(g_ig, kind="mergesort")  # not ignored first
+            g_sorted, g_ig = g_inds[g_order], g_ig[g_order]
+            g_crowd = gt["iscrowd"][g_sorted]
+            iou = ious[np.ix_(d_inds, g_sorted)]
+            D, G = len(d_inds), len(g_sorted)
+            gtm = np.zeros((T, G), dtype=bool)
+            dtm = np.zeros((T, D), dtype=bool)
+            dt_ig = np.zeros((T, D), dtype=bool)
+            if G:
+                # NOTE only the detections overlapping a gt above the lowest threshold can be matched
+                for d in np.nonzero((iou >= thrs.min()).any(1))[0]:
+                    # candidate gts of every threshold, the not ignored ones are preferred, the last best wins ties
+                    cand = (~gtm | g_crowd) & (iou[d] >= thrs[:, None])
+                    cand_not_ig = cand & ~g_ig
+                    cand = np.where(cand_not_ig.any(1, keepdims=True), cand_not_ig, cand)
+                    found = cand.any(1)
+                    if not found.any():
+                        continue
+                    vals = np.where(cand, iou[d], -1.0)
+                    m = G - 1 - vals[:, ::-1].argmax(1)
+                    t_inds = np.nonzero(found)[0]
+                    dtm[t_inds, d] = True
+                    dt_ig[t_inds, d] = g_ig[m[t_inds]]
+                    gtm[t_inds, m[t_inds]] = True
+            d_area = dt["area"][d_inds]
+            dt_ig |= ~dtm & ((d_area < lo) | (d_area > hi))[None]
+            results.append((k, a, (dt["scores"][d_inds], dtm, dt_ig, int((~g_ig).sum()))))
+    return results
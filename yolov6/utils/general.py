@@ -110,6 +110,26 @@ def xywh2xyxy(bboxes):
     return bboxes
 
 
+def pad_targets(targets, batch_size):
+    """Padded targets of each image, built on the targets device.
+    Args:
+        targets: (tensor) [n, 1 + k], the image index of the batch first.
+        batch_size: (int) number of images.
+    Returns:
+        (tensor) [batch_size, max_len, k], the targets of each image keep their order, padded rows are [-1, 0, ...].
+    """
+    img_idx = targets[:, 0].long()
+    counts = torch.bincount(img_idx, minlength=batch_size)
+    max_len = int(counts.max())  # NOTE 唯一的同步, padded 的形状需要 max_len
+    padded = torch.zeros((batch_size, max_len, targets.shape[1] - 1), dtype=targets.dtype, device=targets.device)
+    padded[..., 0] = -1
+    # rank of each target in its image, the stable sort keeps the order of the targets
+    img_idx, order = torch.sort(img_idx, stable=True)
+    rank = torch.arange(len(img_idx), device=targets.device) - (counts.cumsum(0) - counts)[img_idx]
+    padded[img_idx, rank] = targets[order, 1:]
+    return padded
+
+
 def box_iou(box1, box2):
     # https://github.com/pytorch/vision/blob/master/torchvision/ops/boxes.py
     """
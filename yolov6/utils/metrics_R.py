@@ -9,7 +9,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import torch
 
-from yolov6.utils.nms_R import obb_box_iou, obb_box_iou_cuda
+from yolov6.utils.nms_R import obb_box_iou, obb_box_iou_cuda, rbox2hull
 
 # import warnings
 from . import general
@@ -158,33 +158,125 @@ def plot_mc_curve(px, py, save_dir="mc_curve.png", names=(), xlabel="Confidence"
     fig.savefig(Path(save_dir), dpi=250)
 
 
-def process_batch(detections, labels, iouv):
+def process_batch(detections, labels, iouv, det_img_idx=None, label_img_idx=None):
     """
-    Return correct predictions matrix. Both sets of boxes are in (x1, y1, x2, y2) format.
+    Return correct predictions matrix of all IoU levels in a single pass, boxes are in (x, y, w, h, angle) format.
+    Candidate pairs (same image and class) are sorted by IoU once to get the best label of each detection, then all
+    levels are resolved together. This is the same matching as thresholding the pairs and deduplicating them level by
+    level.
     Arguments:
-        detections (Array[N, 7]), x1, y1, x2, y2, angle, conf, class
-        labels (Array[M, 5]), class, x1, y1, x2, y2, angle
+        detections (Array[N, 7]), x, y, w, h, angle, conf, class
+        labels (Array[M, 6]), class, x, y, w, h, angle
+        iouv (Array[10]), IoU levels
+        det_img_idx (Array[N]), label_img_idx (Array[M]), image index of a batch of images, None for one image
     Returns:
         correct (Array[N, 10]), for 10 IoU levels
     """
-    correct = np.zeros((detections.shape[0], iouv.shape[0])).astype(bool)
+    device = detections.device
+    iouv = iouv.to(device)
+    num_dets, num_labels = detections.shape[0], labels.shape[0]
+    correct = torch.zeros(num_dets, iouv.shape[0], dtype=torch.bool, device=device)
+    if num_dets == 0 or num_labels == 0:
+        return correct
+
+    # candidate pairs, labels of the same image and class of each detection
+    det_key, label_key = detections[:, 6].long(), labels[:, 0].long().to(device)
+    if det_img_idx is not None:
+        num_classes = int(max(det_key.max(), label_key.max())) + 1
+        det_key = det_key + det_img_idx.long().to(device) * num_classes
+        label_key = label_key + label_img_idx.long().to(device) * num_classes
+    label_key, label_order = label_key.sort(stable=True)
+    start = torch.searchsorted(label_key, det_key)
+    counts = torch.searchsorted(label_key, det_key, right=True) - start
+    pair_det = torch.repeat_interleave(torch.arange(num_dets, device=device), counts)
+    offsets = torch.cumsum(counts, 0) - counts
+    pair_label = label_order[
+        torch.repeat_interleave(start - offsets, counts) + torch.arange(pair_det.shape[0], device=device)
+    ]
+    # only the pairs with overlapped horizontal hulls may reach the iou levels
+    det_hull, label_hull = rbox2hull(detections[:, :5].float()), rbox2hull(labels[:, 1:].float().to(device))
+    lt = torch.maximum(det_hull[pair_det, :2], label_hull[pair_label, :2])
+    rb = torch.minimum(det_hull[pair_det, 2:], label_hull[pair_label, 2:])
+    keep = ((rb - lt) > 0).all(-1)
+    pair_det, pair_label = pair_det[keep], pair_label[keep]
     # iou = general.box_iou(labels[:, 1:], detections[:, :4])
-    # iou = obb_box_iou(labels[:, 1:].cpu().numpy(), detections[:, :5].cpu().numpy())
-    # iou = torch.from_numpy(iou)
-    iou = obb_box_iou_cuda(labels[:, 1:], detections[:, :5])
+    iou = obb_box_iou_cuda(labels[pair_label, 1:].to(device), detections[pair_det, :5], aligned=True).float()
+    keep = iou >= iouv.min()
+    pair_det, pair_label, iou = pair_det[keep], pair_label[keep], iou[keep]
+
+    # sort once by iou, the first pair of a detection is its best label
+    order = iou.argsort(descending=True, stable=True)
+    pair_det, pair_label, iou = pair_det[order], pair_label[order], iou[order]
+    keep = _first_of_each(pair_det, num_dets)
+    pair_det, pair_label, iou = pair_det[keep], pair_label[keep], iou[keep]
+
+    # NOTE at each level a label is matched by its first detection (NMS outputs are sorted by conf) above the level,
+    # i.e. a detection is correct if its iou >= level > the max iou of the former detections of the same label.
+    # The max is a cummax over (label, detection) order, labels are offset by 2 to split the groups, exact in float64
+    order = (pair_label * num_dets + pair_det).argsort()
+    pair_det, pair_label, iou = pair_det[order], pair_label[order], iou[order].double()
+    offset = 2.0 * pair_label
+    former_max = torch.cat((iou.new_full((1,), -1.0), torch.cummax(iou + offset, 0).values[:-1])) - offset
+    correct[pair_det] = (iou[:, None] >= iouv) & (former_max[:, None] < iouv)
+    return correct
+
+
+def _first_of_each(indices, num):
+    """Mask of the first occurrence of each index."""
+    pos = torch.arange(indices.shape[0], device=indices.device)
+    first = torch.full((num,), indices.shape[0], device=indices.device).scatter_reduce(0, indices, pos, "amin")
+    return first[indices] == pos
+
+
+class MetricAccumulator:
+    """Streaming statistics (correct, conf, pred_cls, target_cls) of ap_per_class.
+    Statistics of every batch are written into preallocated tensors which grow by doubling, so no per image tuples
+    are kept and the final concatenation is a view.
+    """
 
-    correct_class = labels[:, 0:1] == detections[:, 6]
-    for i in range(len(iouv)):
-        x = torch.where((iou >= iouv[i]) & correct_class)  # IoU > threshold and classes match
-        if x[0].shape[0]:
-            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()  # [label, detect, iou]
-            if x[0].shape[0] > 1:
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
-                # matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
-            correct[matches[:, 1].astype(int), i] = True
-    return torch.tensor(correct, dtype=torch.bool, device=iouv.device)
+    def __init__(self, iouv, device="cpu", capacity=4096):
+        self.iouv = iouv
+        self.device = device
+        niou = iouv.numel()
+        self.buffers = {
+            "correct": torch.zeros(capacity, niou, dtype=torch.bool, device=device),
+            "conf": torch.zeros(capacity, device=device),
+            "pred_cls": torch.zeros(capacity, device=device),
+            "target_cls": torch.zeros(capacity, device=device),
+        }
+        self.sizes = {name: 0 for name in self.buffers}
+        self.seen = 0  # number of images
+
+    def _append(self, name, x):
+        buffer, size = self.buffers[name], self.sizes[name]
+        if size + len(x) > len(buffer):
+            new_buffer = buffer.new_zeros((max(2 * len(buffer), size + len(x)), *buffer.shape[1:]))
+            new_buffer[:size] = buffer[:size]
+            self.buffers[name] = buffer = new_buffer
+        buffer[size : size + len(x)] = x.to(self.device, buffer.dtype, non_blocking=True)
+        self.sizes[name] = size + len(x)
+
+    def update(self, preds, labels):
+        """Match the predictions with the labels of a batch of images at once on their device, append the statistics.
+
+        Args:
+            preds: list of [N, 7] (x, y, w, h, angle, conf, class) native-space predictions of each image.
+            labels: list of [M, 6] (class, x, y, w, h, angle) native-space labels of each image.
+        """
+        self.seen += len(preds)
+        device = preds[0].device if len(preds) else self.device
+        det_img_idx = torch.cat([torch.full((len(x),), i, device=device) for i, x in enumerate(preds)])
+        label_img_idx = torch.cat([torch.full((len(x),), i, device=device) for i, x in enumerate(labels)])
+        preds, labels = torch.cat(preds, 0), torch.cat(labels, 0).to(device)
+        correct = process_batch(preds, labels, self.iouv, det_img_idx, label_img_idx)
+        self._append("correct", correct)
+        self._append("conf", preds[:, 5])
+        self._append("pred_cls", preds[:, 6])
+        self._append("target_cls", labels[:, 0])
+
+    def result(self):
+        """(correct, conf, pred_cls, target_cls) numpy arrays for ap_per_class."""
+        return [self.buffers[name][: self.sizes[name]].cpu().numpy() for name in self.buffers]
 
 
 class ConfusionMatrix:
@@ -10,7 +10,11 @@ import cv2
 import numpy as np
 import torch
 import torchvision
-from mmcv.ops import box_iou_rotated, nms_rotated
+
+try:
+    from mmcv.ops import box_iou_rotated, nms_rotated
+except ImportError:  # NOTE CPU-only boxes without compiled mmcv, fall back to the pure torch kernels below
+    box_iou_rotated, nms_rotated = None, None
 
 # Settings
 torch.set_printoptions(linewidth=320, precision=5, profile="long")
@@ -20,34 +24,146 @@ os.environ["NUMEXPR_MAX_THREADS"] = str(min(os.cpu_count(), 8))  # NumExpr max t
 
 
 def obb_box_iou(boxes1, boxes2):
-    area1 = boxes1[:, 2] * boxes1[:, 3]
-    area2 = boxes2[:, 2] * boxes2[:, 3]
-    ious = []
-    for i, box1 in enumerate(boxes1):
-        temp_ious = []
-        r1 = ((box1[0], box1[1]), (box1[2], box1[3]), box1[4])
-        for j, box2 in enumerate(boxes2):
-            r2 = ((box2[0], box2[1]), (box2[2], box2[3]), box2[4])
-            int_pts = cv2.rotatedRectangleIntersection(r1, r2)[1]
-            if int_pts is not None:
-                order_pts = cv2.convexHull(int_pts, returnPoints=True)
-
-                int_area = cv2.contourArea(order_pts)
-
-                inter = int_area * 1.0 / (area1[i] + area2[j] - int_area)
-                temp_ious.append(inter)
-            else:
-                temp_ious.append(0.0)
-        ious.append(temp_ious)
-    return np.array(ious, dtype=np.float32)
-
-
-def obb_box_iou_cuda(boxes1, boxes2):
+    """Rotated IoU matrix of numpy boxes [N, 5] and [M, 5], [x, y, w, h, angle(degree)], returns float32 [N, M]."""
+    return rotated_box_iou(boxes1, boxes2).astype(np.float32)
+
+
+def obb_box_iou_cuda(boxes1, boxes2, aligned=False):
+    if box_iou_rotated is None:  # mmcv is not installed, use the pure torch kernel
+        return rotated_box_iou(boxes1, boxes2, is_aligned=aligned)
     box1 = boxes1.clone()
     box2 = boxes2.clone()
     box1[:, -1] = box1[:, -1] * torch.pi / 180.0
     box2[:, -1] = box2[:, -1] * torch.pi / 180.0
-    return box_iou_rotated(box1, box2, mode="iou")
+    return box_iou_rotated(box1, box2, mode="iou", aligned=aligned)
+
+
+def rotated_box_iou(boxes1, boxes2, mode="iou", is_aligned=False, chunk_size=2 ** 18, eps=1e-6):
+    """Rotated IoU of two sets of boxes, pure torch, runs on both CPU and GPU without mmcv.
+    The intersection polygon is built from the corners of each box inside the other box and the edge
+    intersections, its vertices are sorted by angle around their center and the area is given by the shoelace formula.
+    Only the pairs whose horizontal hulls overlap are computed, at most chunk_size pairs at once to bound the memory.
+    Args:
+        boxes1 (array/tensor): shape [N, 5], [x, y, w, h, angle(degree)].
+        boxes2 (array/tensor): shape [M, 5], [x, y, w, h, angle(degree)].
+        mode (str): 'iou' (intersection over union), 'iof' (intersection over foreground boxes1).
+        is_aligned (bool): compute the N aligned pairs (boxes1[i], boxes2[i]) only, then M must equal to N.
+        chunk_size (int): max number of pairs computed at once.
+    Returns:
+        ious (array/tensor): shape [N, M], or [N] if is_aligned, float32 array for numpy inputs,
+            tensor of the boxes1 float dtype for tensor inputs.
+    """
+    assert mode in ["iou", "iof"], f"Unsupported mode {mode}"
+    if not isinstance(boxes1, torch.Tensor):
+        return rotated_box_iou(
+            torch.from_numpy(np.asarray(boxes1, dtype=np.float32)),
+            torch.from_numpy(np.asarray(boxes2, dtype=np.float32)),
+            mode,
+            is_aligned,
+            chunk_size,
+            eps,
+        ).numpy()
+
+    dtype = boxes1.dtype if boxes1.is_floating_point() else torch.float32
+    # NOTE fp16 is not enough for the polygon clipping, degenerate boxes with w, h <= 0 get iou 0
+    boxes1, boxes2 = boxes1.reshape(-1, 5).float(), boxes2.reshape(-1, 5).float().to(boxes1.device)
+    boxes1 = torch.cat((boxes1[:, :2], boxes1[:, 2:4].clamp(min=0), boxes1[:, 4:]), 1)
+    boxes2 = torch.cat((boxes2[:, :2], boxes2[:, 2:4].clamp(min=0), boxes2[:, 4:]), 1)
+    rows, cols = boxes1.shape[0], boxes2.shape[0]
+    # only the pairs with overlapped horizontal hulls have an intersection
+    hull1, hull2 = rbox2hull(boxes1), rbox2hull(boxes2)
+    if is_aligned:
+        assert rows == cols, f"Aligned boxes must have the same number, got {rows} and {cols}"
+        lt = torch.maximum(hull1[:, :2], hull2[:, :2])
+        rb = torch.minimum(hull1[:, 2:], hull2[:, 2:])
+        pair_i = pair_j = ((rb - lt) > 0).all(-1).nonzero(as_tuple=True)[0]
+        ious = torch.zeros(rows, device=boxes1.device)
+    else:
+        pair_i, pair_j = [], []
+        step = max(1, chunk_size // max(cols, 1))
+        for start in range(0, rows, step):
+            lt = torch.maximum(hull1[start : start + step, None, :2], hull2[None, :, :2])
+            rb = torch.minimum(hull1[start : start + step, None, 2:], hull2[None, :, 2:])
+            i, j = ((rb - lt) > 0).all(-1).nonzero(as_tuple=True)
+            pair_i.append(i + start)
+            pair_j.append(j)
+        pair_i = torch.cat(pair_i) if pair_i else torch.zeros((0,), dtype=torch.long, device=boxes1.device)
+        pair_j = torch.cat(pair_j) if pair_j else torch.zeros((0,), dtype=torch.long, device=boxes1.device)
+        ious = torch.zeros(rows * cols, device=boxes1.device)
+
+    area1, area2 = boxes1[:, 2] * boxes1[:, 3], boxes2[:, 2] * boxes2[:, 3]
+    pair_ious = []
+    for start in range(0, pair_i.shape[0], chunk_size):
+        i, j = pair_i[start : start + chunk_size], pair_j[start : start + chunk_size]
+        inter = _rotated_intersection_area(boxes1[i], boxes2[j], eps) * ((area1[i] > 0) & (area2[j] > 0))
+        union = area1[i] if mode == "iof" else area1[i] + area2[j] - inter
+        pair_ious.append(inter / union.clamp(min=eps))
+    if pair_ious:
+        if is_aligned:
+            ious[pair_i] = torch.cat(pair_ious)
+        else:
+            ious[pair_i * cols + pair_j] = torch.cat(pair_ious)
+    return (ious if is_aligned else ious.reshape(rows, cols)).to(dtype)
+
+
+def rbox2hull(boxes):
+    """Horizontal hulls [N, 4] (x1, y1, x2, y2) of rotated boxes [N, 5], angle in degree."""
+    theta = boxes[:, 4] * torch.pi / 180.0
+    cos, sin = torch.cos(theta).abs(), torch.sin(theta).abs()
+    half_sizes = torch.stack((boxes[:, 2] * cos + boxes[:, 3] * sin, boxes[:, 2] * sin + boxes[:, 3] * cos), 1) / 2.0
+    return torch.cat((boxes[:, :2] - half_sizes, boxes[:, :2] + half_sizes), 1)
+
+
+def _rotated_intersection_area(boxes1, boxes2, eps=1e-6):
+    # NOTE move pairs to the center of boxes1, keeps the float precision for large coordinates
+    offset = boxes1[:, None, :2]
+    corners1 = rbox2poly(boxes1).reshape(-1, 4, 2) - offset
+    corners2 = rbox2poly(boxes2).reshape(-1, 4, 2) - offset
+
+    # [N, 4, 4, 2] edge intersections, p + t * r == q + u * s
+    p, r = corners1[:, :, None], (corners1.roll(-1, dims=1) - corners1)[:, :, None]
+    q, s = corners2[:, None], (corners2.roll(-1, dims=1) - corners2)[:, None]
+    r_cross_s = r[..., 0] * s[..., 1] - r[..., 1] * s[..., 0]
+    is_parallel = r_cross_s.abs() < eps
+    r_cross_s = torch.where(is_parallel, torch.ones_like(r_cross_s), r_cross_s)
+    qp = q - p
+    t = (qp[..., 0] * s[..., 1] - qp[..., 1] * s[..., 0]) / r_cross_s
+    u = (qp[..., 0] * r[..., 1] - qp[..., 1] * r[..., 0]) / r_cross_s
+    inter_mask = ~is_parallel & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    inter_points = p + t[..., None] * r
+
+    vertices = torch.cat((corners1, corners2, inter_points.reshape(-1, 16, 2)), dim=1)  # [N, 24, 2]
+    mask = torch.cat(
+        (_points_in_rect(corners1, corners2, eps), _points_in_rect(corners2, corners1, eps), inter_mask.reshape(-1, 16)),
+        dim=1,
+    )
+
+    # sort the valid vertices by angle around their mean, invalid ones go to the end
+    num_valid = mask.sum(1, keepdim=True)
+    center = (vertices * mask[..., None]).sum(1) / num_valid.clamp(min=1)
+    angles = torch.atan2(vertices[..., 1] - center[:, None, 1], vertices[..., 0] - center[:, None, 0])
+    angles = torch.where(mask, angles, torch.full_like(angles, 4.0))
+    order = angles.argsort(dim=1)
+    vertices = vertices.gather(1, order[..., None].expand(-1, -1, 2))
+    mask = mask.gather(1, order)
+    # invalid vertices are replaced by the first one, they add nothing to the shoelace sum
+    vertices = torch.where(mask[..., None], vertices, vertices[:, :1])
+
+    next_vertices = vertices.roll(-1, dims=1)
+    area = (vertices[..., 0] * next_vertices[..., 1] - vertices[..., 1] * next_vertices[..., 0]).sum(1).abs() / 2.0
+    return torch.where(num_valid.squeeze(1) >= 3, area, torch.zeros_like(area))
+
+
+def _points_in_rect(points, corners, eps=1e-6):
+    """points [N, K, 2] inside the rectangles given by corners [N, 4, 2], same check as select_candidates_in_gts_R"""
+    a, b, d = corners[:, None, 0], corners[:, None, 1], corners[:, None, 3]
+    ab, ad, ap = b - a, d - a, points - a
+    norm_ab, norm_ad = (ab * ab).sum(-1), (ad * ad).sum(-1)
+    ap_dot_ab, ap_dot_ad = (ap * ab).sum(-1), (ap * ad).sum(-1)
+    tol_ab, tol_ad = eps * norm_ab.clamp(min=1.0), eps * norm_ad.clamp(min=1.0)
+    return (
+        (ap_dot_ab >= -tol_ab) & (ap_dot_ab <= norm_ab + tol_ab) & (ap_dot_ad >= -tol_ad) & (ap_dot_ad <= norm_ad + tol_ad)
+    )
 
 
 def xywh2xyxy(x):
@@ -152,9 +268,214 @@ def non_max_suppression(
 
 
 def non_max_suppression_obb(
-    prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False, max_det=300
+    prediction,
+    conf_thres=0.25,
+    iou_thres=0.45,
+    classes=None,
+    agnostic=False,
+    multi_label=False,
+    max_det=300,
+    max_candidates=30000,
 ):
-    """Runs Non-Maximum Suppression (NMS) on inference results.
+    """Runs batched rotated Non-Maximum Suppression (NMS) on inference results.
+    All images are processed at once and the candidates stay on prediction.device, the keep sets are the same as
+    the per image mmcv nms_rotated implementation (non_max_suppression_obb_cuda).
+    Args:
+        prediction: (tensor), with shape [BS, N, 6 + num_classes], N is the number of bboxes.
+        conf_thres: (float) confidence threshold.
+        iou_thres: (float) iou threshold.
+        classes: (None or list[int]), if a list is provided, nms only keep the classes you provide.
+        agnostic: (bool), when it is set to True, we do class-independent nms, otherwise, different class would do nms respectively.
+        multi_label: (bool), when it is set to True, one box can have multi labels, otherwise, one box only huave one label.
+        max_det:(int), max number of output bboxes.
+        max_candidates: (int), max number of candidates of one image put into NMS, see select_candidates_obb().
+
+    Returns:
+         list of detections, echo item is one tensor with shape (num_boxes, 7), 7 is for [xywh, angle, conf, cls].
+    """
+
+    # NOTE [N, x, y, w, h, angle, conf, classes]
+    # NOTE [N, 0, 1, 2, 3, 4,      5,      6:]
+    batch_size, num_classes = prediction.shape[0], prediction.shape[2] - 6  # number of classes
+    # Check the parameters.
+    assert 0 <= conf_thres <= 1, f"conf_thresh must be in 0.0 to 1.0, however {conf_thres} is provided."
+    assert 0 <= iou_thres <= 1, f"iou_thres must be in 0.0 to 1.0, however {iou_thres} is provided."
+
+    img_idx, box_idx, class_idx, conf = select_candidates_obb(
+        prediction, conf_thres, classes, multi_label, max_candidates
+    )
+
+    # Batched rotated NMS, one group per image (and per class when not agnostic)
+    group_idx = img_idx if agnostic else img_idx * num_classes + class_idx
+    keep_box_idx = batched_nms_rotated(prediction[img_idx, box_idx, :5], conf, group_idx, iou_thres)
+
+    # limit detections, keep_box_idx is sorted by score so the max_det highest scores of each image are kept
+    img_idx = img_idx[keep_box_idx]
+    keep = _rank_in_group(conf[keep_box_idx], img_idx, batch_size) < max_det
+    keep_box_idx, img_idx = keep_box_idx[keep], img_idx[keep]
+
+    x = torch.cat(
+        (
+            prediction[img_idx, box_idx[keep_box_idx], :5],
+            conf[keep_box_idx, None],
+            class_idx[keep_box_idx, None].to(prediction.dtype),
+        ),
+        1,
+    )
+    # split per image, score order inside each image is kept by the stable sort
+    x = x[img_idx.sort(stable=True)[1]]
+    return list(x.split(torch.bincount(img_idx, minlength=batch_size).tolist()))
+
+
+def select_candidates_obb(prediction, conf_thres=0.25, classes=None, multi_label=False, max_candidates=30000):
+    """Selects the NMS candidates of all images at once, before any box expansion.
+    The max_candidates highest class scores of each image are taken with one topk, then the conf threshold and the
+    objectness multiply are only applied on them. The conf column of effidehead_R.Detect is always 1, so ranking by
+    the class scores is the same as ranking by conf = obj_conf * cls_conf and the dense multiply is skipped.
+    Args:
+        prediction: (tensor), with shape [BS, N, 6 + num_classes], N is the number of bboxes.
+        conf_thres: (float) confidence threshold.
+        classes: (None or list[int]), if a list is provided, only keep the classes you provide.
+        multi_label: (bool), when it is set to True, one box can have multi labels, otherwise, one box only huave one label.
+        max_candidates: (int), max number of candidates of one image, (box, class) pairs when multi_label.
+
+    Returns:
+        img_idx, box_idx, class_idx, conf (tensor): shape [M], candidates of all images, in image, box, class order.
+    """
+    batch_size, num_boxes, num_classes = prediction.shape[0], prediction.shape[1], prediction.shape[2] - 6
+    multi_label &= num_classes > 1  # multiple labels per box
+
+    scores = prediction[..., 6:]
+    if classes is not None:
+        class_mask = torch.zeros(num_classes, dtype=torch.bool, device=prediction.device)
+        class_mask[torch.tensor(classes, device=prediction.device)] = True
+    if multi_label:
+        if classes is not None:
+            scores = scores * class_mask
+        scores = scores.flatten(1)  # [BS, N * nc]
+    else:  # Only keep the class with highest scores.
+        scores, max_class_idx = scores.max(-1)  # [BS, N]
+        if classes is not None:
+            scores = scores * class_mask[max_class_idx]
+
+    if max_candidates < scores.shape[1]:
+        topk_scores, topk_idx = scores.topk(max_candidates, dim=1)
+        # NOTE back to the anchor order, ties are broken as the per image NMS does
+        topk_idx, order = topk_idx.sort(dim=1)
+        is_candidate = topk_scores.gather(1, order) > conf_thres
+        img_idx = torch.arange(batch_size, device=prediction.device)[:, None].expand_as(topk_idx)[is_candidate]
+        flat_idx = topk_idx[is_candidate]
+    else:
+        img_idx, flat_idx = (scores > conf_thres).nonzero(as_tuple=True)
+
+    if multi_label:
+        box_idx, class_idx = flat_idx // num_classes, flat_idx % num_classes
+    else:
+        box_idx, class_idx = flat_idx, max_class_idx[img_idx, flat_idx]
+    # confidence multiply the objectness, only on the candidates
+    obj_conf = prediction[img_idx, box_idx, 5]
+    conf = prediction[img_idx, box_idx, 6 + class_idx] * obj_conf  # conf = obj_conf * cls_conf
+    keep = (obj_conf > conf_thres) & (conf > conf_thres)
+    return img_idx[keep], box_idx[keep], class_idx[keep], conf[keep]
+
+
+def batched_nms_rotated(boxes, scores, idxs, iou_thres, chunk_size=2 ** 24):
+    """Greedy rotated NMS over groups of boxes, the same rule as mmcv nms_rotated.
+    NOTE cv2.dnn.NMSBoxesRotated also uses this rule, but takes iou = 1 when one box is fully inside the other.
+    Boxes only suppress boxes of the same group (image / class), like adding class offsets in the per image NMS,
+    but without losing precision on the center coordinates.
+    Candidate pairs are found by an iou upper bound from the horizontal hulls and only their rotated IoU is computed, then the greedy
+    keep set is solved with the Cluster-NMS fixed point iteration, which gives exactly the greedy result.
+    Args:
+        boxes: (tensor), with shape [N, 5], [x, y, w, h, angle(degree)].
+        scores: (tensor), with shape [N].
+        idxs: (tensor), with shape [N], group index of each box.
+        iou_thres: (float) iou threshold, boxes with iou > iou_thres are suppressed.
+        chunk_size: (int), max number of candidate pairs of the upper bound test built at once.
+
+    Returns:
+        keep (tensor): indices of the kept boxes, sorted in decreasing order of scores.
+    """
+    if boxes.shape[0] == 0:
+        return torch.zeros((0,), dtype=torch.long, device=boxes.device)
+
+    # sort by score, then group the boxes, each group is a contiguous block sorted by score
+    order = scores.sort(descending=True, stable=True)[1]
+    order = order[idxs[order].sort(stable=True)[1]]
+    boxes, idxs = boxes[order].float(), idxs[order]
+    num_boxes = boxes.shape[0]
+    # horizontal hull half sizes and areas, the iou upper bound of a pair is
+    # min(hull intersection, min area) / (area1 + area2 - min(hull intersection, min area))
+    centers, areas = boxes[:, :2], boxes[:, 2] * boxes[:, 3]
+    hulls = rbox2hull(boxes)
+    half_sizes = (hulls[:, 2:] - hulls[:, :2]) / 2.0
+    _, group_counts = torch.unique_consecutive(idxs, return_counts=True)
+    group_ends = torch.repeat_interleave(group_counts.cumsum(0), group_counts)
+
+    # candidate pairs (i, j), i < j in the same group and iou upper bound > iou_thres
+    num_pairs = group_ends - torch.arange(1, num_boxes + 1, device=boxes.device)  # pairs of each row
+    pair_ends = num_pairs.cumsum(0)
+    chunk_ends = torch.searchsorted(pair_ends, torch.arange(chunk_size, int(pair_ends[-1]) + chunk_size, chunk_size,
+                                                            device=boxes.device), right=True).tolist()
+    pair_i, pair_j, start = [], [], 0
+    for end in chunk_ends:
+        end = min(max(end, start + 1), num_boxes)  # at least one row per chunk
+        if end <= start:
+            break
+        rows = torch.arange(start, end, device=boxes.device)
+        i = torch.repeat_interleave(rows, num_pairs[start:end])
+        first = pair_ends[start:end] - num_pairs[start:end]  # first pair of each row
+        j = i + 1 + torch.arange(i.shape[0], device=boxes.device) - torch.repeat_interleave(
+            first - first[0], num_pairs[start:end]
+        )
+        hull_inter = (half_sizes[i] + half_sizes[j] - (centers[i] - centers[j]).abs()).clamp(min=0).prod(1)
+        inter_bound = torch.minimum(hull_inter, torch.minimum(areas[i], areas[j]))
+        is_pair = inter_bound > iou_thres * (areas[i] + areas[j] - inter_bound)
+        pair_i.append(i[is_pair])
+        pair_j.append(j[is_pair])
+        start = end
+    if not pair_i:  # every box is alone in its group
+        return order[scores[order].sort(descending=True, stable=True)[1]]
+    pair_i, pair_j = torch.cat(pair_i), torch.cat(pair_j)
+
+    ious = rotated_box_iou(boxes[pair_i], boxes[pair_j], is_aligned=True)
+    is_suppress = ious > iou_thres
+    pair_i, pair_j = pair_i[is_suppress], pair_j[is_suppress]
+
+    # box j is kept if no kept box i before it suppresses it, converges in (suppression chain depth) iterations
+    keep = torch.ones(num_boxes, dtype=torch.bool, device=boxes.device)
+    while True:
+        suppressed = torch.zeros_like(keep)
+        suppressed[pair_j[keep[pair_i]]] = True
+        if torch.equal(~suppressed, keep):
+            break
+        keep = ~suppressed
+    keep = order[keep]
+    return keep[scores[keep].sort(descending=True, stable=True)[1]]
+
+
+def _rank_in_group(scores, idxs, num_groups):
+    """Rank (0 is the highest score) of each score inside its group, scores are sorted in decreasing order."""
+    order = idxs.sort(stable=True)[1]
+    counts = torch.bincount(idxs, minlength=num_groups)
+    starts = counts.cumsum(0) - counts
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(order.shape[0], device=scores.device) - starts[idxs[order]]
+    return rank
+
+
+def non_max_suppression_obb_cv2(
+    prediction,
+    conf_thres=0.25,
+    iou_thres=0.45,
+    classes=None,
+    agnostic=False,
+    multi_label=False,
+    max_det=300,
+    time_limit=100.0,
+):
+    """Runs per image Non-Maximum Suppression (NMS) with cv2.dnn.NMSBoxesRotated.
+    Kept as the reference implementation of non_max_suppression_obb, e.g. for tools/benchmark_nms_R.py.
     This code is borrowed from: https://github.com/ultralytics/yolov5/blob/47233e1698b89fc437a4fb9463c815e9171be955/utils/general.py#L775
     Args:
         prediction: (tensor), with shape [N, 6 + num_classes], N is the number of bboxes.
@@ -164,6 +485,7 @@ def non_max_suppression_obb(
         agnostic: (bool), when it is set to True, we do class-independent nms, otherwise, different class would do nms respectively.
         multi_label: (bool), when it is set to True, one box can have multi labels, otherwise, one box only huave one label.
         max_det:(int), max number of output bboxes.
+        time_limit: (float or None), seconds after which the remaining images are left empty, None disables it.
 
     Returns:
          list of detections, echo item is one tensor with shape (num_boxes, 6), 6 is for [xywh, conf, cls].
@@ -182,7 +504,6 @@ def non_max_suppression_obb(
     # Function settings.
     max_wh = 4096  # maximum box width and height
     max_nms = 30000  # maximum number of boxes put into torchvision.ops.nms()
-    time_limit = 100.0  # quit the function when nms cost time exceed the limit time.
     multi_label &= num_classes > 1  # multiple labels per box
 
     tik = time.time()
@@ -253,7 +574,7 @@ def non_max_suppression_obb(
 
         output[img_idx] = x[keep_box_idx]
 
-        if (time.time() - tik) > time_limit:
+        if time_limit is not None and (time.time() - tik) > time_limit:
             print(f"WARNING: NMS cost time exceed the limited {time_limit}s.")
             break  # time limit exceeded
 
@@ -261,7 +582,15 @@ def non_max_suppression_obb(
 
 
 def non_max_suppression_obb_cuda(
-    prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False, max_det=2000
+    prediction,
+    conf_thres=0.25,
+    iou_thres=0.45,
+    classes=None,
+    agnostic=False,
+    multi_label=False,
+    max_det=2000,
+    max_candidates=30000,
+    time_limit=100.0,
 ):
     """Runs Non-Maximum Suppression (NMS) on inference results.
     This code is borrowed from: https://github.com/ultralytics/yolov5/blob/47233e1698b89fc437a4fb9463c815e9171be955/utils/general.py#L775
@@ -273,64 +602,39 @@ def non_max_suppression_obb_cuda(
         agnostic: (bool), when it is set to True, we do class-independent nms, otherwise, different class would do nms respectively.
         multi_label: (bool), when it is set to True, one box can have multi labels, otherwise, one box only huave one label.
         max_det:(int), max number of output bboxes.
+        max_candidates: (int), max number of candidates of one image put into NMS, see select_candidates_obb().
+        time_limit: (float or None), seconds after which the remaining images are left empty, None disables it.
 
     Returns:
          list of detections, echo item is one tensor with shape (num_boxes, 6), 6 is for [xywh, conf, cls].
     """
 
+    if nms_rotated is None:  # mmcv is not installed, use the pure torch batched NMS
+        return non_max_suppression_obb(
+            prediction, conf_thres, iou_thres, classes, agnostic, multi_label, max_det, max_candidates
+        )
+
     # NOTE [N, x, y, w, h, angle, conf, classes]
     # NOTE [N, 0, 1, 2, 3, 4,      5,      6:]
-    num_classes = prediction.shape[2] - 6  # number of classes
-    pred_candidates = torch.logical_and(
-        prediction[..., 5] > conf_thres, torch.max(prediction[..., 6:], axis=-1)[0] > conf_thres
-    )  # candidates
     # Check the parameters.
     assert 0 <= conf_thres <= 1, f"conf_thresh must be in 0.0 to 1.0, however {conf_thres} is provided."
     assert 0 <= iou_thres <= 1, f"iou_thres must be in 0.0 to 1.0, however {iou_thres} is provided."
 
     # Function settings.
     max_wh = 4096  # maximum box width and height
-    max_nms = 30000  # maximum number of boxes put into torchvision.ops.nms()
-    time_limit = 100.0  # quit the function when nms cost time exceed the limit time.
-    multi_label &= num_classes > 1  # multiple labels per box
 
     tik = time.time()
-    output = [torch.zeros((0, 7), device=prediction.device)] * prediction.shape[0]
-    for img_idx, x in enumerate(prediction):  # image index, image inference
-        x = x[pred_candidates[img_idx]]  # confidence
-
+    # Detections matrix's shape is  (n,7), each row represents (xywh, angle, conf, cls)
+    img_idx, box_idx, class_idx, conf = select_candidates_obb(
+        prediction, conf_thres, classes, multi_label, max_candidates
+    )
+    x = torch.cat((prediction[img_idx, box_idx, :5], conf[:, None], class_idx[:, None].to(prediction.dtype)), 1)
+    output = list(x.split(torch.bincount(img_idx, minlength=prediction.shape[0]).tolist()))
+    for img_idx, x in enumerate(output):  # image index, image inference
         # If no box remains, skip the next process.
         if not x.shape[0]:
             continue
 
-        # confidence multiply the objectness
-        x[:, 6:] *= x[:, 5:6]  # conf = obj_conf * cls_conf
-
-        # (center x, center y, width, height)
-        box = x[:, :4]
-        angle = x[:, 4:5].clone()
-
-        # Detections matrix's shape is  (n,6), each row represents (xyxy, conf, cls)
-        if multi_label:
-            box_idx, class_idx = (x[:, 6:] > conf_thres).nonzero(as_tuple=False).T
-            x = torch.cat(
-                (box[box_idx], angle[box_idx], x[box_idx, class_idx + 6, None], class_idx[:, None].float()), 1
-            )
-        else:  # Only keep the class with highest scores.
-            conf, class_idx = x[:, 6:].max(1, keepdim=True)
-            x = torch.cat((box, angle, conf, class_idx.float()), 1)[conf.view(-1) > conf_thres]
-
-        # Filter by class, only keep boxes whose category is in classes.
-        if classes is not None:
-            x = x[(x[:, 6:7] == torch.tensor(classes, device=x.device)).any(1)]
-
-        # Check shape
-        num_box = x.shape[0]  # number of boxes
-        if not num_box:  # no boxes kept.
-            continue
-        elif num_box > max_nms:  # excess max boxes' number.
-            x = x[x[:, 5].argsort(descending=True)[:max_nms]]  # sort by confidence
-
         # Batched NMS
         class_offset = x[:, 6:7] * (0 if agnostic else max_wh)  # classes
         boxes, scores = x[:, :5].clone(), x[:, 5]  # boxes (offset by class), scores
@@ -350,8 +654,9 @@ def non_max_suppression_obb_cuda(
 
         output[img_idx] = x[keep_box_idx]
 
-        if (time.time() - tik) > time_limit:
+        if time_limit is not None and (time.time() - tik) > time_limit:
             print(f"WARNING: NMS cost time exceed the limited {time_limit}s.")
+            output[img_idx + 1 :] = [out[:0] for out in output[img_idx + 1 :]]  # NOTE 剩余图像的候选未经 NMS, 不输出
             break  # time limit exceeded
 
     return output
@@ -393,6 +698,25 @@ def rbox2poly(obboxes):
         return np.concatenate([point1, point2, point3, point4], axis=-1).reshape(*order, 8)
 
 
+def poly2rbox(polys):
+    """
+    Trans poly format to rbox format, the inverse of rbox2poly, general quadrilaterals get the mean of opposite sides.
+    Args:
+        polys (array/tensor): (num_gts, [x1 y1 x2 y2 x3 y3 x4 y4])
+    Returns:
+        rboxes (array/tensor): (num_gts, [cx cy longSide shortSide theta]) theta∈[0, 180)
+    """
+    if not isinstance(polys, torch.Tensor):
+        return poly2rbox(torch.from_numpy(np.asarray(polys, dtype=np.float64))).numpy()
+    points = polys.reshape(*polys.shape[:-1], 4, 2)
+    center = points.mean(-2)
+    vector1 = (points[..., 3, :] - points[..., 0, :] + points[..., 2, :] - points[..., 1, :]) / 2.0  # point1 -> point4
+    vector2 = (points[..., 1, :] - points[..., 0, :] + points[..., 2, :] - points[..., 3, :]) / 2.0  # point1 -> point2
+    longSide, shortSide = vector1.norm(dim=-1, keepdim=True), vector2.norm(dim=-1, keepdim=True)
+    theta = torch.remainder(torch.atan2(vector1[..., 1:], vector1[..., :1]) * 180.0 / torch.pi, 180.0)
+    return torch.cat((center, longSide, shortSide, theta), dim=-1)
+
+
 def rbox2poly_radius(obboxes):
     """
     Trans rbox format to poly format.